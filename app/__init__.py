@@ -1,11 +1,26 @@
 from flask import Flask, request
 from flask_login import LoginManager, login_user
-from .models.user import User
+from flask_migrate import Migrate
+from flask_sqlalchemy import SQLAlchemy
 
+db = SQLAlchemy()
+migrate = Migrate()
 login_manager = LoginManager()
 
+from .models.user import User
+from .models.transaction import Transaction
+from .services import statement_import
+from .services.import_jobs import import_jobs
+from .services.row_fingerprints import row_fingerprints
+from .utils.password_hasher import password_hasher
+from .utils.pdf_imports import page_extractor
+from .utils.statement_cache import statement_cache
+from .utils.transaction_cache import transaction_cache
+from .utils.uploads import SpooledUploadRequest
+
 def create_app():
     app = Flask(__name__)
+    app.request_class = SpooledUploadRequest
     from config import Config
     app.config.from_object(Config)
     app.config['UPLOAD_FOLDER'] = 'uploads'
@@ -13,6 +28,20 @@ def create_app():
     app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16 MB
     app.config['UPLOAD_FOLDER'] = 'uploads'
     app.config['ALLOWED_EXTENSIONS'] = {'pdf'}
+
+    transaction_cache.configure(app.config['TRANSACTION_CACHE_MAX_BYTES'])
+    password_hasher.configure(app.config['PASSWORD_HASH_METHOD'], app.config['PASSWORD_HASH_WORKERS'])
+    page_extractor.configure(app.config['PDF_EXTRACT_WORKERS'], app.config['PDF_BACKEND'],
+                             app.config['PDF_BACKEND_OVERRIDES'])
+    import_jobs.configure(app.config['IMPORT_JOB_FOLDER'], app.config['IMPORT_JOB_WORKERS'],
+                          app.config['IMPORT_JOB_TTL'])
+    statement_import.configure(app.config['STATEMENT_EXTRACT_MODE'])
+    statement_cache.configure(app.config['STATEMENT_CACHE_FOLDER'], app.config['STATEMENT_CACHE_MAX_BYTES'])
+    row_fingerprints.configure(app.config['ROW_FINGERPRINT_FOLDER'])
+
+    db.init_app(app)
+    migrate.init_app(app, db)
+    Transaction.configure_store(app.config['TRANSACTION_BACKEND'], app)
     
     login_manager.init_app(app)
     login_manager.login_view = 'auth.login'
@@ -1,42 +1,232 @@
-import csv
+import logging
+import re
+import sys
 import uuid
 from datetime import datetime
-from pathlib import Path
+from ..services.row_fingerprints import row_fingerprints, transaction_fingerprint
+from ..storage import create_store, encode_cursor, decode_cursor
+from ..utils.money import to_satang, format_satang
+
+# Shared value for fields that were left empty
+EMPTY = ''
+
+
+def _satang_or_none(value):
+    if value is None or value == EMPTY:
+        return None
+    return to_satang(value)
+
+
+def _intern(value):
+    return sys.intern(value) if value else EMPTY
+
+
+# Substrings of a transaction's detail or description that place it in a
+# category; the first category with a match wins
+CATEGORY_PATTERNS = {
+    "Food/Groceries": [
+        "supermarket", "grocery", "restaurant", "cafe", "food", "bakery",
+        "coffee", "dining", "market", "takeout", "delivery", "convenience",
+        "7-eleven", "big c", "tesco", "lotus", "makro", "tops", "foodland",
+        "canteen", "food court", "foodcourt", "foodpanda", "grab food",
+        "kfc", "mcdonalds", "pizza", "burger", "sushi", "noodle", "rice",
+        "beverage", "drink", "snack", "dessert", "ice cream", "chocolate"
+    ],
+    "Utilities": [
+        "electric", "water", "internet", "phone", "mobile", "utility",
+        "bill", "payment", "ptt", "true", "ais", "dtac", "3bb", "tot",
+        "cable tv", "television", "tv", "streaming", "netflix", "spotify",
+        "youtube", "disney+", "prime video", "electricity", "power",
+        "gas", "petrol", "lpg", "ngv", "piped gas", "utility bill"
+    ],
+    "Transportation": [
+        "bus", "train", "mrt", "bts", "taxi", "grab", "bolt", "airport",
+        "rail", "transport", "fuel", "gasoline", "petrol", "parking",
+        "toll", "expressway", "highway", "car", "motorcycle", "bike",
+        "bicycle", "rental", "uber", "lyft", "commute", "travel",
+        "airline", "flight", "boat", "ferry", "subway", "metro"
+    ],
+    "Savings": [
+        "transfer", "withdraw", "deposit", "savings", "investment",
+        "interest", "dividend", "fund", "stock", "bond", "mutual fund",
+        "retirement", "pension", "insurance", "premium", "policy",
+        "wealth", "asset", "portfolio", "bank", "account", "atm",
+        "withdrawal", "deposit", "โอนเงิน", "เงินโอน", "พร้อมเพย์"
+    ]
+}
+
+DEFAULT_CATEGORY = "Miscellaneous"
+
+# One alternation per category, so a category costs one scan of the text
+_CATEGORY_SEARCHES = [
+    (category, re.compile('|'.join(re.escape(pattern) for pattern in patterns)).search)
+    for category, patterns in CATEGORY_PATTERNS.items()
+]
+
+
+def categorize(detail, description=None):
+    """Category of a transaction from its detail and description.
+
+    Matching is case-insensitive. Returns DEFAULT_CATEGORY when no pattern
+    matches.
+    """
+    detail = (detail or EMPTY).lower()
+    description = (description or EMPTY).lower()
+    for category, search in _CATEGORY_SEARCHES:
+        if search(detail) or search(description):
+            return category
+    return DEFAULT_CATEGORY
+
 
 class Transaction:
+    FIELDNAMES = [
+        'id', 'user_id', 'date_time', 'transaction_type', 'detail', 'amount', 'extra',
+        'withdrawal', 'deposit', 'balance', 'branch', 'line_text', 'explanation', 'category', 'created_at', 'updated_at'
+    ]
+
+    # Amounts are kept as integer satang (None when empty) and only turned
+    # back into '1,234.00' strings when read through their properties.
+    __slots__ = (
+        'id', 'user_id', 'date_time', 'transaction_type', 'detail', '_amount', 'extra',
+        '_withdrawal', '_deposit', '_balance', 'branch', 'line_text', 'explanation', 'category', 'created_at', 'updated_at'
+    )
+
+    _store = None
+
     def __init__(self, **kwargs):
-        self.id = kwargs.get('id') or str(uuid.uuid4())
-        self.user_id = kwargs.get('user_id')
-        self.date_time = kwargs.get('date_time')
-        self.transaction_type = kwargs.get('transaction_type')
-        self.detail = kwargs.get('detail', '').lower()
-        self.amount = float(kwargs.get('amount', 0))
-        self.extra = kwargs.get('extra')
-        self.withdrawal = kwargs.get('withdrawal')
-        self.deposit = kwargs.get('deposit')
-        self.balance = kwargs.get('balance')
-        self.branch = kwargs.get('branch')
-        self.line_text = kwargs.get('line_text')
-        self.explanation = kwargs.get('explanation')
-        self.category = kwargs.get('category')
-        self.created_at = kwargs.get('created_at', datetime.now())
-        self.updated_at = kwargs.get('updated_at', datetime.now())
+        get = kwargs.get
+        self.id = get('id') or str(uuid.uuid4())
+        self.user_id = _intern(get('user_id'))
+        self.date_time = get('date_time')
+        self.transaction_type = _intern(get('transaction_type'))
+        self.detail = (get('detail') or EMPTY).lower()
+        self._amount = to_satang(get('amount'))
+        self.extra = get('extra') or EMPTY
+        self._withdrawal = _satang_or_none(get('withdrawal'))
+        self._deposit = _satang_or_none(get('deposit'))
+        self._balance = _satang_or_none(get('balance'))
+        self.branch = _intern(get('branch'))
+        self.line_text = get('line_text') or EMPTY
+        self.explanation = get('explanation') or EMPTY
+        self.category = _intern(get('category')) or None
+        created_at = get('created_at')
+        updated_at = get('updated_at')
+        if created_at is None or updated_at is None:
+            now = datetime.now()
+            created_at = created_at or now
+            updated_at = updated_at or now
+        self.created_at = created_at
+        self.updated_at = updated_at
+
+    def __copy__(self):
+        clone = object.__new__(self.__class__)
+        for name in Transaction.__slots__:
+            setattr(clone, name, getattr(self, name))
+        return clone
+
+    @property
+    def amount(self):
+        return self._amount / 100
+
+    @amount.setter
+    def amount(self, value):
+        self._amount = to_satang(value)
+
+    @property
+    def withdrawal(self):
+        return EMPTY if self._withdrawal is None else format_satang(self._withdrawal)
+
+    @withdrawal.setter
+    def withdrawal(self, value):
+        self._withdrawal = _satang_or_none(value)
+
+    @property
+    def withdrawal_satang(self):
+        return self._withdrawal or 0
+
+    @property
+    def deposit(self):
+        return EMPTY if self._deposit is None else format_satang(self._deposit)
+
+    @deposit.setter
+    def deposit(self, value):
+        self._deposit = _satang_or_none(value)
+
+    @property
+    def deposit_satang(self):
+        return self._deposit or 0
+
+    @property
+    def balance(self):
+        return EMPTY if self._balance is None else format_satang(self._balance)
+
+    @balance.setter
+    def balance(self, value):
+        self._balance = _satang_or_none(value)
+
+    @property
+    def balance_satang(self):
+        return self._balance or 0
+
+    @property
+    def formatted_date_time(self):
+        if isinstance(self.date_time, datetime):
+            return self.date_time.strftime('%d/%m/%y %H:%M')
+        return self.date_time
+
+    @property
+    def cursor(self):
+        """Page cursor pointing just past this transaction."""
+        return encode_cursor(self.date_time, self.id)
+
+    def to_dict(self):
+        """Return the transaction as a CSV row keyed by FIELDNAMES."""
+        return {name: getattr(self, name) for name in self.FIELDNAMES}
+
+    @classmethod
+    def configure_store(cls, name, app=None):
+        """Select the storage backend used by the class methods below.
+
+        Args:
+            name (str): Backend name, see ``Config.TRANSACTION_BACKEND``
+            app (Flask): The app, needed by database-backed stores
+        """
+        cls._store = create_store(name, cls, app)
+
+    @classmethod
+    def get_store(cls):
+        if cls._store is None:
+            cls._store = create_store('csv', cls)
+        return cls._store
 
     def save_user_transaction(self):
-        """Save the transaction to a CSV file."""
-        file_path = Path('user_transactions') / f'{self.user_id}.csv'
-        file_path.parent.mkdir(parents=True, exist_ok=True)
+        """Append the transaction to its user's stored transactions."""
+        self.append_user_transactions(self.user_id, [self])
 
-        with open(file_path, 'a', newline='', encoding='utf-8') as f:
-            writer = csv.DictWriter(f, fieldnames=[
-                'id', 'user_id', 'date_time', 'transaction_type', 'detail', 'amount', 'extra',
-                'withdrawal', 'deposit', 'balance', 'branch', 'line_text', 'explanation', 'category', 'created_at', 'updated_at'
-            ])
-            writer.writerow(self.__dict__)
+    @classmethod
+    def append_user_transactions(cls, user_id, transactions):
+        """Append new transactions to a user's stored transactions.
+
+        With the CSV backend only the new rows are written; the header is
+        added if the file does not exist yet. Concurrent appends to the same
+        file are committed together.
+
+        Args:
+            user_id (str): The ID of the user
+            transactions (list[Transaction]): New transactions to append
+
+        Raises:
+            SchemaMismatchError: If the existing file's header does not have
+                the columns being written
+        """
+        if not transactions:
+            return
+        cls.get_store().append(user_id, transactions)
+        row_fingerprints.add(user_id, [transaction_fingerprint(t) for t in transactions])
 
     @classmethod
     def save_user_transactions(cls, user_id, transactions):
-        """Save multiple transactions to a CSV file.
+        """Replace all of a user's stored transactions.
         
         Args:
             user_id (str): The ID of the user
@@ -53,135 +243,178 @@ class Transaction:
             return
 
         try:
-            file_path = Path('user_transactions') / f'{user_id}.csv'
-            file_path.parent.mkdir(parents=True, exist_ok=True)
-            logger.info(f"Saving transactions to: {file_path}")
-
-            # Get fieldnames from first transaction
-            fieldnames = list(transactions[0].__dict__.keys())
-            logger.debug(f"Using fieldnames: {fieldnames}")
-
-            # Write all transactions at once
-            with open(file_path, 'w', newline='', encoding='utf-8') as f:
-                writer = csv.DictWriter(f, fieldnames=fieldnames)
-                writer.writeheader()
-                for i, transaction in enumerate(transactions, 1):
-                    try:
-                        writer.writerow(transaction.__dict__)
-                        logger.debug(f"Successfully wrote transaction {i}/{len(transactions)}")
-                    except Exception as e:
-                        logger.error(f"Error writing transaction {i}: {str(e)}")
-                        logger.debug(f"Transaction data: {transaction.__dict__}")
-                        raise
-
+            logger.info(f"Saving {len(transactions)} transactions for user {user_id}")
+            cls.get_store().save_all(user_id, transactions)
+            row_fingerprints.replace(user_id, [transaction_fingerprint(t) for t in transactions])
             logger.info(f"Successfully saved {len(transactions)} transactions")
         except Exception as e:
             logger.error(f"Error saving transactions: {str(e)}")
             raise Exception(f"Failed to save transactions: {str(e)}")
 
     @classmethod
-    def get_user_transactions(cls, user_id):
+    def modify_user_transactions(cls, user_id, change):
+        """Apply ``change`` to all of a user's transactions and save the result.
+
+        Unlike loading and then calling save_user_transactions, this never
+        loses another worker's concurrent write: the change is re-run on
+        fresh data if the stored transactions moved underneath it.
+
+        Args:
+            user_id (str): The ID of the user
+            change (callable): Takes the current list of Transaction objects
+                and returns the list to store
+
+        Returns:
+            list[Transaction]: The transactions that were stored
+
+        Raises:
+            ConcurrentUpdateError: If the write kept losing races
+        """
+        transactions = cls.get_store().modify(user_id, change)
+        row_fingerprints.replace(user_id, [transaction_fingerprint(t) for t in transactions])
+        return transactions
+
+    @classmethod
+    def update_user_transactions(cls, user_id, transactions):
+        """Write back edited transactions, matched by id.
+
+        Args:
+            user_id (str): The ID of the user
+            transactions (list[Transaction]): Edited transactions
+        """
+        if not transactions:
+            return
+        store = cls.get_store()
+        old = store.get_many(user_id, [t.id for t in transactions])
+        store.update(user_id, transactions)
+        # Only edits to the date, amounts or detail change a fingerprint
+        before, after = [], []
+        for t in transactions:
+            if t.id in old:
+                was, now = transaction_fingerprint(old[t.id]), transaction_fingerprint(t)
+                if was != now:
+                    before.append(was)
+                    after.append(now)
+        row_fingerprints.remove(user_id, before)
+        row_fingerprints.add(user_id, after)
+
+    @classmethod
+    def delete_user_transactions(cls, user_id, transaction_ids):
+        """Delete transactions by id.
+
+        Args:
+            user_id (str): The ID of the user
+            transaction_ids (list[str]): IDs of the transactions to delete
+
+        Returns:
+            int: Number of transactions deleted
+        """
+        store = cls.get_store()
+        deleted = store.get_many(user_id, transaction_ids)
+        count = store.delete(user_id, transaction_ids)
+        row_fingerprints.remove(user_id, [transaction_fingerprint(t) for t in deleted.values()])
+        return count
+
+    @classmethod
+    def get_user_transactions(cls, user_id, start=None, end=None):
         """Retrieve all transactions for a specific user.
-        
+
         Args:
             user_id (str): The ID of the user whose transactions to retrieve
+            start (datetime): Only include transactions at or after this time
+            end (datetime): Only include transactions before this time
             
         Returns:
             list[Transaction]: List of Transaction objects
         """
-        file_path = Path('user_transactions') / f'{user_id}.csv'
-        if not file_path.exists():
-            return []
-
-        transactions = []
-        with open(file_path, 'r', newline='', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                # Convert string dates to datetime objects
-                try:
-                    # Try ISO format first
-                    row['date_time'] = datetime.fromisoformat(row['date_time'])
-                except ValueError:
-                    try:
-                        # Try custom format with time
-                        row['date_time'] = datetime.strptime(row['date_time'], '%d/%m/%y %H:%M')
-                    except ValueError:
-                        try:
-                            # Try custom format without time
-                            row['date_time'] = datetime.strptime(row['date_time'], '%d/%m/%y')
-                        except ValueError:
-                            # Fallback to current time if all formats fail
-                            row['date_time'] = datetime.now()
-                
-                try:
-                    row['created_at'] = datetime.fromisoformat(row['created_at'])
-                except ValueError:
-                    try:
-                        row['created_at'] = datetime.strptime(row['created_at'], '%Y-%m-%d %H:%M:%S.%f')
-                    except ValueError:
-                        row['created_at'] = datetime.now()
-                
-                try:
-                    row['updated_at'] = datetime.fromisoformat(row['updated_at'])
-                except ValueError:
-                    try:
-                        row['updated_at'] = datetime.strptime(row['updated_at'], '%Y-%m-%d %H:%M:%S.%f')
-                    except ValueError:
-                        row['updated_at'] = datetime.now()
-                transactions.append(cls(**row))
-        
-        return transactions
+        return cls.get_store().load(user_id, start=start, end=end)
+
+    @classmethod
+    def iter_user_transactions(cls, user_id, start=None, end=None, categories=None):
+        """Yield a user's transactions one at a time, filtered while reading.
+
+        Unlike get_user_transactions this never holds the whole history in
+        memory. Once a CSV file is known to be in date order, reading stops
+        at the first row past ``end``.
+
+        Args:
+            user_id (str): The ID of the user whose transactions to retrieve
+            start (datetime): Only include transactions at or after this time
+            end (datetime): Only include transactions before this time
+            categories (Iterable[str]): Only include these categories
+
+        Yields:
+            Transaction: Matching transactions in stored order
+        """
+        return cls.get_store().iter(user_id, start=start, end=end, categories=categories)
+
+    @classmethod
+    def get_user_transactions_page(cls, user_id, cursor=None, limit=50):
+        """Yield one page of a user's transactions, newest first.
+
+        Pages are ordered by (date_time, id). Pass the ``cursor`` of the last
+        transaction on a page to get the next one.
+
+        Args:
+            user_id (str): The ID of the user whose transactions to retrieve
+            cursor (str): Cursor of the last transaction already shown
+            limit (int): Maximum number of transactions on the page
+
+        Raises:
+            ValueError: If the cursor is malformed
+        """
+        after = decode_cursor(cursor) if cursor else None
+        return cls.get_store().page(user_id, after=after, limit=limit)
+
+    @classmethod
+    def get_user_summary(cls, user_id):
+        """Return a user's UserSummary: transaction count, deposit and
+        withdrawal totals, current balance, and monthly and category totals.
+
+        The summary is maintained incrementally as transactions change, so
+        reading it does not depend on the size of the history.
+        """
+        return cls.get_store().summary(user_id)
+
+    @classmethod
+    def get_user_transactions_by_id(cls, user_id, transaction_ids):
+        """Retrieve a user's transactions with the given ids.
+
+        Returns:
+            dict[str, Transaction]: Found transactions keyed by id
+        """
+        return cls.get_store().get_many(user_id, transaction_ids)
+
+    @classmethod
+    def find_stored_fingerprints(cls, user_id, fingerprints):
+        """Return which row fingerprints match transactions the user already has.
+
+        Lookups are O(1) against the user's persisted fingerprint set (see
+        :class:`~app.services.row_fingerprints.RowFingerprints`), which is
+        rebuilt from the stored rows if it has drifted from them.
+
+        Args:
+            user_id (str): The ID of the user
+            fingerprints (Iterable[str]): From row_fingerprint or
+                transaction_fingerprint
+
+        Returns:
+            set[str]: The fingerprints already stored
+        """
+        return row_fingerprints.known(user_id, fingerprints, cls.get_user_summary(user_id).count,
+                                      lambda: cls.iter_user_transactions(user_id))
+
+    @classmethod
+    def get_user_transaction(cls, user_id, transaction_id):
+        """Retrieve a single transaction, or None if the user has no such id."""
+        return cls.get_user_transactions_by_id(user_id, [transaction_id]).get(transaction_id)
 
     def auto_categorize(self):
         """Automatically categorize transactions based on patterns in details and descriptions."""
-        import logging
-        
-        # Mapping of patterns to categories
-        CATEGORY_MAPPING = {
-            "Food/Groceries": [
-                "supermarket", "grocery", "restaurant", "cafe", "food", "bakery",
-                "coffee", "dining", "market", "takeout", "delivery", "convenience",
-                "7-eleven", "big c", "tesco", "lotus", "makro", "tops", "foodland",
-                "canteen", "food court", "foodcourt", "foodpanda", "grab food",
-                "kfc", "mcdonalds", "pizza", "burger", "sushi", "noodle", "rice",
-                "beverage", "drink", "snack", "dessert", "ice cream", "chocolate"
-            ],
-            "Utilities": [
-                "electric", "water", "internet", "phone", "mobile", "utility",
-                "bill", "payment", "ptt", "true", "ais", "dtac", "3bb", "tot",
-                "cable tv", "television", "tv", "streaming", "netflix", "spotify",
-                "youtube", "disney+", "prime video", "electricity", "power",
-                "gas", "petrol", "lpg", "ngv", "piped gas", "utility bill"
-            ],
-            "Transportation": [
-                "bus", "train", "mrt", "bts", "taxi", "grab", "bolt", "airport",
-                "rail", "transport", "fuel", "gasoline", "petrol", "parking",
-                "toll", "expressway", "highway", "car", "motorcycle", "bike",
-                "bicycle", "rental", "uber", "lyft", "commute", "travel",
-                "airline", "flight", "boat", "ferry", "subway", "metro"
-            ],
-            "Savings": [
-                "transfer", "withdraw", "deposit", "savings", "investment",
-                "interest", "dividend", "fund", "stock", "bond", "mutual fund",
-                "retirement", "pension", "insurance", "premium", "policy",
-                "wealth", "asset", "portfolio", "bank", "account", "atm",
-                "withdrawal", "deposit", "โอนเงิน", "เงินโอน", "พร้อมเพย์"
-            ]
-        }
-
-        # Normalize text for case-insensitive matching
-        detail = self.detail.lower()
-        description = (self.transaction_type or "").lower()
-
-        # Find matching category
-        self.category = "Miscellaneous"  # Default category
-        for category, patterns in CATEGORY_MAPPING.items():
-            if any(pattern in detail or pattern in description for pattern in patterns):
-                self.category = category
-                break
+        self.category = categorize(self.detail, self.transaction_type)
 
         # Log uncategorized transactions for review
-        if self.category == "Miscellaneous":
+        if self.category == DEFAULT_CATEGORY:
             logging.info(f"Uncategorized transaction: {self.detail} ({self.transaction_type})")
 
         return self
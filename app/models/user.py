@@ -1,9 +1,102 @@
+import contextlib
 import csv
+import logging
 import os
+import tempfile
+import threading
 from pathlib import Path
 from datetime import datetime
-from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
+from ..utils.file_lock import file_lock, increment_counter
+from ..utils.password_hasher import password_hasher
+from ..utils.transaction_cache import file_signature
+
+FIELDNAMES = ['id', 'username', 'email', 'password_hash', 'created_at']
+
+
+class DuplicateUserError(ValueError):
+    """Raised when registering a username or email that is already taken."""
+
+
+class UserIndex:
+    """In-memory index of users.csv by id, username and email.
+
+    The file is parsed once and again only when its signature (mtime, size,
+    inode) changes, e.g. after another worker registered a user. Users
+    created by this process are added in place without a re-read. Lookups
+    are dict hits, so the cost of authenticating a request does not grow
+    with the number of users.
+    """
+
+    def __init__(self):
+        self._signature = None
+        # id -> row dict, in file order
+        self._by_id = {}
+        self._by_username = {}
+        self._by_email = {}
+        # Largest numeric id in the file
+        self._max_id = 0
+        self._lock = threading.Lock()
+
+    def rows(self, file_path):
+        """Return all rows in file order, re-reading the file if it changed."""
+        with self._current(file_path):
+            return list(self._by_id.values())
+
+    def get(self, file_path, field, value):
+        """Return the row whose ``field`` (id, username or email) is ``value``, or None."""
+        with self._current(file_path):
+            table = {'id': self._by_id, 'username': self._by_username, 'email': self._by_email}[field]
+            return table.get(value)
+
+    def max_id(self, file_path):
+        """Return the largest numeric user id in the file, or 0."""
+        with self._current(file_path):
+            return self._max_id
+
+    @contextlib.contextmanager
+    def _current(self, file_path):
+        """Hold the lock with the index matching the file on disk."""
+        signature = file_signature(file_path)
+        with self._lock:
+            if signature != self._signature:
+                self._load(file_path, signature)
+            yield
+
+    def _load(self, file_path, signature):
+        self._by_id, self._by_username, self._by_email = {}, {}, {}
+        self._max_id = 0
+        if signature is not None:
+            with open(file_path, 'r', newline='') as f:
+                for row in csv.DictReader(f):
+                    self._add(row)
+        self._signature = signature
+
+    def _add(self, row):
+        # Same precedence as the linear scans this replaces: first row wins
+        self._by_id.setdefault(row.get('id'), row)
+        self._by_username.setdefault(row.get('username'), row)
+        if row.get('email'):
+            self._by_email.setdefault(row['email'], row)
+        user_id = row.get('id') or ''
+        if user_id.isdigit():
+            self._max_id = max(self._max_id, int(user_id))
+
+    def added(self, file_path, row, previous_signature):
+        """Record a row this process just appended to the file.
+
+        The index is only updated in place if it was current before the
+        append; otherwise the next lookup re-reads the file.
+        """
+        with self._lock:
+            if self._signature is not None and self._signature == previous_signature:
+                self._add(row)
+                self._signature = file_signature(file_path)
+
+
+user_index = UserIndex()
+
+logger = logging.getLogger(__name__)
 
 class User(UserMixin):
     def __init__(self, **kwargs):
@@ -14,10 +107,53 @@ class User(UserMixin):
         self.created_at = kwargs.get('created_at', datetime.now().isoformat())
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return password_hasher.verify(self.password_hash, password)
+
+    def upgrade_password(self, password):
+        """Rehash a just-verified password if its hash uses an outdated method or cost.
+
+        Returns:
+            bool: Whether the stored hash was replaced
+        """
+        if not password_hasher.needs_rehash(self.password_hash):
+            return False
+        self.set_password(password)
+        User.update_password_hash(self.id, self.password_hash)
+        logger.info(f"Upgraded password hash of user {self.id} to {password_hasher.method}")
+        return True
+
+    @staticmethod
+    def update_password_hash(user_id, password_hash):
+        """Replace a user's stored password hash.
+
+        users.csv is rewritten to a temp file and renamed over the old one
+        under the users lock, so lock-free readers see either version.
+        """
+        file_path = User.get_user_csv_path()
+        with file_lock(file_path.with_suffix('.lock')):
+            with open(file_path, 'r', newline='') as f:
+                reader = csv.DictReader(f)
+                fieldnames = reader.fieldnames or FIELDNAMES
+                rows = list(reader)
+            for row in rows:
+                if row.get('id') == user_id:
+                    row['password_hash'] = password_hash
+            fd, tmp_path = tempfile.mkstemp(dir=file_path.parent, prefix=f'.{file_path.name}.')
+            try:
+                with os.fdopen(fd, 'w', newline='') as f:
+                    writer = csv.DictWriter(f, fieldnames=fieldnames)
+                    writer.writeheader()
+                    writer.writerows(rows)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, file_path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+                raise
 
     @staticmethod
     def get_user_csv_path():
@@ -28,47 +164,63 @@ class User(UserMixin):
     @staticmethod
     def get_all_users():
         """Read all users from CSV"""
-        file_path = User.get_user_csv_path()
-        if not file_path.exists():
-            return []
-        
-        users = []
-        with open(file_path, 'r') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                users.append(User(**row))
-        return users
+        rows = user_index.rows(User.get_user_csv_path())
+        return [User(**row) for row in rows]
+
+    @staticmethod
+    def _lookup(field, value):
+        row = user_index.get(User.get_user_csv_path(), field, value)
+        return User(**row) if row is not None else None
 
     @staticmethod
     def get_by_id(user_id):
         """Get user by ID"""
-        users = User.get_all_users()
-        return next((u for u in users if u.id == user_id), None)
+        return User._lookup('id', user_id)
 
     @staticmethod
     def get_by_username(username):
         """Get user by username"""
-        users = User.get_all_users()
-        return next((u for u in users if u.username == username), None)
+        return User._lookup('username', username)
+
+    @staticmethod
+    def get_by_email(email):
+        """Get user by email"""
+        return User._lookup('email', email)
 
     @staticmethod
     def create_user(username, email, password):
-        """Create a new user"""
-        users = User.get_all_users()
-        user_id = str(len(users) + 1)
-        
-        user = User(
-            id=user_id,
-            username=username,
-            email=email
-        )
+        """Create a new user.
+
+        Ids come from a sequence kept in ``user_data/users.lock``. It is
+        advanced under an exclusive lock together with the username and
+        email checks and the append, so parallel sign-ups across worker
+        processes never share an id, username or email.
+
+        Raises:
+            DuplicateUserError: If the username or email is already taken
+        """
+        user = User(username=username, email=email)
+        # Hash before taking the lock; it is by far the slowest step
         user.set_password(password)
-        
-        # Add new user to CSV
-        with open(User.get_user_csv_path(), 'a', newline='') as f:
-            writer = csv.DictWriter(f, fieldnames=['id', 'username', 'email', 'password_hash', 'created_at'])
-            if not f.tell():  # If file is empty, write header
-                writer.writeheader()
-            writer.writerow(user.__dict__)
-        
+
+        file_path = User.get_user_csv_path()
+        with file_lock(file_path.with_suffix('.lock')) as fd:
+            if user_index.get(file_path, 'username', username) is not None:
+                raise DuplicateUserError('Username already exists')
+            if email and user_index.get(file_path, 'email', email) is not None:
+                raise DuplicateUserError('Email already registered')
+            # Never below ids already in the file, e.g. ones written before
+            # the sequence existed
+            user.id = str(increment_counter(fd, floor=user_index.max_id(file_path)))
+
+            # Add new user to CSV
+            signature = file_signature(file_path)
+            row = dict(user.__dict__)
+            with open(file_path, 'a', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=FIELDNAMES)
+                if not f.tell():  # If file is empty, write header
+                    writer.writeheader()
+                writer.writerow(row)
+            user_index.added(file_path, row, signature)
+
         return user
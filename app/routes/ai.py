@@ -6,7 +6,7 @@ import json
 
 ai_bp = Blueprint('ai', __name__)
 
-from app.utils.pdf_parser import parse_transaction_line
+from app.services.statement_import import read_statement
 from collections import defaultdict
 import os
 
@@ -14,23 +14,10 @@ import os
 def index():
     return render_template('ai.html')
 
-import PyPDF2
-
 def load_transactions():
-    transactions = []
-    with open('transcript.pdf', 'rb') as f:
-        reader = PyPDF2.PdfReader(f)
-        for page in reader.pages:
-            text = page.extract_text()
-            for line in text.split('\n'):
-                # Try parsing as Thai transaction first
-                transaction = parse_thai_transaction(line)
-                if not transaction:
-                    # Fallback to generic parsero
-                    transaction = parse_transaction_line(line)
-                if transaction:
-                    transactions.append(transaction)
-    return transactions
+    # Parsed once per content and parser version, then served from the
+    # statement cache
+    return read_statement('transcript.pdf')['parsed_transactions']
 
 def analyze_transactions(transactions):
     categories = defaultdict(float)
@@ -94,30 +81,13 @@ def generate_ai_advice(analysis):
 def analysis_overview():
     from app.models.transaction import Transaction
     
-    # Initialize category totals
-    categories = defaultdict(float)
+    chart_data = {}
     
     # Check if user is authenticated
     if current_user.is_authenticated:
-        # Get user's transactions
-        transactions = Transaction.get_user_transactions(current_user.id)
-        
-        # Analyze transactions
-        for t in transactions:
-            # Ensure transaction is categorized
-            if not t.category:
-                t.auto_categorize()
-            
-            # Process withdrawals (expenses)
-            if t.withdrawal:
-                try:
-                    withdrawal = float(t.withdrawal.replace(',', ''))
-                    categories[t.category] += withdrawal
-                except ValueError:
-                    pass
-    
-    # Convert to format suitable for chart
-    chart_data = dict(categories)
+        # Withdrawals (expenses) per category from the user's summary;
+        # uncategorized transactions are counted under their auto category
+        chart_data = Transaction.get_user_summary(current_user.id).by_category('withdrawal')
     
     return jsonify({
         'categories': chart_data
@@ -1,6 +1,6 @@
 from flask import Blueprint, render_template, redirect, url_for, request, flash
 from flask_login import login_user, logout_user, current_user
-from ..models.user import User
+from ..models.user import DuplicateUserError, User
 from .. import login_manager
 
 auth_bp = Blueprint('auth', __name__)
@@ -20,6 +20,7 @@ def login():
         user = User.get_by_username(username)
         
         if user and user.check_password(password):
+            user.upgrade_password(password)
             login_user(user)
             return redirect(url_for('expenses.index'))
         flash('Invalid username or password')
@@ -35,10 +36,11 @@ def register():
         email = request.form.get('email')
         password = request.form.get('password')
         
-        if User.get_by_username(username):
-            flash('Username already exists')
-        else:
+        try:
             user = User.create_user(username, email, password)
+        except DuplicateUserError as e:
+            flash(str(e))
+        else:
             login_user(user)
             return redirect(url_for('expenses.index'))
     return render_template('register.html')
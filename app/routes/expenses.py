@@ -1,12 +1,14 @@
-from flask import Blueprint, render_template, redirect, url_for, request, flash, current_app, jsonify
+from flask import Blueprint, render_template, redirect, url_for, request, flash, current_app, jsonify, Response, stream_with_context
 from flask_login import login_required, current_user
-import os
+import json
 import uuid
-import pdfplumber
 import traceback
 from datetime import datetime
 from ..models.transaction import Transaction
-from ..utils.pdf_parser import parse_transaction_line
+from ..services.import_jobs import import_jobs
+from ..services.row_fingerprints import row_fingerprint
+from ..services.statement_import import parse_statement
+from ..utils.uploads import spool_upload
 
 # Temporary in-memory categories
 categories = [
@@ -25,24 +27,76 @@ categories = [
     {'id': 13, 'name': 'Miscellaneous', 'description': 'Other expenses'},
 ]
 
+# Transactions per page of the transaction table
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
 expenses_bp = Blueprint('expenses', __name__)
 
+def category_name(category_id):
+    """Map a category id from a form or preview row to its name."""
+    if not category_id:
+        return None
+    return next((c['name'] for c in categories if str(c['id']) == str(category_id)), None)
+
 @expenses_bp.route('/')
 @login_required
 def index():
-    transactions = Transaction.get_user_transactions(current_user.id)
+    # Only the newest page is rendered; the table fetches the rest from
+    # expenses.transactions_page as the user scrolls
+    transactions = list(Transaction.get_user_transactions_page(current_user.id, limit=PAGE_SIZE))
+    next_cursor = transactions[-1].cursor if len(transactions) == PAGE_SIZE else None
     
-    # Calculate totals
-    total_deposits = sum(float(t.deposit.replace(',', '')) if t.deposit else 0 for t in transactions)
-    total_withdrawals = sum(float(t.withdrawal.replace(',', '')) if t.withdrawal else 0 for t in transactions)
-    current_balance = float(transactions[-1].balance.replace(',', '')) if transactions else 0
+    # Totals come from the incrementally maintained summary, not from the page
+    summary = Transaction.get_user_summary(current_user.id)
     
     return render_template('expenses.html', 
                          transactions=transactions,
+                         next_cursor=next_cursor,
                          categories=categories,
-                         total_deposits=total_deposits,
-                         total_withdrawals=total_withdrawals,
-                         current_balance=current_balance)
+                         total_deposits=summary.total_deposits(),
+                         total_withdrawals=summary.total_withdrawals(),
+                         current_balance=summary.current_balance())
+
+@expenses_bp.route('/transactions')
+@login_required
+def transactions_page():
+    """Stream one page of transactions as JSON for the lazy-loading table."""
+    try:
+        limit = max(1, min(int(request.args.get('limit', PAGE_SIZE)), MAX_PAGE_SIZE))
+        page = Transaction.get_user_transactions_page(
+            current_user.id, cursor=request.args.get('cursor'), limit=limit)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    def generate():
+        yield '{"transactions": ['
+        count = 0
+        last = None
+        for transaction in page:
+            if count:
+                yield ','
+            yield json.dumps(transaction_json(transaction), ensure_ascii=False)
+            count += 1
+            last = transaction
+        next_cursor = last.cursor if count == limit else None
+        yield '], "next_cursor": ' + json.dumps(next_cursor) + '}'
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+def transaction_json(transaction):
+    """Serialize a stored transaction for the transaction table."""
+    return {
+        'id': transaction.id,
+        'date_time': transaction.formatted_date_time,
+        'transaction_type': transaction.transaction_type,
+        'detail': transaction.detail,
+        'deposit': transaction.deposit,
+        'withdrawal': transaction.withdrawal,
+        'balance': transaction.balance,
+        'explanation': transaction.explanation,
+        'category': transaction.category,
+    }
 
 @expenses_bp.route('/preview_transcript', methods=['POST'])
 @login_required
@@ -57,106 +111,82 @@ def preview_transcript():
         return redirect(url_for('expenses.index'))
 
     if file and file.filename.lower().endswith('.pdf'):
-        filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], file.filename)
-        file.save(filepath)
-
-        parsed_transactions = []
-        failed_transactions = []
-        non_transactions = []
-        
         try:
-            import chardet
-            
-            # First detect the file encoding
-            with open(filepath, 'rb') as f:
-                raw_data = f.read()
-                encoding = chardet.detect(raw_data)['encoding']
-                print(f"Detected encoding: {encoding}")
-            
-            # Try multiple extraction methods
-            page_text = None
-            methods = [
-                ('pdfplumber', lambda: pdfplumber.open(filepath)),
-                ('PyMuPDF', lambda: fitz.open(filepath))
-            ]
-            
-            for method_name, open_func in methods:
-                try:
-                    if method_name == 'pdfplumber':
-                        with open_func() as pdf:
-                            for page in pdf.pages:
-                                page_text = page.extract_text(x_tolerance=1, y_tolerance=1, encoding=encoding)
-                                if page_text:
-                                    break
-                    else:
-                        doc = open_func()
-                        page_text = ""
-                        for page in doc:
-                            page_text += page.get_text()
-                    print(f"Successfully extracted text using {method_name}")
-                    break
-                except Exception as e:
-                    print(f"Failed to extract text using {method_name}: {str(e)}")
-                    page_text = None
-                
-            if page_text is None:
-                print("All text extraction methods failed")
-                
-            if page_text:
-                page_lines = page_text.split('\n')
-                for line in page_lines:
-                    try:
-                        parsed = parse_transaction_line(line)
-                        if parsed:
-                            print(f"Successfully parsed line: {line}")
-                            print(f"Parsed data: {parsed}")
-                            # Ensure all required fields are present
-                            parsed['user_id'] = current_user.id
-                            parsed['explanation'] = ''
-                            parsed['category_id'] = None
-                            parsed['transaction_type'] = parsed.get('transaction', '')
-                            parsed['branch'] = parsed.get('branch', '')
-                            parsed['extra'] = parsed.get('extra', '')
-                            parsed['line_text'] = line
-                            parsed_transactions.append(parsed)
-                            print(f"Added transaction with ID: {parsed.get('id')}")
-                        else:
-                            print(f"Not a transaction line: {line}")
-                            non_transactions.append(line.strip())
-                    except Exception as e:
-                        print(f"Error parsing line: {line}")
-                        print(f"Error details: {str(e)}")
-                        failed_transactions.append({
-                            'line': line,
-                            'error': str(e)
-                        })
+            # The upload is already spooled in memory (see
+            # SpooledUploadRequest); the PDF engine reads it from there
+            preview = parse_statement(file.stream, current_user.id)
         except Exception as e:
             print(f"Error processing PDF: {str(e)}")
             traceback.print_exc()
             flash(f'Error processing PDF: {str(e)}')
             return redirect(url_for('expenses.index'))
-        finally:
-            # Clean up the uploaded file
-            try:
-                if os.path.exists(filepath):
-                    os.remove(filepath)
-                    print(f"Cleaned up file: {filepath}")
-            except Exception as e:
-                print(f"Error cleaning up file: {str(e)}")
 
-        return render_template('expenses.html', 
-                             parsed_transactions=parsed_transactions,
-                             failed_transactions=failed_transactions,
-                             non_transactions=non_transactions,
-                             categories=categories,
-                             preview_mode=True,
-                             total_deposits=0,
-                             total_withdrawals=0,
-                             current_balance=0)
+        return render_preview(preview)
 
     flash('Invalid file type. Please upload a PDF.')
     return redirect(url_for('expenses.index'))
 
+def render_preview(preview, job_id=None):
+    return render_template('expenses.html', 
+                         parsed_transactions=preview['parsed_transactions'],
+                         failed_transactions=preview['failed_transactions'],
+                         non_transactions=preview['non_transactions'],
+                         categories=categories,
+                         preview_mode=True,
+                         import_job_id=job_id,
+                         total_deposits=0,
+                         total_withdrawals=0,
+                         current_balance=0)
+
+@expenses_bp.route('/import_jobs', methods=['POST'])
+@login_required
+def start_import_job():
+    """Accept a statement upload and parse it in the background.
+
+    Responds 202 with the job id right away; poll ``status_url`` and open
+    ``preview_url`` once the status is ``done``.
+    """
+    file = request.files.get('file')
+    if not file or not file.filename:
+        return jsonify({'error': 'No file uploaded'}), 400
+    if not file.filename.lower().endswith('.pdf'):
+        return jsonify({'error': 'Invalid file type. Please upload a PDF.'}), 400
+
+    # The request's own stream is closed when it ends; the job closes this copy
+    job = import_jobs.submit(current_user.id, spool_upload(file), file.filename)
+    return jsonify({
+        'job_id': job['id'],
+        'status': job['status'],
+        'status_url': url_for('expenses.import_job_status', job_id=job['id']),
+        'preview_url': url_for('expenses.import_job_preview', job_id=job['id']),
+    }), 202
+
+@expenses_bp.route('/import_jobs/<string:job_id>')
+@login_required
+def import_job_status(job_id):
+    """Progress of an import job: pages done, lines parsed, failures."""
+    job = import_jobs.get(job_id, current_user.id)
+    if job is None:
+        return jsonify({'error': 'Import job not found'}), 404
+    return jsonify({key: job[key] for key in (
+        'id', 'status', 'filename', 'pages_done', 'pages_total', 'lines_parsed',
+        'failures', 'transactions', 'error', 'created_at', 'updated_at')})
+
+@expenses_bp.route('/import_jobs/<string:job_id>/preview')
+@login_required
+def import_job_preview(job_id):
+    preview = import_jobs.result(job_id, current_user.id)
+    if preview is None:
+        job = import_jobs.get(job_id, current_user.id)
+        if job is None:
+            flash('Import not found')
+        elif job['status'] == 'failed':
+            flash(f"Error processing PDF: {job['error']}")
+        else:
+            flash('The import is still being processed')
+        return redirect(url_for('expenses.index'))
+    return render_preview(preview, job_id)
+
 @expenses_bp.route('/save_transcript', methods=['POST'])
 @login_required
 def save_transcript():
@@ -168,6 +198,11 @@ def save_transcript():
             return jsonify({'error': 'Request must be JSON'}), 400
             
         parsed_transactions = request.json.get('transactions', [])
+        job_id = request.json.get('job_id')
+        if not parsed_transactions and job_id:
+            # Save a background import's preview as parsed
+            preview = import_jobs.result(job_id, current_user.id)
+            parsed_transactions = preview['parsed_transactions'] if preview else []
         print(f"Received {len(parsed_transactions)} transactions to save")
         
         if not parsed_transactions:
@@ -175,16 +210,26 @@ def save_transcript():
             return jsonify({'error': 'No transactions provided'}), 400
             
         saved_transactions = []
+        new_transactions = []
         failed_transactions = []
         
-        # Get existing transactions
+        # Get the existing transactions this import refers to
         print("Fetching existing transactions...")
-        existing_transactions = Transaction.get_user_transactions(current_user.id)
+        existing_ids = [
+            p['id'] for p in parsed_transactions
+            if p.get('id') and not str(p['id']).startswith('temp_')
+        ]
+        existing_transactions = Transaction.get_user_transactions_by_id(current_user.id, existing_ids)
         print(f"Found {len(existing_transactions)} existing transactions")
-        
-        # Convert existing transactions to dict format
-        existing_dicts = {t.id: t.__dict__ for t in existing_transactions}
-        print(f"Converted {len(existing_dicts)} transactions to dict format")
+
+        # New rows of overlapping statements that are already stored (or
+        # that repeat within this import) are skipped
+        fingerprints = {
+            i: row_fingerprint(p) for i, p in enumerate(parsed_transactions)
+            if not p.get('id') or str(p['id']).startswith('temp_')
+        }
+        stored = Transaction.find_stored_fingerprints(current_user.id, fingerprints.values())
+        skipped_duplicates = 0
         
         print("\nProcessing received transactions:")
         
@@ -195,33 +240,41 @@ def save_transcript():
                 print(f"Transaction data: {parsed}")
                 # For preview transactions or transactions with temporary IDs
                 if 'id' not in parsed or not parsed['id'] or str(parsed.get('id', '')).startswith('temp_'):
+                    fingerprint = fingerprints[i - 1]
+                    if fingerprint in stored:
+                        print("Skipping transaction that is already saved")
+                        skipped_duplicates += 1
+                        continue
+                    stored.add(fingerprint)
                     print("Creating new transaction with generated ID")
                     new_transaction = Transaction(
                         id=str(uuid.uuid4()),
                         user_id=current_user.id,
                         date_time=parsed.get('date_time', ''),
                         transaction_type=parsed.get('transaction', ''),
-                        details=parsed.get('details', ''),
+                        detail=parsed.get('details', ''),
                         withdrawal=parsed.get('withdrawal', ''),
                         deposit=parsed.get('deposit', ''),
                         balance=parsed.get('balance', ''),
                         explanation=parsed.get('explanation', ''),
-                        category_id=int(parsed['category_id']) if parsed.get('category_id') else None,
+                        category=category_name(parsed.get('category_id')),
                         branch='',
                         extra='',
                         line_text=parsed.get('line_text', '')
                     )
                     # Auto-categorize if no category was provided
-                    if not new_transaction.category_id:
+                    if not new_transaction.category:
                         new_transaction.auto_categorize()
                     saved_transactions.append(new_transaction)
+                    new_transactions.append(new_transaction)
                 else:
                     # For existing transactions, update them
-                    transaction = next((t for t in existing_transactions if t.id == parsed['id']), None)
+                    transaction = existing_transactions.get(parsed['id'])
                     if transaction:
                         transaction.explanation = parsed.get('explanation', '')
-                        category_id = parsed.get('category_id')
-                        transaction.category_id = int(category_id) if category_id else None
+                        category = category_name(parsed.get('category_id'))
+                        if category:
+                            transaction.category = category
                         transaction.updated_at = datetime.now()
                         saved_transactions.append(transaction)
             except Exception as e:
@@ -244,18 +297,25 @@ def save_transcript():
             transaction.user_id = current_user.id
             
         print("\nSaving transactions to file...")
-        Transaction.save_user_transactions(current_user.id, saved_transactions)
+        new_ids = {t.id for t in new_transactions}
+        Transaction.update_user_transactions(
+            current_user.id, [t for t in saved_transactions if t.id not in new_ids])
+        Transaction.append_user_transactions(current_user.id, new_transactions)
         print("Transactions saved successfully")
+        if job_id:
+            import_jobs.discard(job_id)
 
         if failed_transactions:
             return jsonify({
                 'message': f'Successfully imported {len(saved_transactions)} transactions. Failed to import {len(failed_transactions)} transactions.',
-                'failed_transactions': failed_transactions
+                'failed_transactions': failed_transactions,
+                'skipped_duplicates': skipped_duplicates
             }), 200
         else:
             return jsonify({
                 'message': 'All transactions imported successfully',
-                'count': len(saved_transactions)
+                'count': len(saved_transactions),
+                'skipped_duplicates': skipped_duplicates
             }), 200
             
     except Exception as e:
@@ -269,11 +329,8 @@ def save_transcript():
 @expenses_bp.route('/edit_transaction/<string:transaction_id>', methods=['GET', 'POST'])
 @login_required
 def edit_transaction(transaction_id):
-    # Get all transactions
-    transactions = Transaction.get_user_transactions(current_user.id)
-    
     # Find the transaction to edit
-    transaction = next((t for t in transactions if t.id == transaction_id), None)
+    transaction = Transaction.get_user_transaction(current_user.id, transaction_id)
     
     if not transaction or transaction.user_id != current_user.id:
         flash('You are not authorized to edit this transaction')
@@ -284,15 +341,15 @@ def edit_transaction(transaction_id):
             # Update transaction fields
             transaction.date_time = request.form['date_time']
             transaction.transaction_type = request.form['transaction_type']
-            transaction.details = request.form['details']
+            transaction.detail = request.form['details']
             transaction.withdrawal = request.form['withdrawal'] if request.form['withdrawal'] else ''
             transaction.deposit = request.form['deposit'] if request.form['deposit'] else ''
             transaction.balance = request.form['balance']
             transaction.branch = request.form['branch']
             transaction.updated_at = datetime.now()
             
-            # Save updated transactions
-            Transaction.save_user_transactions(current_user.id, transactions)
+            # Save the updated transaction
+            Transaction.update_user_transactions(current_user.id, [transaction])
             
             flash('Transaction updated successfully')
             return redirect(url_for('expenses.index'))
@@ -304,11 +361,8 @@ def edit_transaction(transaction_id):
 @expenses_bp.route('/delete_transaction/<string:transaction_id>', methods=['POST'])
 @login_required
 def delete_transaction(transaction_id):
-    # Get all transactions
-    transactions = Transaction.get_user_transactions(current_user.id)
-    
     # Find the transaction to delete
-    transaction = next((t for t in transactions if t.id == transaction_id), None)
+    transaction = Transaction.get_user_transaction(current_user.id, transaction_id)
     
     if not transaction or transaction.user_id != current_user.id:
         flash('You are not authorized to delete this transaction')
@@ -316,10 +370,7 @@ def delete_transaction(transaction_id):
     
     try:
         # Remove the transaction
-        transactions = [t for t in transactions if t.id != transaction_id]
-        
-        # Save updated transactions
-        Transaction.save_user_transactions(current_user.id, transactions)
+        Transaction.delete_user_transactions(current_user.id, [transaction_id])
         
         flash('Transaction deleted successfully')
     except Exception as e:
@@ -339,11 +390,8 @@ def add_transaction():
             description = request.form['description']
             transaction_type = request.form['type']
 
-            # Get existing transactions
-            transactions = Transaction.get_user_transactions(current_user.id)
-            
             # Calculate new balance
-            current_balance = float(transactions[-1].balance.replace(',', '')) if transactions else 0
+            current_balance = Transaction.get_user_summary(current_user.id).current_balance()
             if transaction_type == 'withdrawal':
                 new_balance = current_balance - amount
                 withdrawal = f"{amount:,.2f}"
@@ -359,21 +407,18 @@ def add_transaction():
                 user_id=current_user.id,
                 date_time=date.strftime('%d/%m/%y %H:%M'),
                 transaction_type=transaction_type,
-                details=description,
+                detail=description,
                 withdrawal=withdrawal,
                 deposit=deposit,
                 balance=f"{new_balance:,.2f}",
-                category_id=category_id,
+                category=category_name(category_id),
                 branch='',  # Optional fields
                 extra='',
                 line_text=''
             )
 
-            # Add to transactions list
-            transactions.append(new_transaction)
-            
-            # Save updated transactions
-            Transaction.save_user_transactions(current_user.id, transactions)
+            # Append only the new row to the user's file
+            new_transaction.save_user_transaction()
             
             flash('Transaction added successfully')
             return redirect(url_for('expenses.index'))
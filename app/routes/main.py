@@ -1,8 +1,6 @@
 from flask import Blueprint, render_template, jsonify, request, redirect, url_for
 from flask_login import current_user, login_required
 from flask_wtf.csrf import generate_csrf
-from datetime import datetime
-from ..models.transaction import Transaction
 from ..models.user import User
 
 main_bp = Blueprint('main', __name__)
@@ -21,21 +19,10 @@ def get_csrf_token():
 
 @main_bp.route('/')
 def index():
-    transactions = []
-    if current_user.is_authenticated:
-        # Call the correct static method (pluralized)
-        transactions = Transaction.get_user_transactions(current_user.id)
-
-        # Format datetime for rendering, but preserve datetime object if needed
-        for trans in transactions:
-            if isinstance(trans.date_time, datetime):
-                trans.formatted_date_time = trans.date_time.strftime('%d/%m/%y %H:%M')
-            else:
-                trans.formatted_date_time = trans.date_time  # Already formatted
-
+    # The dashboard only shows summary cards, so it doesn't need the
+    # user's transaction history
     return render_template(
         'index.html', 
-        transactions=transactions,
         categories=categories
     )
 
@@ -1,4 +1,3 @@
-from datetime import datetime
 from collections import defaultdict
 import requests
 from app.models.transaction import Transaction
@@ -46,35 +45,22 @@ class AnalysisService:
         return "Unable to get AI analysis at this time"
 
     @staticmethod
-    def get_monthly_spending(user_id):
-        """Calculate monthly spending totals"""
-        transactions = Transaction.get_user_transactions(user_id)
-        monthly_totals = defaultdict(float)
-        
-        for t in transactions:
-            if t.withdrawal:
-                try:
-                    date = datetime.strptime(t.date_time, '%d/%m/%y %H:%M')
-                    month_key = date.strftime('%Y-%m')
-                    monthly_totals[month_key] += float(t.withdrawal)
-                except (ValueError, TypeError):
-                    continue
-                    
-        return dict(monthly_totals)
+    def get_monthly_spending(user_id, month=None):
+        """Calculate monthly spending totals
+
+        If ``month`` (a date or datetime) is given, only that month's total
+        is returned.
+        """
+        totals = Transaction.get_user_summary(user_id).by_month('withdrawal')
+        if month is None:
+            return totals
+        key = f'{month.year:04d}-{month.month:02d}'
+        return {key: totals[key]} if key in totals else {}
 
     @staticmethod
     def get_top_categories(user_id):
         """Identify top spending categories"""
-        transactions = Transaction.get_user_transactions(user_id)
-        category_totals = defaultdict(float)
-        
-        for t in transactions:
-            if t.withdrawal and t.category_id:
-                try:
-                    category_totals[t.category_id] += float(t.withdrawal)
-                except (ValueError, TypeError):
-                    continue
-                    
+        category_totals = Transaction.get_user_summary(user_id).by_category('withdrawal')
         return dict(sorted(category_totals.items(), key=lambda x: x[1], reverse=True))
 
     @staticmethod
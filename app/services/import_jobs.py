@@ -0,0 +1,191 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from .statement_import import parse_statement
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 2
+# Finished jobs and their previews are kept this long (seconds)
+DEFAULT_TTL = 24 * 60 * 60
+# Progress is written to disk at most this often (seconds)
+PROGRESS_INTERVAL = 0.2
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+
+def _valid_id(job_id):
+    # Job ids come from URLs; never let one name another file
+    return len(job_id) == 32 and all(c in '0123456789abcdef' for c in job_id)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class ImportJobs:
+    """Runs statement imports in the background and tracks their progress.
+
+    A job extracts and parses an uploaded PDF with
+    :func:`~app.services.statement_import.parse_statement` on a small thread
+    pool (page extraction itself fans out to worker processes), so the
+    upload request returns as soon as the file is received.
+
+    Job state lives in ``<directory>/<job_id>.json`` and the finished
+    preview in ``<directory>/<job_id>.result.json``, both replaced
+    atomically, so any worker process can answer status polls and hand
+    the preview to ``save_transcript``. A job whose process died is
+    reported as failed. Jobs are removed ``ttl`` seconds after they were
+    last updated.
+    """
+
+    def __init__(self, directory='import_jobs', workers=DEFAULT_WORKERS, ttl=DEFAULT_TTL):
+        self.directory = Path(directory)
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='import')
+        self._lock = threading.Lock()
+
+    def configure(self, directory, workers, ttl):
+        with self._lock:
+            old = self._executor
+            self.directory = Path(directory)
+            self.ttl = ttl
+            self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='import')
+        # Jobs already queued there still run
+        old.shutdown(wait=False)
+
+    def submit(self, user_id, source, filename):
+        """Queue the import of an upload, which the job closes when done.
+
+        Args:
+            user_id (str): The importing user
+            source (file): Seekable binary file holding the PDF
+            filename (str): The upload's original name
+
+        Returns:
+            dict: The new job's state, including its ``id``
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._remove_expired()
+        now = time.time()
+        job = {
+            'id': uuid.uuid4().hex,
+            'user_id': str(user_id),
+            'filename': filename,
+            'status': QUEUED,
+            'pid': os.getpid(),
+            'pages_done': 0,
+            'pages_total': None,
+            'lines_parsed': 0,
+            'failures': 0,
+            'transactions': 0,
+            'error': None,
+            'created_at': now,
+            'updated_at': now,
+        }
+        self._write(self._path(job['id']), job)
+        with self._lock:
+            self._executor.submit(self._run, dict(job), source)
+        return job
+
+    def get(self, job_id, user_id=None):
+        """Return a job's state, or None if unknown (or not ``user_id``'s)."""
+        if not _valid_id(job_id):
+            return None
+        job = self._read(self._path(job_id))
+        if job is None or (user_id is not None and job['user_id'] != str(user_id)):
+            return None
+        if job['status'] in (QUEUED, RUNNING) and job['pid'] != os.getpid() and not _pid_alive(job['pid']):
+            job['status'] = FAILED
+            job['error'] = 'The import worker exited before finishing'
+        return job
+
+    def result(self, job_id, user_id=None):
+        """Return a finished job's preview (see parse_statement), or None."""
+        job = self.get(job_id, user_id)
+        if job is None or job['status'] != DONE:
+            return None
+        return self._read(self._result_path(job_id))
+
+    def discard(self, job_id):
+        """Forget a job and its preview."""
+        if not _valid_id(job_id):
+            return
+        for path in (self._path(job_id), self._result_path(job_id)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _run(self, job, source):
+        last_write = 0
+
+        def update(force=False, **changes):
+            nonlocal last_write
+            job.update(changes, updated_at=time.time())
+            if force or job['updated_at'] - last_write >= PROGRESS_INTERVAL:
+                self._write(self._path(job['id']), job)
+                last_write = job['updated_at']
+
+        try:
+            update(force=True, status=RUNNING)
+            result = parse_statement(source, job['user_id'], progress=update)
+            self._write(self._result_path(job['id']), result)
+            update(force=True, status=DONE, transactions=len(result['parsed_transactions']),
+                   failures=len(result['failed_transactions']))
+            logger.info(f"Import job {job['id']} parsed {job['transactions']} transactions "
+                        f"from {job['pages_total']} pages")
+        except Exception as e:
+            logger.exception(f"Import job {job['id']} failed")
+            update(force=True, status=FAILED, error=str(e))
+        finally:
+            source.close()
+
+    def _remove_expired(self):
+        cutoff = time.time() - self.ttl
+        for path in self.directory.glob('*.json'):
+            try:
+                if path.stat().st_mtime < cutoff:
+                    path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def _path(self, job_id):
+        return self.directory / f'{job_id}.json'
+
+    def _result_path(self, job_id):
+        return self.directory / f'{job_id}.result.json'
+
+    def _read(self, path):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _write(self, path, data):
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+
+import_jobs = ImportJobs()
@@ -0,0 +1,241 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from pathlib import Path
+
+from ..utils.dates import DATE_TIME_FORMATS
+from ..utils.file_lock import file_lock
+from ..utils.money import to_satang
+
+logger = logging.getLogger(__name__)
+
+# First line of every fingerprint file; files with another are rebuilt
+FINGERPRINT_VERSION = 'v1'
+
+# Users whose fingerprints are kept in memory
+USER_ENTRIES = 64
+
+# Rewrite a file once it holds at least this many removal lines and no
+# fewer removals than live fingerprints
+COMPACT_MIN_DEAD = 256
+
+
+def _date_key(value):
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M')
+    value = ' '.join(str(value or '').split())
+    for _, parse in DATE_TIME_FORMATS:
+        try:
+            return parse(value).strftime('%Y-%m-%d %H:%M')
+        except ValueError:
+            pass
+    # Kept as written rather than defaulted, so it still only matches itself
+    return value
+
+
+def _fingerprint(date_time, withdrawal, deposit, balance, detail):
+    key = '\x1f'.join((_date_key(date_time), str(withdrawal), str(deposit), str(balance),
+                       ' '.join((detail or '').lower().split())))
+    return hashlib.blake2b(key.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def row_fingerprint(row):
+    """Fingerprint of a preview row (see parse_statement) or a posted one.
+
+    Built from the date and time, the withdrawal, deposit and balance in
+    satang, and the detail with case and spacing folded, so the same
+    statement line matches however it was extracted or formatted.
+    """
+    return _fingerprint(row.get('date_time'), to_satang(row.get('withdrawal')), to_satang(row.get('deposit')),
+                        to_satang(row.get('balance')), row.get('details'))
+
+
+def transaction_fingerprint(transaction):
+    """Fingerprint of a stored Transaction, comparable with row_fingerprint."""
+    return _fingerprint(transaction.date_time, transaction.withdrawal_satang, transaction.deposit_satang,
+                        transaction.balance_satang, transaction.detail)
+
+
+class _UserFingerprints:
+    def __init__(self, path):
+        self.path = path
+        self._reset(None)
+
+    def _reset(self, inode):
+        self.inode = inode
+        # fingerprint -> number of stored rows with it
+        self.counts = {}
+        self.total = 0
+        # Removal lines in the file
+        self.dead = 0
+        # File bytes applied to counts
+        self.covered = 0
+
+    def apply(self, line):
+        op, fingerprint = line[0], line[1:]
+        if op == '+':
+            self.counts[fingerprint] = self.counts.get(fingerprint, 0) + 1
+            self.total += 1
+        elif self.counts.get(fingerprint):
+            self.counts[fingerprint] -= 1
+            if not self.counts[fingerprint]:
+                del self.counts[fingerprint]
+            self.total -= 1
+            self.dead += 1
+
+    def refresh(self):
+        """Apply lines other writers appended since the last refresh."""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            self._reset(None)
+            return
+        if stat.st_ino != self.inode or stat.st_size < self.covered:
+            self._reset(stat.st_ino)
+        if stat.st_size == self.covered:
+            return
+        with open(self.path, 'rb') as f:
+            if not self.covered:
+                if f.readline().decode('ascii', 'replace').strip() != FINGERPRINT_VERSION:
+                    # Another version: left empty, so the next check rebuilds it
+                    return
+                self.covered = f.tell()
+            f.seek(self.covered)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # Still being written; picked up by a later refresh
+                    break
+                self.apply(line.decode('ascii').rstrip('\n'))
+                self.covered += len(line)
+
+
+class RowFingerprints:
+    """Per-user multiset of the fingerprints of stored transactions.
+
+    Statements overlap from month to month, so imports check each new row
+    against this set instead of against the user's history. Membership is a
+    dict lookup; the set is kept current by Transaction's write methods
+    (appends add fingerprints, deletes remove them, full saves replace them).
+
+    Each user's set is persisted as ``<directory>/<user_id>.fp``: a version
+    line, then one ``+<fingerprint>`` or ``-<fingerprint>`` line per change.
+    Appends hold a shared ``flock`` on ``<user_id>.lock`` and rewrites an
+    exclusive one; every process applies only the lines appended since it
+    last looked, and reloads a file that was replaced. Files are compacted
+    once removals pile up.
+
+    The set can't see writes that bypass Transaction, or a crash between a
+    store write and the set's, so :meth:`known` compares its size with the
+    store's row count and rebuilds it from the stored rows when they differ.
+    """
+
+    def __init__(self, directory='row_fingerprints'):
+        self.directory = Path(directory)
+        self.rebuilds = 0
+        # user_id -> _UserFingerprints, least recently used first
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+
+    def configure(self, directory):
+        with self._lock:
+            self.directory = Path(directory)
+            self._users.clear()
+
+    def known(self, user_id, fingerprints, count, transactions):
+        """Return which of ``fingerprints`` belong to stored transactions.
+
+        Args:
+            user_id (str): The ID of the user
+            fingerprints (Iterable[str]): Fingerprints to look up
+            count (int): Number of transactions the store holds for the user
+            transactions (callable): Returns the user's stored transactions,
+                called only if the set has to be rebuilt
+
+        Returns:
+            set[str]: The fingerprints already stored
+        """
+        with self._lock:
+            user = self._user(user_id)
+            user.refresh()
+            if user.total != count:
+                logger.info(f"Rebuilding row fingerprints of user {user_id}: "
+                            f"{user.total} fingerprints for {count} transactions")
+                self._rewrite(user_id, user, [transaction_fingerprint(t) for t in transactions()])
+                self.rebuilds += 1
+            return {fingerprint for fingerprint in fingerprints if fingerprint in user.counts}
+
+    def add(self, user_id, fingerprints):
+        """Record fingerprints of newly stored transactions."""
+        self._append(user_id, [f'+{fingerprint}\n' for fingerprint in fingerprints])
+
+    def remove(self, user_id, fingerprints):
+        """Forget fingerprints of deleted (or edited) transactions."""
+        self._append(user_id, [f'-{fingerprint}\n' for fingerprint in fingerprints])
+        with self._lock:
+            user = self._user(user_id)
+            if user.dead >= COMPACT_MIN_DEAD and user.dead >= user.total:
+                logger.info(f"Compacting row fingerprints of user {user_id}: "
+                            f"{user.total} live, {user.dead} removed")
+                self._rewrite(user_id, user, [fingerprint for fingerprint, n in user.counts.items()
+                                              for _ in range(n)])
+
+    def replace(self, user_id, fingerprints):
+        """Replace a user's whole set, e.g. after all transactions were saved."""
+        with self._lock:
+            self._rewrite(user_id, self._user(user_id), list(fingerprints))
+
+    def _append(self, user_id, lines):
+        if not lines:
+            return
+        with self._lock:
+            user = self._user(user_id)
+            self.directory.mkdir(parents=True, exist_ok=True)
+            # Appends share the lock; creating the file (and its version
+            # line) needs it exclusively
+            new_file = not user.path.exists()
+            with file_lock(self._lock_path(user_id), shared=not new_file):
+                with open(user.path, 'a', encoding='ascii') as f:
+                    if f.tell() == 0:
+                        f.write(FINGERPRINT_VERSION + '\n')
+                    f.write(''.join(lines))
+            user.refresh()
+
+    def _rewrite(self, user_id, user, fingerprints):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=f'.{user.path.name}.')
+        try:
+            with os.fdopen(fd, 'w', encoding='ascii') as f:
+                f.write(FINGERPRINT_VERSION + '\n')
+                f.write(''.join(f'+{fingerprint}\n' for fingerprint in fingerprints))
+            with file_lock(self._lock_path(user_id)):
+                os.replace(tmp_path, user.path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        user.refresh()
+
+    def _user(self, user_id):
+        # The caller holds self._lock
+        user = self._users.get(user_id)
+        if user is None:
+            user = self._users[user_id] = _UserFingerprints(self.directory / f'{user_id}.fp')
+        self._users.move_to_end(user_id)
+        while len(self._users) > USER_ENTRIES:
+            self._users.popitem(last=False)
+        return user
+
+    def _lock_path(self, user_id):
+        return self.directory / f'{user_id}.lock'
+
+    def stats(self):
+        with self._lock:
+            return {'users': len(self._users), 'rebuilds': self.rebuilds,
+                    'fingerprints': sum(user.total for user in self._users.values())}
+
+
+row_fingerprints = RowFingerprints()
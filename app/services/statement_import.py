@@ -0,0 +1,111 @@
+import logging
+
+from ..models.transaction import Transaction
+from ..utils.pdf_imports import page_extractor
+from ..utils.pdf_parser import PARSER_VERSION, parse_lines
+from ..utils.statement_cache import content_key, statement_cache
+from ..utils.statement_columns import read_page_columns
+from .row_fingerprints import row_fingerprint
+
+logger = logging.getLogger(__name__)
+
+# How pages are read: 'text' scans each page's extracted text, 'words' maps
+# each word to a column by its position (see statement_columns)
+EXTRACT_MODES = ('text', 'words')
+extract_mode = 'text'
+
+
+def configure(mode):
+    """Choose how statement pages are read, one of EXTRACT_MODES."""
+    global extract_mode
+    if mode not in EXTRACT_MODES:
+        raise ValueError(f"Unknown statement extract mode {mode!r}; expected one of {EXTRACT_MODES}")
+    extract_mode = mode
+
+
+def parse_statement(source, user_id, progress=None):
+    """Extract and parse every transaction line of a statement PDF.
+
+    Args:
+        source (str | Path | file): Path of the PDF, or a seekable binary
+            file such as a spooled upload
+        user_id (str): The user the preview rows are for
+        progress (callable): Called with keyword arguments ``pages_done``,
+            ``pages_total``, ``lines_parsed`` and ``failures`` as work
+            advances
+
+    Returns:
+        dict: ``parsed_transactions`` (preview rows), ``failed_transactions``
+        (``{'line', 'error'}``) and ``non_transactions`` (lines that aren't
+        transactions). Rows the user already has, or that repeat an earlier
+        row of the statement, have ``duplicate`` set
+    """
+    preview = read_statement(source, progress)
+    fingerprints = [row_fingerprint(parsed) for parsed in preview['parsed_transactions']]
+    seen = Transaction.find_stored_fingerprints(user_id, fingerprints)
+    for parsed, fingerprint in zip(preview['parsed_transactions'], fingerprints):
+        parsed['user_id'] = user_id
+        parsed['duplicate'] = fingerprint in seen
+        seen.add(fingerprint)
+    return preview
+
+
+def read_statement(source, progress=None):
+    """Like parse_statement, but with rows not tied to a user.
+
+    Results are cached by the PDF's content, PARSER_VERSION and the extract
+    mode, so a statement seen before is returned without opening it.
+    """
+    key = content_key(source, f'{PARSER_VERSION}-{extract_mode}')
+    preview = statement_cache.get(key)
+    if preview is not None:
+        logger.info(f"Statement {key} found in the cache")
+        if progress is not None:
+            progress(pages_done=preview['pages'], pages_total=preview['pages'],
+                     lines_parsed=preview['lines'], failures=len(preview['failed_transactions']))
+    else:
+        preview = _parse(source, key, progress or (lambda **counts: None))
+        statement_cache.put(key, preview)
+    return preview
+
+
+def _count_parsed(texts):
+    # How PDF engines are compared: transactions the parser finds in their text
+    return sum(len(parse_lines(text.split('\n'))['parsed_transactions']) for text in texts)
+
+
+def _parse(source, key, report):
+    def pages_done(done, total):
+        report(pages_done=done, pages_total=total)
+
+    if extract_mode == 'words':
+        pages = page_extractor.extract_pages(source, progress=pages_done, reader=read_page_columns)
+    else:
+        texts = page_extractor.extract_pages(source, progress=pages_done, score=_count_parsed)
+        pages = [dict(parse_lines(text.split('\n')), lines=text.count('\n') + 1) for text in texts]
+    if not any(page['parsed_transactions'] or any(page['non_transactions']) for page in pages):
+        logger.warning(f"No text could be extracted from statement {key}")
+
+    parsed_transactions = []
+    failed_transactions = []
+    non_transactions = []
+    lines_parsed = 0
+    for page in pages:
+        for parsed in page['parsed_transactions']:
+            # Ensure all required fields are present
+            parsed['explanation'] = ''
+            parsed['category_id'] = None
+            parsed['transaction_type'] = parsed['transaction']
+        parsed_transactions += page['parsed_transactions']
+        failed_transactions += page['failed_transactions']
+        non_transactions += page['non_transactions']
+        lines_parsed += page['lines']
+        report(lines_parsed=lines_parsed, failures=len(failed_transactions))
+
+    return {
+        'parsed_transactions': parsed_transactions,
+        'failed_transactions': failed_transactions,
+        'non_transactions': non_transactions,
+        'pages': len(pages),
+        'lines': lines_parsed,
+    }
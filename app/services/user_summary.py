@@ -0,0 +1,189 @@
+from datetime import datetime
+
+from ..utils.dates import parse_date_time
+
+COLUMNS = ('withdrawal', 'deposit')
+
+
+def _date_time(value):
+    # Rows being written may still hold the date as entered ('dd/mm/yy HH:MM')
+    if isinstance(value, str) and value:
+        return parse_date_time(value)
+    return value
+
+
+def _month(value):
+    value = _date_time(value)
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m')
+    return '1970-01'
+
+
+def latest_key(transaction):
+    """Sort key of the current-balance rule: latest date_time, then id."""
+    value = _date_time(transaction.date_time)
+    return [value.isoformat() if isinstance(value, datetime) else '', transaction.id]
+
+
+def _category(transaction):
+    if transaction.category:
+        return transaction.category
+    # auto_categorize sets the category on the object, so work on a copy
+    return transaction.__copy__().auto_categorize().category
+
+
+class UserSummary:
+    """Running totals of a user's transactions, maintained by deltas.
+
+    Holds the row count, deposit and withdrawal totals, the current balance
+    and per-month / per-category totals, all in satang. :meth:`add` and
+    :meth:`remove` apply one transaction in O(1), so a store can keep the
+    summary current as rows are created, edited and deleted instead of
+    re-aggregating the whole history. Read methods return baht.
+
+    The current balance is the balance of the latest transaction by
+    date_time, ties going to the greater id, whatever order rows are stored
+    in; ``latest`` holds that row's :func:`latest_key` (``[]`` when there
+    are no rows). Removing the latest row leaves ``latest`` as None, as
+    nothing here says which row is latest now; the store looks it up and
+    calls :meth:`set_latest`.
+    """
+
+    def __init__(self, count=0, withdrawals=0, deposits=0, balance=0, latest=(),
+                 months=None, categories=None):
+        self.count = count
+        self.withdrawals = withdrawals
+        self.deposits = deposits
+        self.balance = balance
+        self.latest = list(latest) if latest is not None else None
+        # key -> [withdrawal satang, deposit satang]
+        self.months = months if months is not None else {}
+        self.categories = categories if categories is not None else {}
+
+    @classmethod
+    def from_transactions(cls, transactions):
+        """Summarize transactions."""
+        summary = cls()
+        for t in transactions:
+            summary.add(t)
+        return summary
+
+    def add(self, transaction):
+        """Count a transaction."""
+        self._apply(transaction, 1)
+        key = latest_key(transaction)
+        if self.latest is not None and key >= self.latest:
+            self.set_latest(key, transaction.balance_satang)
+
+    def remove(self, transaction):
+        """Uncount a transaction previously added."""
+        self._apply(transaction, -1)
+        if not self.count:
+            self.set_latest([], 0)
+        elif latest_key(transaction) == self.latest:
+            self.latest = None
+
+    def replace(self, old, new):
+        """Count an edit of ``old`` into ``new``.
+
+        Editing the latest row without moving it earlier keeps it latest, so
+        the store need not look for another.
+        """
+        latest = self.latest
+        self.remove(old)
+        self.add(new)
+        key = latest_key(new)
+        if self.latest is None and latest == latest_key(old) and key >= latest:
+            self.set_latest(key, new.balance_satang)
+
+    def extend(self, other):
+        """Add the totals of another summary of different rows, and return self."""
+        if self.latest is None or other.latest is None:
+            self.latest = None
+        elif other.latest > self.latest:
+            self.set_latest(other.latest, other.balance)
+        self.count += other.count
+        self.withdrawals += other.withdrawals
+        self.deposits += other.deposits
+        for totals, more in ((self.months, other.months), (self.categories, other.categories)):
+            for key, (withdrawal, deposit) in more.items():
+                entry = totals.setdefault(key, [0, 0])
+                entry[0] += withdrawal
+                entry[1] += deposit
+                if entry == [0, 0]:
+                    del totals[key]
+        return self
+
+    def set_latest(self, key, balance):
+        """Make the row with :func:`latest_key` ``key`` the latest one."""
+        self.latest = list(key)
+        self.balance = balance
+
+    def _apply(self, transaction, sign):
+        withdrawal = transaction.withdrawal_satang * sign
+        deposit = transaction.deposit_satang * sign
+        self.count += sign
+        self.withdrawals += withdrawal
+        self.deposits += deposit
+        for totals, key in ((self.months, _month(transaction.date_time)),
+                            (self.categories, _category(transaction))):
+            entry = totals.setdefault(key, [0, 0])
+            entry[0] += withdrawal
+            entry[1] += deposit
+            if entry == [0, 0]:
+                del totals[key]
+
+    def __len__(self):
+        return self.count
+
+    def total_deposits(self):
+        """Sum of all deposits in baht."""
+        return self.deposits / 100
+
+    def total_withdrawals(self):
+        """Sum of all withdrawals in baht."""
+        return self.withdrawals / 100
+
+    def current_balance(self):
+        """Balance recorded on the last transaction, in baht."""
+        return self.balance / 100 if self.count else 0
+
+    def by_category(self, column='withdrawal'):
+        """Total of an amount column per category, in baht.
+
+        Categories with no amount are left out.
+        """
+        return self._totals(self.categories, column)
+
+    def by_month(self, column='withdrawal'):
+        """Total of an amount column per ``YYYY-MM`` month, in baht."""
+        return dict(sorted(self._totals(self.months, column).items()))
+
+    def _totals(self, totals, column):
+        if column not in COLUMNS:
+            raise ValueError(f"Unknown amount column: {column}")
+        i = COLUMNS.index(column)
+        return {key: entry[i] / 100 for key, entry in totals.items() if entry[i]}
+
+    def copy(self):
+        return UserSummary.from_dict(self.to_dict())
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'withdrawals': self.withdrawals,
+            'deposits': self.deposits,
+            'balance': self.balance,
+            'latest': self.latest,
+            'months': {key: list(entry) for key, entry in self.months.items()},
+            'categories': {key: list(entry) for key, entry in self.categories.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        data = dict(data)
+        # Summaries saved under the old stored-last rule don't say which
+        # row is latest
+        if data.pop('last_row', None) is not None:
+            data['latest'] = None
+        return cls(**data)
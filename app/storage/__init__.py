@@ -0,0 +1,61 @@
+"""Pluggable storage backends for user transactions.
+
+Every backend implements the same small interface used by
+:class:`app.models.transaction.Transaction`: ``load``, ``iter``, ``page``,
+``get_many``, ``save_all``, ``modify``, ``append``, ``update``, ``delete``
+and ``summary``.
+"""
+import base64
+from datetime import datetime
+
+
+class ConcurrentUpdateError(RuntimeError):
+    """Raised when a write loses a race with another writer and is not applied."""
+
+
+def encode_cursor(date_time, transaction_id):
+    """Encode a (date_time, id) page position as an opaque URL-safe string."""
+    raw = f"{date_time.isoformat()}|{transaction_id}".encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Decode a cursor made by encode_cursor.
+
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        date_time, transaction_id = raw.split('|', 1)
+        return datetime.fromisoformat(date_time), transaction_id
+    except (UnicodeError, TypeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+def create_store(name, model, app=None):
+    """Create the transaction store named by ``TRANSACTION_BACKEND``.
+
+    Args:
+        name (str): ``'csv'``, ``'partitioned'`` or ``'sqlite'``
+        model (type): The Transaction class rows are loaded into
+        app (Flask): The app, required by database-backed stores
+
+    Returns:
+        A transaction store instance
+
+    Raises:
+        ValueError: If the backend name is unknown
+    """
+    if name == 'csv':
+        from .csv_backend import CsvTransactionStore
+        snapshots = app is not None and app.config.get('TRANSACTION_SNAPSHOTS', False)
+        return CsvTransactionStore(model, snapshots=snapshots)
+    if name == 'partitioned':
+        from .partitioned_backend import PartitionedTransactionStore
+        compress_after = app.config.get('TRANSACTION_COMPRESS_AFTER_MONTHS') if app is not None else None
+        return PartitionedTransactionStore(model, compress_after=compress_after)
+    if name == 'sqlite':
+        from .sqlite_backend import SqliteTransactionStore
+        return SqliteTransactionStore(model, app)
+    raise ValueError(f"Unknown transaction backend: {name}")
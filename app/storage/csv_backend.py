@@ -0,0 +1,602 @@
+import bisect
+import contextlib
+import csv
+import itertools
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from operator import itemgetter
+from pathlib import Path
+
+import numpy as np
+
+from ..utils.csv_appender import CsvAppender
+from ..utils.file_lock import file_lock, read_generation, rewriting
+from ..utils.dates import DATE_TIME_FORMATS, DateColumnParser, parse_date_time, parse_timestamp
+from ..utils.transaction_cache import transaction_cache, file_signature
+from . import ConcurrentUpdateError
+from .row_index import TOMBSTONE, RowIndex, iter_records, parse_record, read_record
+from .rows import RowParser, in_range
+from .snapshot import Snapshot, to_micros, write_snapshot
+
+logger = logging.getLogger(__name__)
+
+# Users whose page index / row index / mapped snapshot is kept in memory
+PAGE_INDEX_ENTRIES = 256
+ROW_INDEX_ENTRIES = 256
+SNAPSHOT_ENTRIES = 256
+
+# A full read rewrites the binary snapshot once this many rows had to be
+# parsed from the CSV past it, or this many of its rows are no longer live
+SNAPSHOT_MAX_STALE = 64
+
+# Rewrite a file once it holds at least this many dead records (superseded
+# versions and tombstones) and no fewer dead records than live rows
+COMPACT_MIN_DEAD = 256
+
+# Attempts at a read-modify-write before giving up on concurrent writers,
+# with a random backoff of up to RETRY_BACKOFF * 2**attempt seconds
+WRITE_RETRIES = 8
+RETRY_BACKOFF = 0.005
+
+
+class CsvTransactionStore:
+    """Stores each user's transactions in ``<directory>/<user_id>.csv``.
+
+    Whole-history reads are served from the in-process transaction cache.
+    Edits and deletes append a new row version or a tombstone instead of
+    rewriting the file, and a :class:`RowIndex` kept next to it maps each id
+    to its live row, so point reads, edits and deletes cost I/O proportional
+    to the rows they touch. Files are compacted once dead records pile up.
+    The same index keeps each user's :class:`UserSummary` current, so
+    totals and rollups never re-read the history.
+
+    Several processes may share the directory. Readers take no locks: a
+    file is only ever appended to, or replaced whole by renaming a fully
+    written temp file over it, so an open handle always sees a consistent
+    version, and reads stop at the last record the row index had seen.
+    Appenders hold a shared ``flock`` on ``<user_id>.lock`` (O_APPEND keeps
+    their records whole) and rewrites an exclusive one, bumping the
+    generation counter kept in that file; sidecar files (row index,
+    summary, snapshot) record the inode and generation they were built for,
+    so a replaced file is never mistaken for the old one even if the
+    filesystem reuses its inode. Read-modify-write
+    cycles go through :meth:`modify`, which checks the file version before
+    publishing and retries if another writer got there first.
+
+    With ``snapshots`` on, live rows are also kept in a binary, memory-mapped
+    :class:`Snapshot` (``<user_id>.bin``) that reads serve rows from without
+    parsing CSV; only records appended since it was written are parsed. The
+    CSV stays the source of truth: the snapshot is tied to the CSV's inode
+    and generation, ignored when they don't match and rewritten by the next full read once
+    it falls behind.
+    """
+
+    name = 'csv'
+
+    def __init__(self, model, directory='user_transactions', snapshots=False):
+        self.model = model
+        self.directory = Path(directory)
+        self.snapshots = snapshots
+        self._appender = CsvAppender(model.FIELDNAMES)
+        # Date values that missed their column's detected format, over all reads
+        self.date_fallbacks = 0
+        # path -> (signature, whether rows were in date order)
+        self._sorted = {}
+        # path -> _PageIndex, least recently used first
+        self._page_indexes = OrderedDict()
+        self._page_indexes_lock = threading.Lock()
+        # path -> RowIndex, least recently used first
+        self._row_indexes = OrderedDict()
+        self._row_indexes_lock = threading.Lock()
+        # path -> Snapshot, least recently used first
+        self._snapshots = OrderedDict()
+        self._snapshots_lock = threading.Lock()
+
+    def path(self, user_id):
+        return self.directory / f'{user_id}.csv'
+
+    def load(self, user_id, start=None, end=None):
+        file_path = self.path(user_id)
+        signature = file_signature(file_path)
+        if signature is None:
+            return []
+
+        if start is not None or end is not None:
+            return list(self.iter(user_id, start=start, end=end))
+
+        transactions = transaction_cache.get(user_id, signature)
+        if transactions is None:
+            transactions = self._read(file_path, signature)
+            transaction_cache.put(user_id, signature, transactions)
+        return transactions
+
+    def iter(self, user_id, start=None, end=None, categories=None):
+        file_path = self.path(user_id)
+        signature = file_signature(file_path)
+        if signature is None:
+            return
+        if categories is not None:
+            categories = set(categories)
+
+        cached = transaction_cache.peek(user_id, signature)
+        if cached is not None:
+            for t in cached:
+                if in_range(t.date_time, start, end) and (categories is None or t.category in categories):
+                    yield t.__copy__()
+            return
+
+        # Only trust date order for early exit if a full pass over this exact
+        # file version has confirmed it
+        stop_at_end = end is not None and self._sorted.get(file_path) == (signature, True)
+        with self._open(file_path, _live_state) as opened:
+            if opened is None:
+                return
+            f, generation, (header, live, covered) = opened
+            snapshot = self._snapshot(file_path, f, generation, covered)
+            tail_start = None
+            if snapshot is not None:
+                # Rows in the snapshot are filtered on its columns and only
+                # the matches are built; the rest of the file is streamed
+                yield from self._snapshot_rows(snapshot, live, start, end, categories)
+                tail_start = snapshot.covered
+                stop_at_end = False
+            rows = RowParser(csv.DictReader(_live_lines(f, live, covered, start=tail_start),
+                                             fieldnames=header))
+            previous = None
+            in_order = True
+            for row in rows:
+                date_time = rows.date_time.parse(row['date_time'])
+                if previous is not None and date_time < previous:
+                    in_order = False
+                previous = date_time
+                if end is not None and date_time >= end:
+                    if stop_at_end:
+                        return
+                    continue
+                if start is not None and date_time < start:
+                    continue
+                if categories is not None and (row['category'] or None) not in categories:
+                    continue
+                row['date_time'] = date_time
+                rows.parse_timestamps(row)
+                yield self.model(**row)
+        if tail_start is None:
+            self._sorted[file_path] = (signature, in_order)
+        self._count_fallbacks(file_path, rows)
+
+    def _snapshot_rows(self, snapshot, live, start, end, categories):
+        indices = snapshot.live_indices(live)
+        if start is not None or end is not None:
+            dates = snapshot.columns['date_time'][indices]
+            mask = np.ones(len(indices), dtype=bool)
+            if start is not None:
+                mask &= dates >= to_micros(start)
+            if end is not None:
+                mask &= dates < to_micros(end)
+            indices = indices[mask]
+        transactions = snapshot.transactions(indices, self.model)
+        if categories is not None:
+            transactions = [t for t in transactions if t.category in categories]
+        return transactions
+
+    def page(self, user_id, after=None, limit=50):
+        """Yield up to ``limit`` transactions, newest first.
+
+        Ordering is by (date_time, id); ``after`` is the key of the last
+        transaction of the previous page. Only the rows on the page are read
+        and parsed, found through an offset index over the user's file.
+        """
+        file_path = self.path(user_id)
+        with self._open(file_path, _live_state) as opened:
+            if opened is None:
+                return
+            f, generation, (header, live, covered) = opened
+            snapshot = self._snapshot(file_path, f, generation, covered)
+            index = self._page_index(file_path, f, generation, header, live, covered, snapshot)
+            stop = len(index.keys) if after is None else bisect.bisect_left(index.keys, after)
+            offsets = index.offsets[max(0, stop - limit):stop]
+            for offset in reversed(offsets):
+                yield self._read_at(f, header, offset, snapshot)
+
+    def _page_index(self, file_path, f, generation, header, live, covered, snapshot):
+        # Inode, generation and indexed length identify one version of the file
+        version = (os.fstat(f.fileno()).st_ino, generation, covered)
+        with self._page_indexes_lock:
+            index = self._page_indexes.get(file_path)
+            if index is not None and index.signature == version:
+                self._page_indexes.move_to_end(file_path)
+                return index
+
+        index = _PageIndex.build(f, version, header, live, covered, snapshot)
+        with self._page_indexes_lock:
+            self._page_indexes[file_path] = index
+            self._page_indexes.move_to_end(file_path)
+            while len(self._page_indexes) > PAGE_INDEX_ENTRIES:
+                self._page_indexes.popitem(last=False)
+        return index
+
+    def summary(self, user_id):
+        file_path = self.path(user_id)
+        index = self._row_index(file_path)
+        with index.lock:
+            self._refresh(file_path, index)
+            return index.get_summary()
+
+    def get_many(self, user_id, ids):
+        ids = set(ids)
+
+        def state(index):
+            return index.header, sorted((offset, id_) for id_ in ids
+                                        if (offset := index.offset(id_)) is not None)
+
+        file_path = self.path(user_id)
+        with self._open(file_path, state) as opened:
+            if opened is None:
+                return {}
+            f, generation, (header, offsets) = opened
+            snapshot = self._snapshot(file_path, f, generation) if offsets else None
+            return {id_: self._read_at(f, header, offset, snapshot) for offset, id_ in offsets}
+
+    def version(self, user_id):
+        """Opaque token that changes whenever the user's file does."""
+        return file_signature(self.path(user_id)) or ()
+
+    def save_all(self, user_id, transactions, if_version=None):
+        """Replace all of a user's transactions.
+
+        The new file is written in full next to the old one and renamed over
+        it, so readers see either the old or the new version, never a mix.
+
+        Args:
+            if_version: Only publish if :meth:`version` still returns this
+
+        Raises:
+            ConcurrentUpdateError: If ``if_version`` no longer matches
+            ValueError: If a transaction has the reserved TOMBSTONE type
+        """
+        rows = _rows(transactions)
+        file_path = self.path(user_id)
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=file_path.parent, prefix=f'.{file_path.name}.')
+        try:
+            with os.fdopen(fd, 'w', newline='', encoding='utf-8') as f:
+                writer = csv.DictWriter(f, fieldnames=self.model.FIELDNAMES)
+                writer.writeheader()
+                writer.writerows(rows)
+                f.flush()
+                os.fsync(f.fileno())
+            with rewriting(self._lock_path(file_path)):
+                if if_version is not None and self.version(user_id) != if_version:
+                    raise ConcurrentUpdateError(f"{file_path} changed since it was read")
+                os.replace(tmp_path, file_path)
+                # Readers wait while the generation is odd, so the old index
+                # and snapshot are gone before anyone looks for the new file's
+                index = self._row_index(file_path)
+                with index.lock:
+                    index.remove()
+                self._drop_snapshot(file_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        finally:
+            transaction_cache.invalidate(user_id)
+
+    def modify(self, user_id, change):
+        """Read-modify-write a user's transactions with optimistic retries.
+
+        ``change`` gets the current list and returns the new one. If another
+        writer changes the file between the read and the write, the write is
+        abandoned and ``change`` runs again on fresh data.
+
+        Raises:
+            ConcurrentUpdateError: If every attempt lost a race
+        """
+        for attempt in range(WRITE_RETRIES):
+            version = self.version(user_id)
+            transactions = change(self.load(user_id))
+            try:
+                self.save_all(user_id, transactions, if_version=version)
+                return transactions
+            except ConcurrentUpdateError:
+                logger.info(f"Lost update on user {user_id}'s transactions, retrying ({attempt + 1})")
+                time.sleep(random.uniform(0, RETRY_BACKOFF * 2 ** attempt))
+        raise ConcurrentUpdateError(
+            f"Gave up updating user {user_id}'s transactions after {WRITE_RETRIES} attempts")
+
+    def append(self, user_id, transactions):
+        self._append_rows(self.path(user_id), _rows(transactions))
+        transaction_cache.invalidate(user_id)
+
+    def _append_rows(self, file_path, rows):
+        # Appends share the lock so they don't block each other; creating
+        # the file (and its header) needs it exclusively
+        new_file = not file_path.exists() or file_path.stat().st_size == 0
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        with file_lock(self._lock_path(file_path), shared=not new_file):
+            self._appender.append(file_path, rows)
+
+    def _lock_path(self, file_path):
+        return file_path.with_suffix('.lock')
+
+    def update(self, user_id, transactions):
+        """Append new versions of existing transactions; unknown ids are ignored."""
+        rows = _rows(transactions)
+        file_path = self.path(user_id)
+        index = self._row_index(file_path)
+        with index.lock:
+            self._refresh(file_path, index)
+            rows = [row for row in rows if row['id'] in index]
+        if rows:
+            self._append_rows(file_path, rows)
+            transaction_cache.invalidate(user_id)
+            self._maybe_compact(user_id)
+
+    def delete(self, user_id, ids):
+        """Append a tombstone for each existing id and return how many there were."""
+        file_path = self.path(user_id)
+        index = self._row_index(file_path)
+        with index.lock:
+            self._refresh(file_path, index)
+            ids = [id_ for id_ in dict.fromkeys(ids) if id_ in index]
+        if not ids:
+            return 0
+        now = datetime.now()
+        self._append_rows(file_path, [
+            {'id': id_, 'user_id': user_id, 'transaction_type': TOMBSTONE,
+             'created_at': now, 'updated_at': now}
+            for id_ in ids
+        ])
+        transaction_cache.invalidate(user_id)
+        self._maybe_compact(user_id)
+        return len(ids)
+
+    def _maybe_compact(self, user_id):
+        file_path = self.path(user_id)
+        index = self._row_index(file_path)
+        with index.lock:
+            self._refresh(file_path, index)
+            dead, live = index.dead, len(index)
+        if dead >= COMPACT_MIN_DEAD and dead >= live:
+            logger.info(f"Compacting {file_path}: {live} live rows, {dead} dead records")
+            try:
+                self.modify(user_id, lambda transactions: transactions)
+            except ConcurrentUpdateError as e:
+                # The write that triggered compaction already succeeded;
+                # a later one will try again
+                logger.warning(f"Skipped compacting {file_path}: {e}")
+
+    def _row_index(self, file_path):
+        with self._row_indexes_lock:
+            index = self._row_indexes.get(file_path)
+            if index is None:
+                index = self._row_indexes[file_path] = RowIndex(file_path, self.model)
+            self._row_indexes.move_to_end(file_path)
+            while len(self._row_indexes) > ROW_INDEX_ENTRIES:
+                self._row_indexes.popitem(last=False)
+            return index
+
+    def _refresh(self, file_path, index):
+        """Refresh ``index`` against a generation no rewrite changed meanwhile.
+
+        The caller holds ``index.lock``.
+
+        Raises:
+            ConcurrentUpdateError: If the file kept being rewritten
+        """
+        lock_path = self._lock_path(file_path)
+        for attempt in range(WRITE_RETRIES):
+            generation = read_generation(lock_path)
+            if generation is not None:
+                index.refresh(generation)
+                if read_generation(lock_path) == generation:
+                    return index
+            time.sleep(random.uniform(0, RETRY_BACKOFF * 2 ** attempt))
+        raise ConcurrentUpdateError(f"{file_path} kept being rewritten while indexing it")
+
+    @contextlib.contextmanager
+    def _open(self, file_path, state):
+        """Open a user's file for reading, with ``state(index)`` taken from
+        its row index for the same version of the file.
+
+        Yields ``(f, generation, state)``, or None if the file doesn't exist. No file
+        lock is taken; if the file is replaced between opening it and
+        reading the index, both are tried again.
+        """
+        index = self._row_index(file_path)
+        for _ in range(WRITE_RETRIES):
+            try:
+                f = open(file_path, 'rb')
+            except FileNotFoundError:
+                yield None
+                return
+            with f:
+                inode = os.fstat(f.fileno()).st_ino
+                with index.lock:
+                    self._refresh(file_path, index)
+                    current = index.inode == inode
+                    generation = index.generation
+                    result = state(index) if current else None
+                if current:
+                    yield f, generation, result
+                    return
+        raise ConcurrentUpdateError(f"{file_path} kept being replaced while opening it")
+
+    def _snapshot(self, file_path, f, generation, covered=None):
+        """Return the mapped snapshot of the open file ``f``, or None.
+
+        Only a snapshot made for this file's inode and ``generation``, and
+        covering no more than the ``covered`` bytes the caller will trust,
+        is returned.
+        """
+        if not self.snapshots:
+            return None
+        inode = os.fstat(f.fileno()).st_ino
+        with self._snapshots_lock:
+            snapshot = self._snapshots.get(file_path)
+            if snapshot is not None and (snapshot.inode, snapshot.generation) == (inode, generation):
+                self._snapshots.move_to_end(file_path)
+            else:
+                snapshot = Snapshot.open(file_path.with_suffix('.bin'), inode, generation)
+                if snapshot is None:
+                    return None
+                self._snapshots[file_path] = snapshot
+                while len(self._snapshots) > SNAPSHOT_ENTRIES:
+                    self._snapshots.popitem(last=False)
+        if covered is not None and snapshot.covered > covered:
+            return None
+        return snapshot
+
+    def _drop_snapshot(self, file_path):
+        with self._snapshots_lock:
+            self._snapshots.pop(file_path, None)
+        try:
+            os.remove(file_path.with_suffix('.bin'))
+        except FileNotFoundError:
+            pass
+
+    def _read_at(self, f, header, offset, snapshot=None):
+        if snapshot is not None:
+            i = snapshot.find(offset)
+            if i is not None:
+                return snapshot.transactions([i], self.model)[0]
+        f.seek(offset)
+        row = dict(zip(header, parse_record(read_record(f))))
+        row['date_time'] = parse_date_time(row['date_time'])
+        row['created_at'] = parse_timestamp(row['created_at'])
+        row['updated_at'] = parse_timestamp(row['updated_at'])
+        return self.model(**row)
+
+    def _read(self, file_path, signature=None):
+        """Parse every live row of a user's transaction file, in stored order."""
+        model = self.model
+        # (row number, offset) of each transaction, in file order
+        positions = []
+        with self._open(file_path, _live_state) as opened:
+            if opened is None:
+                return []
+            f, generation, (header, live, covered) = opened
+            transactions = []
+            snapshot = self._snapshot(file_path, f, generation, covered)
+            tail_start = None
+            if snapshot is not None:
+                indices = snapshot.live_indices(live)
+                transactions = snapshot.transactions(indices, model)
+                positions = [(live[offset], offset) for offset in snapshot.offsets[indices].tolist()]
+                tail_start = snapshot.covered
+            rows = RowParser(csv.DictReader(_live_lines(f, live, covered, positions, tail_start),
+                                             fieldnames=header))
+            tail = [model(**rows.parse(row)) for row in rows]
+            transactions += tail
+            if self.snapshots and (snapshot is None or len(tail) >= SNAPSHOT_MAX_STALE
+                                   or len(snapshot) - len(indices) >= SNAPSHOT_MAX_STALE):
+                self._write_snapshot(file_path, f, generation, covered, transactions, positions)
+        if signature is not None:
+            # Date order as laid out in the file, which is what iter() streams
+            self._sorted[file_path] = (signature, all(
+                a.date_time <= b.date_time
+                for a, b in zip(transactions, itertools.islice(transactions, 1, None))))
+        if any(a > b for a, b in zip(positions, itertools.islice(positions, 1, None))):
+            # Edited rows were appended at the end; put them back in place
+            transactions = [t for _, t in sorted(zip(positions, transactions), key=itemgetter(0))]
+        self._count_fallbacks(file_path, rows)
+        return transactions
+
+    def _write_snapshot(self, file_path, f, generation, covered, transactions, positions):
+        inode = os.fstat(f.fileno()).st_ino
+        try:
+            written = write_snapshot(file_path.with_suffix('.bin'), inode, generation, covered,
+                                     transactions, positions)
+        except OSError as e:
+            logger.warning(f"Could not write snapshot for {file_path}: {e}")
+            return
+        if not written:
+            logger.info(f"{file_path} has values the snapshot format can't hold; not snapshotting")
+            return
+        with self._snapshots_lock:
+            self._snapshots.pop(file_path, None)
+
+    def _count_fallbacks(self, file_path, rows):
+        fallbacks = rows.fallbacks()
+        self.date_fallbacks += fallbacks
+        if fallbacks:
+            logger.info(f"{file_path}: {fallbacks} date values did not match the detected "
+                        f"format ({rows.date_time.format_name}) and used the slow parser")
+
+
+class _PageIndex:
+    """(date_time, id) keys of every row in a file, sorted, with the byte
+    offset each row starts at."""
+
+    def __init__(self, signature, header, keys, offsets):
+        self.signature = signature
+        self.header = header
+        self.keys = keys
+        self.offsets = offsets
+
+    @classmethod
+    def build(cls, f, signature, header, live, covered, snapshot=None):
+        if 'id' not in header or 'date_time' not in header:
+            return cls(signature, header, [], [])
+        id_col = header.index('id')
+        date_col = header.index('date_time')
+        dates = DateColumnParser(DATE_TIME_FORMATS, parse_date_time)
+        entries = []
+        f.seek(0)
+        read_record(f)
+        if snapshot is not None:
+            indices = snapshot.live_indices(live)
+            entries = list(zip(snapshot.dates(indices), snapshot.strings(indices, 'id'),
+                               snapshot.offsets[indices].tolist()))
+            f.seek(snapshot.covered)
+        for offset, record in iter_records(f):
+            if offset >= covered:
+                break
+            if offset not in live:
+                continue
+            values = parse_record(record)
+            if dates.format_name is None:
+                dates.detect([values[date_col]])
+            entries.append((dates.parse(values[date_col]), values[id_col], offset))
+        entries.sort()
+        return cls(signature, header,
+                   [(date_time, id_) for date_time, id_, _ in entries],
+                   [offset for _, _, offset in entries])
+
+
+def _rows(transactions):
+    # CSV rows of transactions. A row of type TOMBSTONE would be read back
+    # as the deletion of its id, so that type is refused
+    rows = [t.to_dict() for t in transactions]
+    for row in rows:
+        if row.get('transaction_type') == TOMBSTONE:
+            raise ValueError(f"Transaction type {TOMBSTONE!r} is reserved for deleted rows")
+    return rows
+
+
+def _live_state(index):
+    return index.header, index.live_offsets(), index.covered
+
+
+def _live_lines(f, live, covered, positions=None, start=None):
+    """Decode the live records of a file from ``start`` (default: after the
+    header) up to ``covered``, appending (row number, offset) of each to
+    ``positions``."""
+    f.seek(0)
+    read_record(f)
+    if start is not None:
+        f.seek(start)
+    for offset, record in iter_records(f):
+        if offset >= covered:
+            return
+        row = live.get(offset)
+        if row is not None:
+            if positions is not None:
+                positions.append((row, offset))
+            yield record.decode('utf-8')
\ No newline at end of file
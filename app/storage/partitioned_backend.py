@@ -0,0 +1,473 @@
+import contextlib
+import csv
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import tempfile
+from datetime import datetime
+from pathlib import Path
+
+from ..services.user_summary import UserSummary
+from ..utils.dates import parse_date_time
+from ..utils.file_lock import file_lock
+from ..utils.transaction_cache import transaction_cache
+from . import ConcurrentUpdateError
+from .csv_backend import CsvTransactionStore
+from .rows import RowParser, in_range
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = 'manifest.json'
+MANIFEST_VERSION = 1
+
+# Attempts at reading a month whose file keeps being replaced underneath
+# a lock-free reader
+READ_RETRIES = 8
+
+
+def month_key(date_time):
+    """Return the ``YYYY-MM`` partition a transaction date falls in."""
+    return parse_date_time(date_time).strftime('%Y-%m')
+
+
+def _month_bounds(key):
+    year, month = map(int, key.split('-'))
+    return datetime(year, month, 1), datetime(year + month // 12, month % 12 + 1, 1)
+
+
+def _overlaps(key, start, end):
+    month_start, month_end = _month_bounds(key)
+    return (start is None or month_end > start) and (end is None or month_start < end)
+
+
+def _page_key(transaction):
+    return transaction.date_time, transaction.id
+
+
+class PartitionedTransactionStore:
+    """Stores each user's transactions as one CSV file per month.
+
+    Layout::
+
+        user_transactions/<user_id>/manifest.json
+        user_transactions/<user_id>/2024-05.csv
+        user_transactions/<user_id>/2023-01.csv.gz
+
+    The manifest lists every month with its file, row count, size, a digest
+    of its contents and the :class:`UserSummary` of its rows. Date-range
+    reads and pages open only the months they need and summaries come from
+    the manifest alone, so asking about this month costs the same however
+    long the history is. Writes rewrite only the months their rows fall in:
+    an append or import touches the months of the new rows, and a full save
+    skips months whose contents didn't change.
+
+    With ``compress_after`` set, months more than that many months old are
+    gzipped the next time the user's data is written. Compressed months are
+    read and rewritten whole like any other.
+
+    Writers hold an exclusive ``flock`` on ``<user_id>/.lock``. Month files
+    and the manifest are replaced by renaming fully written temp files over
+    them, manifest last, so readers take no locks; one that finds a month's
+    file gone re-reads the manifest. Point reads, edits and deletes scan
+    months newest first until they find their ids.
+
+    A user's single-file CSV from the ``csv`` backend is split into months
+    the first time it is accessed, and left in place untouched.
+    """
+
+    name = 'partitioned'
+
+    def __init__(self, model, directory='user_transactions', compress_after=None):
+        self.model = model
+        self.directory = Path(directory)
+        self.compress_after = compress_after
+
+    def user_dir(self, user_id):
+        return self.directory / str(user_id)
+
+    def load(self, user_id, start=None, end=None):
+        if start is not None or end is not None:
+            return list(self.iter(user_id, start=start, end=end))
+
+        partitions, signature = self._manifest(user_id)
+        if signature is None:
+            return []
+        transactions = transaction_cache.get(user_id, signature)
+        if transactions is None:
+            transactions = [t for key in partitions for t in self._read_month(user_id, key, partitions)]
+            # Only cache what was read if no write was published meanwhile
+            if self._manifest(user_id)[1] == signature:
+                transaction_cache.put(user_id, signature, transactions)
+        return transactions
+
+    def iter(self, user_id, start=None, end=None, categories=None):
+        partitions, signature = self._manifest(user_id)
+        if signature is None:
+            return
+        if categories is not None:
+            categories = set(categories)
+
+        cached = transaction_cache.peek(user_id, signature)
+        if cached is not None:
+            for t in cached:
+                if in_range(t.date_time, start, end) and (categories is None or t.category in categories):
+                    yield t.__copy__()
+            return
+
+        for key in partitions:
+            if not _overlaps(key, start, end):
+                continue
+            for t in self._read_month(user_id, key, partitions):
+                if in_range(t.date_time, start, end) and (categories is None or t.category in categories):
+                    yield t
+
+    def page(self, user_id, after=None, limit=50):
+        """Yield up to ``limit`` transactions, newest first.
+
+        Ordering is by (date_time, id); ``after`` is the key of the last
+        transaction of the previous page. Months are read newest first and
+        only until the page is full.
+        """
+        partitions, _ = self._manifest(user_id)
+        remaining = limit
+        for key in reversed(list(partitions)):
+            if remaining <= 0:
+                return
+            if after is not None and _month_bounds(key)[0] > after[0]:
+                continue
+            for t in sorted(self._read_month(user_id, key, partitions), key=_page_key, reverse=True):
+                if after is not None and _page_key(t) >= after:
+                    continue
+                yield t
+                remaining -= 1
+                if remaining <= 0:
+                    return
+
+    def summary(self, user_id):
+        partitions = self._manifest(user_id)[0]
+        stale = [key for key, entry in partitions.items() if not _summary_current(key, entry['summary'])]
+        if stale:
+            partitions = self._resummarize(user_id, stale)
+        summary = UserSummary()
+        for entry in partitions.values():
+            summary.extend(UserSummary.from_dict(entry['summary']))
+        return summary
+
+    def _resummarize(self, user_id, keys):
+        """Rebuild the manifest summaries of months ``keys`` from their files.
+
+        Returns:
+            dict: The updated partitions
+        """
+        with self._writing(user_id) as (user_dir, partitions):
+            stale = [key for key in keys
+                     if key in partitions and not _summary_current(key, partitions[key]['summary'])]
+            if stale:
+                logger.info(f"Rebuilding summaries of user {user_id}'s months {stale}")
+                for key in stale:
+                    rows = self._read_partition(user_dir, partitions[key])
+                    partitions[key] = dict(partitions[key], summary=UserSummary.from_transactions(rows).to_dict())
+                _write_manifest(user_dir, partitions)
+            return partitions
+
+    def get_many(self, user_id, ids):
+        wanted = set(ids)
+        partitions, signature = self._manifest(user_id)
+        cached = transaction_cache.peek(user_id, signature)
+        if cached is not None:
+            return {t.id: t.__copy__() for t in cached if t.id in wanted}
+
+        found = {}
+        for key in reversed(list(partitions)):
+            if len(found) == len(wanted):
+                break
+            for t in self._read_month(user_id, key, partitions):
+                if t.id in wanted:
+                    found[t.id] = t
+        return found
+
+    def version(self, user_id):
+        """Opaque token that changes whenever the user's data does."""
+        return self._manifest(user_id)[1] or ()
+
+    def save_all(self, user_id, transactions, if_version=None):
+        """Replace all of a user's transactions.
+
+        Only months whose contents differ from what is stored are rewritten.
+
+        Args:
+            if_version: Only publish if :meth:`version` still returns this
+
+        Raises:
+            ConcurrentUpdateError: If ``if_version`` no longer matches
+        """
+        try:
+            with self._writing(user_id) as (user_dir, partitions):
+                if if_version is not None and self.version(user_id) != if_version:
+                    raise ConcurrentUpdateError(f"{user_dir} changed since it was read")
+                self._replace_all(user_dir, partitions, transactions)
+        finally:
+            transaction_cache.invalidate(user_id)
+
+    def modify(self, user_id, change):
+        """Read-modify-write a user's transactions under the user's lock.
+
+        ``change`` gets the current list and returns the new one; no other
+        writer can run in between.
+        """
+        try:
+            with self._writing(user_id) as (user_dir, partitions):
+                transactions = change(self.load(user_id))
+                self._replace_all(user_dir, partitions, transactions)
+                return transactions
+        finally:
+            transaction_cache.invalidate(user_id)
+
+    def append(self, user_id, transactions):
+        try:
+            with self._writing(user_id) as (user_dir, partitions):
+                months = {}
+                for t in transactions:
+                    key = month_key(t.date_time)
+                    if key not in months:
+                        months[key] = self._read_partition(user_dir, partitions[key]) if key in partitions else []
+                    months[key].append(t)
+                self._commit(user_dir, partitions, months)
+        finally:
+            transaction_cache.invalidate(user_id)
+
+    def update(self, user_id, transactions):
+        """Write back edited transactions, matched by id; unknown ids are ignored.
+
+        An edit that changes a transaction's month moves it to the end of
+        the new month.
+        """
+        wanted = {t.id: t for t in transactions}
+        if not wanted:
+            return
+        try:
+            with self._writing(user_id) as (user_dir, partitions):
+                months = self._find(user_dir, partitions, wanted)
+                moved = []
+                for key, rows in months.items():
+                    kept = []
+                    for t in rows:
+                        new = wanted.get(t.id)
+                        if new is None:
+                            kept.append(t)
+                        elif month_key(new.date_time) == key:
+                            kept.append(new)
+                        else:
+                            moved.append(new)
+                    months[key] = kept
+                for t in moved:
+                    key = month_key(t.date_time)
+                    if key not in months:
+                        months[key] = self._read_partition(user_dir, partitions[key]) if key in partitions else []
+                    months[key].append(t)
+                self._commit(user_dir, partitions, months)
+        finally:
+            transaction_cache.invalidate(user_id)
+
+    def delete(self, user_id, ids):
+        """Delete transactions by id and return how many there were."""
+        wanted = set(ids)
+        if not wanted:
+            return 0
+        try:
+            with self._writing(user_id) as (user_dir, partitions):
+                months = self._find(user_dir, partitions, wanted)
+                deleted = 0
+                for key, rows in months.items():
+                    months[key] = [t for t in rows if t.id not in wanted]
+                    deleted += len(rows) - len(months[key])
+                self._commit(user_dir, partitions, months)
+                return deleted
+        finally:
+            transaction_cache.invalidate(user_id)
+
+    def _find(self, user_dir, partitions, ids):
+        """Read months newest first until every id is found.
+
+        Returns:
+            dict: Month -> its transactions, for the months holding any of ``ids``
+        """
+        months = {}
+        missing = set(ids)
+        for key in reversed(list(partitions)):
+            if not missing:
+                break
+            rows = self._read_partition(user_dir, partitions[key])
+            hits = missing.intersection(t.id for t in rows)
+            if hits:
+                months[key] = rows
+                missing -= hits
+        return months
+
+    def _manifest(self, user_id):
+        """Return ``(partitions, signature)`` for a user.
+
+        ``partitions`` maps each month to its manifest entry, oldest first.
+        The signature is (manifest mtime, total CSV bytes, manifest inode),
+        or None if the user has no data.
+        """
+        user_dir = self.user_dir(user_id)
+        partitions, signature = _read_manifest(user_dir)
+        if signature is None and self._legacy_path(user_id).exists():
+            with self._writing(user_id):
+                pass
+            partitions, signature = _read_manifest(user_dir)
+        return partitions, signature
+
+    def _read_month(self, user_id, key, partitions):
+        """Read one month, following the manifest if its file was replaced."""
+        user_dir = self.user_dir(user_id)
+        for _ in range(READ_RETRIES):
+            entry = partitions.get(key)
+            if entry is None:
+                return []
+            try:
+                return self._read_partition(user_dir, entry)
+            except FileNotFoundError:
+                partitions = _read_manifest(user_dir)[0]
+        raise ConcurrentUpdateError(f"{user_dir / key} kept being replaced while reading it")
+
+    def _read_partition(self, user_dir, entry):
+        path = user_dir / entry['file']
+        opener = gzip.open if path.suffix == '.gz' else open
+        with opener(path, 'rt', newline='', encoding='utf-8') as f:
+            rows = RowParser(csv.DictReader(f))
+            return [self.model(**rows.parse(row)) for row in rows]
+
+    @contextlib.contextmanager
+    def _writing(self, user_id):
+        """Hold the user's write lock; yields ``(user_dir, partitions)``."""
+        user_dir = self.user_dir(user_id)
+        user_dir.mkdir(parents=True, exist_ok=True)
+        with file_lock(user_dir / '.lock'):
+            partitions, signature = _read_manifest(user_dir)
+            if signature is None:
+                self._migrate(user_id, user_dir, partitions)
+            yield user_dir, partitions
+
+    def _legacy_path(self, user_id):
+        return self.directory / f'{user_id}.csv'
+
+    def _migrate(self, user_id, user_dir, partitions):
+        """Split the user's single-file CSV, if there is one, into months."""
+        if not self._legacy_path(user_id).exists():
+            return
+        transactions = CsvTransactionStore(self.model, self.directory).load(user_id)
+        logger.info(f"Partitioning {len(transactions)} transactions of user {user_id} by month")
+        self._replace_all(user_dir, partitions, transactions)
+
+    def _replace_all(self, user_dir, partitions, transactions):
+        months = {key: [] for key in partitions}
+        for t in transactions:
+            months.setdefault(month_key(t.date_time), []).append(t)
+        self._commit(user_dir, partitions, months)
+
+    def _commit(self, user_dir, partitions, months):
+        """Store ``months`` (month -> its full list of transactions; empty
+        removes the month), compress months that went cold and publish the
+        manifest. ``partitions`` is updated in place."""
+        obsolete = []
+        for key, transactions in months.items():
+            old = partitions.pop(key, None)
+            if transactions:
+                partitions[key] = self._write_partition(user_dir, key, transactions, old)
+            if old is not None and old['file'] != partitions.get(key, {}).get('file'):
+                obsolete.append(old['file'])
+        for key, entry in partitions.items():
+            if self._is_cold(key) and not entry['file'].endswith('.gz'):
+                with open(user_dir / entry['file'], 'rb') as f:
+                    data = f.read()
+                partitions[key] = dict(entry, file=f'{key}.csv.gz')
+                _write_file(user_dir / partitions[key]['file'], gzip.compress(data, mtime=0))
+                obsolete.append(entry['file'])
+
+        _write_manifest(user_dir, partitions)
+        # Only once the manifest no longer points at them
+        for name in obsolete:
+            try:
+                os.remove(user_dir / name)
+            except FileNotFoundError:
+                pass
+
+    def _write_partition(self, user_dir, key, transactions, old):
+        """Write one month's file, unless ``old`` already holds these rows.
+
+        Returns:
+            dict: The month's manifest entry
+        """
+        buf = io.StringIO()
+        writer = csv.DictWriter(buf, fieldnames=self.model.FIELDNAMES)
+        writer.writeheader()
+        writer.writerows(t.to_dict() for t in transactions)
+        data = buf.getvalue().encode('utf-8')
+        digest = hashlib.sha1(data).hexdigest()
+        compress = self._is_cold(key)
+        name = f'{key}.csv.gz' if compress else f'{key}.csv'
+        if old is not None and old['digest'] == digest and old['file'] == name:
+            return old
+
+        _write_file(user_dir / name, gzip.compress(data, mtime=0) if compress else data)
+        return {
+            'file': name,
+            'rows': len(transactions),
+            'bytes': len(data),
+            'digest': digest,
+            'summary': UserSummary.from_transactions(transactions).to_dict(),
+        }
+
+    def _is_cold(self, key):
+        if self.compress_after is None:
+            return False
+        year, month = map(int, key.split('-'))
+        now = datetime.now()
+        return (now.year * 12 + now.month) - (year * 12 + month) > self.compress_after
+
+
+def _read_manifest(user_dir):
+    try:
+        with open(user_dir / MANIFEST, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            data = json.load(f)
+    except FileNotFoundError:
+        return {}, None
+    if data.get('version') != MANIFEST_VERSION:
+        raise ValueError(f"Unsupported manifest version in {user_dir}: {data.get('version')}")
+    partitions = data['partitions']
+    return partitions, (stat.st_mtime_ns, sum(e['bytes'] for e in partitions.values()), stat.st_ino)
+
+
+def _summary_current(key, summary):
+    # Summaries written before string dates were parsed put every row of an
+    # appended month under '1970-01'; older ones still track the row stored
+    # last instead of the latest
+    return set(summary['months']) <= {key} and 'latest' in summary
+
+
+def _write_manifest(user_dir, partitions):
+    _write_file(user_dir / MANIFEST, json.dumps({
+        'version': MANIFEST_VERSION,
+        'partitions': dict(sorted(partitions.items())),
+    }).encode('utf-8'))
+
+
+def _write_file(path, data):
+    """Atomically replace ``path`` with ``data``."""
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
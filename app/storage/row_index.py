@@ -0,0 +1,327 @@
+import contextlib
+import csv
+import json
+import logging
+import os
+import tempfile
+import threading
+from pathlib import Path
+
+from ..services.user_summary import UserSummary, latest_key
+from ..utils.dates import parse_date_time
+
+logger = logging.getLogger(__name__)
+
+# transaction_type value marking a row as the deletion of its id; the CSV
+# backend refuses to store transactions of this type
+TOMBSTONE = '#deleted'
+
+INDEX_VERSION = 'v1'
+
+
+class RowIndex:
+    """Persistent id -> (byte offset, row number) index of a user CSV file.
+
+    The CSV is treated as a log: an edit appends the new version of a row
+    and a delete appends a tombstone row, so neither rewrites the file. The
+    index records which record is live for each id, and the row number the
+    id was first stored at so reads can keep the original order.
+
+    It is kept next to the CSV as ``<user_id>.idx``, itself append-only: a
+    ``v1 <inode> <generation>`` header, then one line per indexed record::
+
+        +  <id>  <offset>  <end>  <row>     live version of a row
+        -  <id>  <offset>  <end>            tombstone
+
+    :meth:`refresh` only scans the CSV past the last indexed record, so
+    appends made by other writers are picked up incrementally. Replaying a
+    line is idempotent and later offsets always win, so duplicated or
+    reordered lines from concurrent writers are harmless. If the CSV was
+    replaced (new inode or rewrite generation, see
+    :func:`~app.utils.file_lock.rewriting`) or shrank, the index is rebuilt
+    from scratch.
+
+    The index also keeps the user's :class:`UserSummary` current: every
+    record it catches up on is applied as a delta (the previous version of
+    an edited or deleted row is read back from its old offset). The summary
+    is saved as ``<user_id>.summary.json`` together with the index position
+    it reflects, and rebuilt from the live rows when that doesn't match.
+    Only deleting (or back-dating) the latest row makes the current balance
+    need another read of the live rows, to find which one is latest now.
+    """
+
+    def __init__(self, csv_path, model):
+        self.csv_path = Path(csv_path)
+        self.path = self.csv_path.with_suffix('.idx')
+        self.summary_path = self.csv_path.with_suffix('.summary.json')
+        self.model = model
+        # Held by callers around refresh() and reads of the index
+        self.lock = threading.RLock()
+        self._reset(None, None)
+
+    def _reset(self, inode, generation):
+        self.inode = inode
+        self.generation = generation
+        self.header = []
+        # id -> (offset, row number)
+        self.rows = {}
+        # id -> offset of the tombstone that removed it
+        self.deleted = {}
+        # CSV bytes covered by the index
+        self.covered = 0
+        self.next_row = 0
+        # Records in the CSV that are superseded versions or tombstones
+        self.dead = 0
+        # Kept up to date by _catch_up once loaded or built
+        self.summary = None
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, transaction_id):
+        return transaction_id in self.rows
+
+    def offset(self, transaction_id):
+        entry = self.rows.get(transaction_id)
+        return entry[0] if entry is not None else None
+
+    def live_offsets(self):
+        """Map each live record's offset to its row number."""
+        return {offset: row for offset, row in self.rows.values()}
+
+    def refresh(self, generation):
+        """Bring the index up to date with the CSV file and return it.
+
+        Args:
+            generation (int): The CSV's current rewrite generation
+        """
+        try:
+            stat = os.stat(self.csv_path)
+        except FileNotFoundError:
+            self._reset(None, None)
+            return self
+        if ((stat.st_ino, generation) != (self.inode, self.generation)
+                or stat.st_size < self.covered):
+            self._load(stat, generation)
+        if stat.st_size > self.covered or not self.header:
+            self._catch_up()
+        return self
+
+    def _load(self, stat, generation):
+        self._reset(stat.st_ino, generation)
+        header = [INDEX_VERSION, str(stat.st_ino), str(generation)]
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                first = f.readline().split()
+                if first == header:
+                    for line in f:
+                        if line.endswith('\n'):
+                            self._replay(line.rstrip('\n').split('\t'))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, IndexError) as e:
+            logger.warning(f"Rebuilding unreadable row index {self.path}: {e}")
+            self._reset(stat.st_ino, generation)
+
+        if self.covered > stat.st_size:
+            self._reset(stat.st_ino, generation)
+        if not self.covered:
+            # Missing, stale or empty: start over from the whole CSV
+            with open(self.path, 'w', encoding='utf-8') as f:
+                f.write(' '.join(header) + '\n')
+        self._load_summary()
+
+    def _load_summary(self):
+        try:
+            with open(self.summary_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if (data['inode'], data['generation'], data['covered']) == (
+                    self.inode, self.generation, self.covered):
+                self.summary = UserSummary.from_dict(data['summary'])
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Ignoring unreadable summary {self.summary_path}: {e}")
+
+    def _save_summary(self):
+        data = {'inode': self.inode, 'generation': self.generation, 'covered': self.covered,
+                'summary': self.summary.to_dict()}
+        fd, tmp_path = tempfile.mkstemp(dir=self.summary_path.parent,
+                                        prefix=f'.{self.summary_path.name}.')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.summary_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def get_summary(self):
+        """Return the summary of the live rows, building it if needed.
+
+        Call :meth:`refresh` first. The result is a copy.
+        """
+        if self.inode is None:
+            return UserSummary()
+        if self.summary is None:
+            summary = UserSummary()
+            for t in self._live_transactions():
+                summary.add(t)
+            self.summary = summary
+            self._save_summary()
+        elif self.summary.latest is None:
+            latest, balance = [], 0
+            for t in self._live_transactions():
+                key = latest_key(t)
+                if key > latest:
+                    latest, balance = key, t.balance_satang
+            self.summary.set_latest(latest, balance)
+            self._save_summary()
+        return self.summary.copy()
+
+    def _live_transactions(self):
+        live = self.live_offsets()
+        with open(self.csv_path, 'rb') as f:
+            read_record(f)
+            for offset, record in iter_records(f):
+                if offset >= self.covered:
+                    break
+                if offset in live:
+                    yield self._transaction(record)
+
+    def _transaction(self, record):
+        values = dict(zip(self.header, parse_record(record)))
+        values['date_time'] = parse_date_time(values.get('date_time'))
+        return self.model(**values)
+
+    def _transaction_at(self, f, offset):
+        f.seek(offset)
+        return self._transaction(read_record(f))
+
+    def _replay(self, fields):
+        op, transaction_id, offset, end = fields[0], fields[1], int(fields[2]), int(fields[3])
+        if op == '+':
+            self._apply_row(transaction_id, offset, int(fields[4]))
+        else:
+            self._apply_tombstone(transaction_id, offset)
+        self.covered = max(self.covered, end)
+
+    def _apply_row(self, transaction_id, offset, row):
+        """Make the record at ``offset`` the live version of its id.
+
+        Returns:
+            bool: Whether the index changed
+        """
+        if offset <= self.deleted.get(transaction_id, -1):
+            return False
+        current = self.rows.get(transaction_id)
+        if current is None:
+            self.deleted.pop(transaction_id, None)
+            self.rows[transaction_id] = (offset, row)
+            self.next_row = max(self.next_row, row + 1)
+            return True
+        if offset > current[0]:
+            self.rows[transaction_id] = (offset, current[1])
+            self.dead += 1
+            return True
+        return False
+
+    def _apply_tombstone(self, transaction_id, offset):
+        """Delete an id by the tombstone at ``offset``; returns whether it was live."""
+        current = self.rows.get(transaction_id)
+        if current is not None and offset > current[0]:
+            del self.rows[transaction_id]
+            self.deleted[transaction_id] = offset
+            self.dead += 2
+            return True
+        if offset > self.deleted.get(transaction_id, -1):
+            self.deleted[transaction_id] = offset
+            self.dead += 1
+        return False
+
+    def _catch_up(self):
+        lines = []
+        start = self.covered
+        summary = self.summary
+        with open(self.csv_path, 'rb') as f, \
+                (open(self.csv_path, 'rb') if summary is not None else contextlib.nullcontext()) as old:
+            # ``old`` is a second handle for reading back previous versions
+            # of changed rows
+            header = parse_record(read_record(f))
+            self.header = header
+            if 'id' not in header or 'transaction_type' not in header:
+                return
+            id_col = header.index('id')
+            type_col = header.index('transaction_type')
+            if self.covered:
+                f.seek(self.covered)
+            else:
+                self.covered = f.tell()
+            for offset, record in iter_records(f):
+                if not record.endswith(b'\n'):
+                    # Still being written; picked up by a later refresh
+                    break
+                end = offset + len(record)
+                values = parse_record(record)
+                if len(values) <= max(id_col, type_col):
+                    self.covered = end
+                    continue
+                transaction_id = values[id_col]
+                previous = self.rows.get(transaction_id)
+                if values[type_col] == TOMBSTONE:
+                    changed = self._apply_tombstone(transaction_id, offset)
+                    lines.append(f'-\t{transaction_id}\t{offset}\t{end}\n')
+                else:
+                    row = previous[1] if previous is not None else self.next_row
+                    changed = self._apply_row(transaction_id, offset, row)
+                    lines.append(f'+\t{transaction_id}\t{offset}\t{end}\t{row}\n')
+                self.covered = end
+
+                if summary is not None and changed:
+                    if previous is None:
+                        summary.add(self._transaction(record))
+                    elif transaction_id in self.rows:
+                        summary.replace(self._transaction_at(old, previous[0]), self._transaction(record))
+                    else:
+                        summary.remove(self._transaction_at(old, previous[0]))
+
+        if lines:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(''.join(lines))
+        if summary is not None and self.covered != start:
+            self._save_summary()
+
+    def remove(self):
+        """Forget the index and summary, e.g. after the CSV was rewritten."""
+        self._reset(None, None)
+        for path in (self.path, self.summary_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def read_record(f):
+    """Read one CSV record from a binary file, following quoted newlines."""
+    record = f.readline()
+    while record.count(b'"') % 2:
+        line = f.readline()
+        if not line:
+            break
+        record += line
+    return record
+
+
+def iter_records(f):
+    """Yield (byte offset, raw record) for every CSV record in a binary file."""
+    offset = f.tell()
+    while True:
+        record = read_record(f)
+        if not record:
+            return
+        yield offset, record
+        offset += len(record)
+
+
+def parse_record(record):
+    return next(csv.reader([record.decode('utf-8')]), [])
@@ -0,0 +1,54 @@
+"""Parsing of stored CSV transaction rows, shared by the CSV-based backends."""
+import itertools
+
+from ..utils.dates import (
+    DATE_TIME_FORMATS, TIMESTAMP_FORMATS, DateColumnParser, parse_date_time, parse_timestamp,
+)
+
+# Rows read before choosing each date column's parser
+DATE_SAMPLE_ROWS = 20
+
+
+class RowParser:
+    """Iterates CSV rows, converting date columns with per-file parsers.
+
+    Each date column's format is detected from the first rows and then
+    parsed with a single fast parser; values that don't match fall back to
+    trying every known format.
+    """
+
+    def __init__(self, reader):
+        self._head = list(itertools.islice(reader, DATE_SAMPLE_ROWS))
+        self._rows = itertools.chain(self._head, reader)
+        self.date_time = DateColumnParser(DATE_TIME_FORMATS, parse_date_time)
+        self.created_at = DateColumnParser(TIMESTAMP_FORMATS, parse_timestamp)
+        self.updated_at = DateColumnParser(TIMESTAMP_FORMATS, parse_timestamp)
+        self.date_time.detect(row.get('date_time') for row in self._head)
+        self.created_at.detect(row.get('created_at') for row in self._head)
+        self.updated_at.detect(row.get('updated_at') for row in self._head)
+
+    def __iter__(self):
+        return self._rows
+
+    def parse(self, row):
+        """Convert all of a row's date columns in place and return it."""
+        row['date_time'] = self.date_time.parse(row['date_time'])
+        return self.parse_timestamps(row)
+
+    def parse_timestamps(self, row):
+        row['created_at'] = self.created_at.parse(row['created_at'])
+        row['updated_at'] = self.updated_at.parse(row['updated_at'])
+        return row
+
+    def fallbacks(self):
+        return self.date_time.fallbacks + self.created_at.fallbacks + self.updated_at.fallbacks
+
+
+def in_range(value, start, end):
+    """Return whether ``value`` is at or after ``start`` and before ``end``;
+    either bound may be None."""
+    if start is not None and value < start:
+        return False
+    if end is not None and value >= end:
+        return False
+    return True
@@ -0,0 +1,238 @@
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from datetime import datetime
+
+import numpy as np
+
+MAGIC = b'TXNSNAP\0'
+FORMAT_VERSION = 1
+
+# magic, format version, row count, string count, CSV inode, CSV rewrite
+# generation, CSV bytes covered
+_HEADER = struct.Struct('<8sIIIxxxxQQQ')
+
+# Stands for an empty amount (None) in the integer columns
+NULL = np.iinfo(np.int64).min
+
+_EPOCH = datetime(1970, 1, 1)
+
+# Fixed-width int64 columns. offset/row locate the record in the CSV and
+# its row number; dates are naive microseconds since the epoch; amounts are
+# the Transaction's satang slots.
+DATE_COLUMNS = ('date_time', 'created_at', 'updated_at')
+AMOUNT_COLUMNS = ('_amount', '_withdrawal', '_deposit', '_balance')
+INT_COLUMNS = ('offset', 'row') + DATE_COLUMNS + AMOUNT_COLUMNS
+
+# uint32 references into the string table
+STRING_COLUMNS = (
+    'id', 'user_id', 'transaction_type', 'detail', 'extra', 'branch',
+    'line_text', 'explanation', 'category',
+)
+# Low-cardinality columns whose decoded values are interned, as
+# Transaction.__init__ does
+INTERNED_COLUMNS = {'user_id', 'transaction_type', 'branch', 'category'}
+
+
+def to_micros(value):
+    """Naive datetime -> microseconds since the epoch, as stored in snapshots."""
+    if not isinstance(value, datetime) or value.tzinfo is not None:
+        raise ValueError(f"Cannot store {value!r} in a snapshot")
+    delta = value - _EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1_000_000 + delta.microseconds
+
+
+def _align(pos):
+    return (pos + 7) & ~7
+
+
+def write_snapshot(path, inode, generation, covered, transactions, positions):
+    """Write a binary snapshot of a user's live rows.
+
+    Args:
+        path (Path): The ``.bin`` file to (re)write, atomically
+        inode (int): Inode of the CSV file the rows were read from
+        generation (int): The CSV's rewrite generation
+        covered (int): CSV bytes the snapshot reflects
+        transactions (list[Transaction]): Live rows in file (offset) order
+        positions (list[tuple[int, int]]): (row number, CSV offset) per row
+
+    Returns:
+        bool: False if a row can't be represented (e.g. an aware datetime)
+    """
+    n = len(transactions)
+    ints = {name: np.empty(n, dtype='<i8') for name in INT_COLUMNS}
+    refs = {name: np.empty(n, dtype='<u4') for name in STRING_COLUMNS}
+    strings = {}
+    try:
+        for i, (t, (row, offset)) in enumerate(zip(transactions, positions)):
+            ints['offset'][i] = offset
+            ints['row'][i] = row
+            for name in DATE_COLUMNS:
+                ints[name][i] = to_micros(getattr(t, name))
+            for name in AMOUNT_COLUMNS:
+                value = getattr(t, name)
+                ints[name][i] = NULL if value is None else value
+            for name in STRING_COLUMNS:
+                refs[name][i] = strings.setdefault(getattr(t, name) or '', len(strings))
+    except ValueError:
+        return False
+
+    encoded = [s.encode('utf-8') for s in strings]
+    string_offsets = np.zeros(len(encoded) + 1, dtype='<u8')
+    np.cumsum([len(b) for b in encoded], out=string_offsets[1:])
+
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(_HEADER.pack(MAGIC, FORMAT_VERSION, n, len(encoded), inode, generation,
+                                 covered))
+            for column in [*ints.values(), *refs.values(), string_offsets]:
+                f.write(b'\0' * (_align(f.tell()) - f.tell()))
+                f.write(column.tobytes())
+            f.write(b''.join(encoded))
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return True
+
+
+class Snapshot:
+    """A memory-mapped binary snapshot of a user's live transactions.
+
+    Layout: a fixed header (magic, format version, row and string counts,
+    and the inode, generation and length of the CSV version it reflects), then one
+    8-byte aligned column per field — int64 for offsets, row numbers, dates
+    and satang amounts, uint32 string references for text — then the string
+    table as uint64 end offsets and a UTF-8 blob. Each distinct string is
+    stored once.
+
+    Columns are numpy views over the mapping, so opening a snapshot reads
+    nothing but the header; only the rows and strings actually asked for
+    are turned into Python objects. Rows are sorted by CSV offset.
+    """
+
+    def __init__(self, mapped, inode, generation, covered, count, string_count):
+        self._mmap = mapped
+        self.inode = inode
+        self.generation = generation
+        self.covered = covered
+        self.count = count
+        pos = _HEADER.size
+        self.columns = {}
+        for name in INT_COLUMNS + STRING_COLUMNS:
+            dtype = '<i8' if name in INT_COLUMNS else '<u4'
+            pos = _align(pos)
+            self.columns[name] = np.frombuffer(mapped, dtype=dtype, count=count, offset=pos)
+            pos += count * np.dtype(dtype).itemsize
+        pos = _align(pos)
+        self._string_ends = np.frombuffer(mapped, dtype='<u8', count=string_count + 1, offset=pos)
+        self._blob = pos + (string_count + 1) * 8
+        self._strings = [None] * string_count
+        self.offsets = self.columns['offset']
+
+    @classmethod
+    def open(cls, path, inode, generation):
+        """Map the snapshot at ``path`` if it was made for this CSV version.
+
+        Returns:
+            Snapshot | None: None if missing, for another file, or unreadable
+        """
+        try:
+            with open(path, 'rb') as f:
+                head = f.read(_HEADER.size)
+                if len(head) < _HEADER.size:
+                    return None
+                (magic, version, count, string_count, snap_inode, snap_generation,
+                 covered) = _HEADER.unpack(head)
+                if (magic != MAGIC or version != FORMAT_VERSION
+                        or (snap_inode, snap_generation) != (inode, generation)):
+                    return None
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            return None
+        try:
+            return cls(mapped, inode, generation, covered, count, string_count)
+        except ValueError:
+            # Truncated file: a column runs past the end of the mapping
+            return None
+
+    def __len__(self):
+        return self.count
+
+    def _decode(self, refs, intern=False):
+        """Return the string table as a list with at least ``refs`` decoded."""
+        table = self._strings
+        for ref in np.unique(refs).tolist():
+            if table[ref] is None:
+                start = self._blob + int(self._string_ends[ref])
+                end = self._blob + int(self._string_ends[ref + 1])
+                value = self._mmap[start:end].decode('utf-8')
+                table[ref] = sys.intern(value) if intern else value
+        return table
+
+    def live_indices(self, live):
+        """Indices of rows whose CSV offset is still live, in offset order."""
+        if not self.count:
+            return np.empty(0, dtype=np.intp)
+        live_offsets = np.fromiter(live, dtype=np.int64, count=len(live))
+        return np.flatnonzero(np.isin(self.offsets, live_offsets))
+
+    def find(self, offset):
+        """Index of the row stored at CSV ``offset``, or None."""
+        i = int(np.searchsorted(self.offsets, offset))
+        if i < self.count and self.offsets[i] == offset:
+            return i
+        return None
+
+    def dates(self, indices, name='date_time'):
+        # numpy converts datetime64[us] to naive datetime objects in C
+        return self.columns[name][indices].astype('datetime64[us]').tolist()
+
+    def strings(self, indices, name):
+        refs = self.columns[name][indices]
+        table = self._decode(refs, intern=name in INTERNED_COLUMNS)
+        return list(map(table.__getitem__, refs.tolist()))
+
+    def transactions(self, indices, model):
+        """Build ``model`` objects for the rows at ``indices``.
+
+        The objects' slots are filled straight from the columns, without
+        going through ``model.__init__``.
+        """
+        date_times, created, updated = (self.dates(indices, name) for name in DATE_COLUMNS)
+        amounts, withdrawals, deposits, balances = (
+            [None if v == NULL else v for v in self.columns[name][indices].tolist()]
+            for name in AMOUNT_COLUMNS
+        )
+        strings = [self.strings(indices, name) for name in STRING_COLUMNS]
+
+        result = []
+        new = object.__new__
+        for (date_time, created_at, updated_at, amount, withdrawal, deposit, balance,
+             id_, user_id, transaction_type, detail, extra, branch, line_text, explanation,
+             category) in zip(date_times, created, updated, amounts, withdrawals, deposits,
+                              balances, *strings):
+            t = new(model)
+            t.id = id_
+            t.user_id = user_id
+            t.date_time = date_time
+            t.transaction_type = transaction_type
+            t.detail = detail
+            t._amount = amount
+            t.extra = extra
+            t._withdrawal = withdrawal
+            t._deposit = deposit
+            t._balance = balance
+            t.branch = branch
+            t.line_text = line_text
+            t.explanation = explanation
+            t.category = category or None
+            t.created_at = created_at
+            t.updated_at = updated_at
+            result.append(t)
+        return result
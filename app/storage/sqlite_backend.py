@@ -0,0 +1,241 @@
+import contextlib
+import json
+
+from sqlalchemy import event, tuple_
+
+from .. import db
+from ..services.user_summary import UserSummary, latest_key
+from ..utils.dates import parse_date_time, parse_timestamp
+
+transaction_table = db.Table(
+    'user_transaction',
+    db.Column('id', db.String(64), primary_key=True),
+    db.Column('user_id', db.String(64), nullable=False),
+    db.Column('date_time', db.DateTime),
+    db.Column('transaction_type', db.String(100)),
+    db.Column('detail', db.Text),
+    db.Column('amount', db.Float),
+    db.Column('extra', db.String(50)),
+    db.Column('withdrawal', db.String(32)),
+    db.Column('deposit', db.String(32)),
+    db.Column('balance', db.String(32)),
+    db.Column('branch', db.String(50)),
+    db.Column('line_text', db.Text),
+    db.Column('explanation', db.Text),
+    db.Column('category', db.String(50)),
+    db.Column('created_at', db.DateTime),
+    db.Column('updated_at', db.DateTime),
+    db.Index('ix_user_transaction_user_date', 'user_id', 'date_time'),
+    db.Index('ix_user_transaction_user_category', 'user_id', 'category'),
+)
+
+# Each user's UserSummary as JSON, written in the same transaction as the
+# rows it summarizes
+summary_table = db.Table(
+    'user_summary',
+    db.Column('user_id', db.String(64), primary_key=True),
+    db.Column('data', db.Text, nullable=False),
+)
+
+
+def _enable_wal(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
+
+
+class SqliteTransactionStore:
+    """Stores transactions in the app's SQLite database (WAL mode).
+
+    Rows are indexed by id, (user_id, date_time) and (user_id, category), so
+    point reads, edits, deletes and date-range queries never scan a user's
+    whole history. Each user's :class:`UserSummary` is kept in the
+    ``user_summary`` table and updated by every write in the same
+    transaction, so reading it is one primary-key lookup; it is built from
+    the rows the first time it is needed.
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, model, app):
+        self.model = model
+        with app.app_context():
+            self.engine = db.engine
+        if self.engine.dialect.name == 'sqlite':
+            event.listen(self.engine, 'connect', _enable_wal)
+            # Connections opened before the listener was attached
+            self.engine.dispose()
+        transaction_table.create(self.engine, checkfirst=True)
+        summary_table.create(self.engine, checkfirst=True)
+
+    def load(self, user_id, start=None, end=None):
+        with self.engine.connect() as conn:
+            return [self._to_model(row) for row in conn.execute(self._query(user_id, start, end))]
+
+    def iter(self, user_id, start=None, end=None, categories=None):
+        query = self._query(user_id, start, end, categories)
+        with self.engine.connect() as conn:
+            result = conn.execution_options(stream_results=True, yield_per=500).execute(query)
+            for row in result:
+                yield self._to_model(row)
+
+    def page(self, user_id, after=None, limit=50):
+        t = transaction_table
+        query = t.select().where(t.c.user_id == str(user_id))
+        if after is not None:
+            query = query.where(tuple_(t.c.date_time, t.c.id) < tuple_(*after))
+        query = query.order_by(t.c.date_time.desc(), t.c.id.desc()).limit(limit)
+        with self.engine.connect() as conn:
+            for row in conn.execute(query):
+                yield self._to_model(row)
+
+    def summary(self, user_id):
+        s = summary_table
+        with self.engine.connect() as conn:
+            data = conn.execute(s.select().where(s.c.user_id == str(user_id))).first()
+        if data is not None:
+            return UserSummary.from_dict(json.loads(data.data))
+        with self._writing() as conn:
+            return self._summarize(conn, user_id, lambda summary: None)
+
+    def _summarize(self, conn, user_id, change):
+        """Bring a user's stored summary up to date with rows just written.
+
+        Called in the write's transaction. ``change(summary)`` applies the
+        write to the summary as it was before it, returning the new summary
+        or None if it changed it in place; a missing summary is instead
+        built from the rows as they are now.
+        """
+        s = summary_table
+        key = str(user_id)
+        data = conn.execute(s.select().where(s.c.user_id == key)).first()
+        if data is None:
+            summary = UserSummary.from_transactions(
+                self._to_model(row) for row in conn.execute(self._query(user_id)))
+        else:
+            summary = UserSummary.from_dict(json.loads(data.data))
+            summary = change(summary) or summary
+        if summary.latest is None:
+            t = transaction_table
+            row = conn.execute(t.select().where(t.c.user_id == key)
+                               .order_by(t.c.date_time.desc(), t.c.id.desc()).limit(1)).first()
+            if row is None:
+                summary.set_latest([], 0)
+            else:
+                latest = self._to_model(row)
+                summary.set_latest(latest_key(latest), latest.balance_satang)
+        conn.execute(s.delete().where(s.c.user_id == key))
+        conn.execute(s.insert().values(user_id=key, data=json.dumps(summary.to_dict())))
+        return summary
+
+    def _query(self, user_id, start=None, end=None, categories=None):
+        t = transaction_table
+        query = t.select().where(t.c.user_id == str(user_id))
+        if start is not None:
+            query = query.where(t.c.date_time >= start)
+        if end is not None:
+            query = query.where(t.c.date_time < end)
+        if categories is not None:
+            query = query.where(t.c.category.in_(list(categories)))
+        return query.order_by(t.c.date_time, t.c.id)
+
+    def get_many(self, user_id, ids):
+        with self.engine.connect() as conn:
+            return self._get_many(conn, user_id, ids)
+
+    def _get_many(self, conn, user_id, ids):
+        ids = list(ids)
+        if not ids:
+            return {}
+        t = transaction_table
+        query = t.select().where(t.c.user_id == str(user_id), t.c.id.in_(ids))
+        return {row.id: self._to_model(row) for row in conn.execute(query)}
+
+    def save_all(self, user_id, transactions):
+        with self._writing() as conn:
+            self._replace(conn, user_id, lambda current: transactions)
+
+    def modify(self, user_id, change):
+        """Read-modify-write a user's transactions in one transaction.
+
+        On SQLite the transaction is begun IMMEDIATE, taking the write lock
+        before the read, so no other writer can slip in between.
+        """
+        with self._writing() as conn:
+            return self._replace(conn, user_id, change)
+
+    @contextlib.contextmanager
+    def _writing(self):
+        """A write transaction; on SQLite begun IMMEDIATE, so the summary
+        read at its start can't be changed by another writer before it ends."""
+        if self.engine.dialect.name != 'sqlite':
+            with self.engine.begin() as conn:
+                yield conn
+            return
+        with self.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            conn.exec_driver_sql('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except BaseException:
+                conn.exec_driver_sql('ROLLBACK')
+                raise
+            conn.exec_driver_sql('COMMIT')
+
+    def _replace(self, conn, user_id, change):
+        t = transaction_table
+        transactions = change([self._to_model(row) for row in conn.execute(self._query(user_id))])
+        conn.execute(t.delete().where(t.c.user_id == str(user_id)))
+        if transactions:
+            conn.execute(t.insert(), [self._to_row(user_id, tr) for tr in transactions])
+        self._summarize(conn, user_id, lambda summary: UserSummary.from_transactions(transactions))
+        return transactions
+
+    def append(self, user_id, transactions):
+        with self._writing() as conn:
+            conn.execute(transaction_table.insert(), [self._to_row(user_id, tr) for tr in transactions])
+
+            def add(summary):
+                for tr in transactions:
+                    summary.add(tr)
+            self._summarize(conn, user_id, add)
+
+    def update(self, user_id, transactions):
+        t = transaction_table
+        with self._writing() as conn:
+            old = self._get_many(conn, user_id, [tr.id for tr in transactions])
+            for tr in transactions:
+                row = self._to_row(user_id, tr)
+                conn.execute(t.update().where(t.c.user_id == row['user_id'], t.c.id == row['id']).values(**row))
+
+            def replace(summary):
+                for tr in transactions:
+                    if tr.id in old:
+                        summary.replace(old[tr.id], tr)
+            self._summarize(conn, user_id, replace)
+
+    def delete(self, user_id, ids):
+        ids = list(ids)
+        if not ids:
+            return 0
+        t = transaction_table
+        with self._writing() as conn:
+            old = self._get_many(conn, user_id, ids)
+            result = conn.execute(t.delete().where(t.c.user_id == str(user_id), t.c.id.in_(ids)))
+
+            def remove(summary):
+                for tr in old.values():
+                    summary.remove(tr)
+            self._summarize(conn, user_id, remove)
+            return result.rowcount
+
+    def _to_row(self, user_id, transaction):
+        row = transaction.to_dict()
+        row['user_id'] = str(user_id)
+        row['date_time'] = parse_date_time(row['date_time'])
+        row['created_at'] = parse_timestamp(row['created_at'])
+        row['updated_at'] = parse_timestamp(row['updated_at'])
+        return row
+
+    def _to_model(self, row):
+        return self.model(**row._mapping)
@@ -0,0 +1,137 @@
+import csv
+import io
+import os
+import threading
+
+
+class SchemaMismatchError(ValueError):
+    """Raised when rows do not fit the header of the file they are appended to."""
+
+
+class _Pending:
+    __slots__ = ('rows', 'done', 'error')
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.done = False
+        self.error = None
+
+
+class _FileState:
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.pending = []
+        self.writing = False
+        # Appends using this state; it is dropped when the last one ends
+        self.users = 0
+
+
+class CsvAppender:
+    """Append-only CSV writer with group commit.
+
+    Rows are only ever added at the end of a file; the header is written when
+    the file is new or empty. Threads appending to the same file at the same
+    time are batched: whichever arrives first writes everything queued so far
+    with a single write and fsync, and the others wait for that commit.
+    Per-file state is kept only while appends to the file are in flight.
+    """
+
+    def __init__(self, fieldnames, fsync=True):
+        self.fieldnames = list(fieldnames)
+        self.fsync = fsync
+        self._states = {}
+        self._states_lock = threading.Lock()
+
+    def append(self, file_path, rows):
+        """Append rows to a CSV file, creating it with a header if needed.
+
+        Args:
+            file_path (Path | str): File to append to
+            rows (list[dict]): Rows keyed by column name
+
+        Raises:
+            SchemaMismatchError: If a row has columns the file's header lacks
+        """
+        if not rows:
+            return
+        key = os.path.abspath(file_path)
+        state = self._acquire(key)
+        try:
+            self._append(state, file_path, rows)
+        finally:
+            self._release(key, state)
+
+    def _append(self, state, file_path, rows):
+        mine = _Pending(rows)
+        with state.cond:
+            state.pending.append(mine)
+            while not mine.done and state.writing:
+                state.cond.wait()
+            if mine.done:
+                if mine.error:
+                    raise mine.error
+                return
+            batch, state.pending = state.pending, []
+            state.writing = True
+
+        error = None
+        try:
+            self._write(file_path, [row for p in batch for row in p.rows])
+        except Exception as e:
+            error = e
+
+        with state.cond:
+            for p in batch:
+                p.done = True
+                p.error = error
+            state.writing = False
+            state.cond.notify_all()
+        if error:
+            raise error
+
+    def _acquire(self, key):
+        with self._states_lock:
+            state = self._states.get(key)
+            if state is None:
+                state = self._states[key] = _FileState()
+            state.users += 1
+            return state
+
+    def _release(self, key, state):
+        with self._states_lock:
+            state.users -= 1
+            if not state.users:
+                del self._states[key]
+
+    def _write(self, file_path, rows):
+        os.makedirs(os.path.dirname(os.path.abspath(file_path)), exist_ok=True)
+        with open(file_path, 'a+', newline='', encoding='utf-8') as f:
+            f.seek(0, os.SEEK_END)
+            new_file = f.tell() == 0
+            if new_file:
+                fieldnames = self.fieldnames
+            else:
+                f.seek(0)
+                fieldnames = next(csv.reader([f.readline()]), [])
+                self._check_schema(file_path, fieldnames, rows)
+
+            buf = io.StringIO()
+            writer = csv.DictWriter(buf, fieldnames=fieldnames, restval='')
+            if new_file:
+                writer.writeheader()
+            writer.writerows(rows)
+
+            # 'a' mode always writes at the end of the file, whatever the
+            # read position, so the header check above does not interfere.
+            f.write(buf.getvalue())
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+
+    def _check_schema(self, file_path, fieldnames, rows):
+        missing = set(self.fieldnames).difference(fieldnames)
+        for row in rows:
+            missing.update(k for k in row if k not in fieldnames)
+        if missing:
+            raise SchemaMismatchError(
+                f"{file_path} header is missing columns: {', '.join(sorted(missing))}")
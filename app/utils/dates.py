@@ -0,0 +1,119 @@
+from datetime import datetime
+
+
+def parse_date_time(value):
+    """Parse a transaction's date_time as stored in CSV or entered in forms.
+
+    Accepts ISO strings and the statement formats ``dd/mm/yy HH:MM`` and
+    ``dd/mm/yy``. Falls back to the current time if nothing matches.
+    """
+    if isinstance(value, datetime):
+        return value
+    try:
+        # Try ISO format first
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        pass
+    try:
+        # Try custom format with time
+        return datetime.strptime(value, '%d/%m/%y %H:%M')
+    except (TypeError, ValueError):
+        pass
+    try:
+        # Try custom format without time
+        return datetime.strptime(value, '%d/%m/%y')
+    except (TypeError, ValueError):
+        # Fallback to current time if all formats fail
+        return datetime.now()
+
+
+def parse_timestamp(value):
+    """Parse a created_at/updated_at value, falling back to the current time."""
+    if isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f')
+    except (TypeError, ValueError):
+        return datetime.now()
+
+
+def _year(yy):
+    # Same pivot as strptime's %y: 69-99 -> 1900s, 00-68 -> 2000s
+    return 1900 + yy if yy >= 69 else 2000 + yy
+
+
+def _parse_dmy_hm(value):
+    """Parse exactly ``dd/mm/yy HH:MM`` by slicing."""
+    if len(value) != 14 or value[2] != '/' or value[5] != '/' or value[8] != ' ' or value[11] != ':':
+        raise ValueError(value)
+    return datetime(_year(int(value[6:8])), int(value[3:5]), int(value[0:2]),
+                    int(value[9:11]), int(value[12:14]))
+
+
+def _parse_dmy(value):
+    """Parse exactly ``dd/mm/yy`` by slicing."""
+    if len(value) != 8 or value[2] != '/' or value[5] != '/':
+        raise ValueError(value)
+    return datetime(_year(int(value[6:8])), int(value[3:5]), int(value[0:2]))
+
+
+# Candidate fast parsers, most common first. datetime.fromisoformat also
+# covers the '%Y-%m-%d %H:%M:%S.%f' form written by str(datetime).
+DATE_TIME_FORMATS = [
+    ('iso', datetime.fromisoformat),
+    ('dd/mm/yy HH:MM', _parse_dmy_hm),
+    ('dd/mm/yy', _parse_dmy),
+]
+TIMESTAMP_FORMATS = [
+    ('iso', datetime.fromisoformat),
+]
+
+
+class DateColumnParser:
+    """Parses one CSV column using a format detected from sample values.
+
+    :meth:`detect` picks the candidate format that parses the most
+    non-empty samples. After that each value costs one call to that fast
+    parser; only values it rejects go through the slow ``fallback`` chain,
+    and those are counted in ``fallbacks``.
+    """
+
+    def __init__(self, formats, fallback):
+        self.formats = formats
+        self.fallback = fallback
+        self.format_name = None
+        self._fast = None
+        self.fallbacks = 0
+
+    def detect(self, samples):
+        samples = [s for s in samples if s]
+        best, best_hits = None, 0
+        for name, parse in self.formats:
+            hits = 0
+            for sample in samples:
+                try:
+                    parse(sample)
+                    hits += 1
+                except (TypeError, ValueError):
+                    pass
+            if hits > best_hits:
+                best, best_hits = (name, parse), hits
+            if hits == len(samples):
+                break
+        if best is None:
+            return None
+        self.format_name, self._fast = best
+        return self.format_name
+
+    def parse(self, value):
+        if self._fast is not None:
+            try:
+                return self._fast(value)
+            except (TypeError, ValueError):
+                pass
+        self.fallbacks += 1
+        return self.fallback(value)
@@ -0,0 +1,103 @@
+import contextlib
+import os
+
+try:
+    import fcntl
+except ImportError:  # Windows: no advisory locks, single-process use only
+    fcntl = None
+
+
+@contextlib.contextmanager
+def file_lock(path, shared=False):
+    """Hold a shared or exclusive ``flock`` on ``path`` for the block.
+
+    The lock file is created if needed and never removed. Locks are taken
+    on a dedicated file rather than the data file, because data files are
+    replaced by rename and a lock on the old inode would not exclude
+    writers of the new one. flock locks belong to the open file, so they
+    also exclude other threads of the same process.
+
+    Yields the lock file's descriptor.
+
+    Args:
+        path (Path | str): Lock file
+        shared (bool): Take a shared lock instead of an exclusive one
+    """
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        yield fd
+    finally:
+        # Closing the descriptor releases the lock
+        os.close(fd)
+
+
+# The lock file's first 8 bytes hold a counter: a sequence for
+# increment_counter, or for rewriting() a generation of the file it guards,
+# used as a seqlock that is odd while a rewrite is being published.
+
+def _read_counter(fd):
+    os.lseek(fd, 0, os.SEEK_SET)
+    return int.from_bytes(os.read(fd, 8).ljust(8, b'\0'), 'little')
+
+
+def _write_counter(fd, value):
+    os.lseek(fd, 0, os.SEEK_SET)
+    os.write(fd, value.to_bytes(8, 'little'))
+
+
+def increment_counter(fd, floor=0):
+    """Advance the counter of a lock file held exclusively and return it.
+
+    Args:
+        fd (int): Descriptor yielded by :func:`file_lock`
+        floor (int): The result is always greater than this
+
+    Returns:
+        int: The new counter value
+    """
+    value = max(_read_counter(fd), floor) + 1
+    _write_counter(fd, value)
+    return value
+
+
+@contextlib.contextmanager
+def rewriting(path):
+    """Exclusively lock ``path`` while the guarded file is replaced.
+
+    The generation is made odd for the duration and even again after, so
+    readers can tell that a version they read was replaced underneath them
+    even if the new file happens to get the old one's inode.
+    """
+    with file_lock(path) as fd:
+        generation = _read_counter(fd)
+        generation += 1 if generation % 2 == 0 else 2
+        _write_counter(fd, generation)
+        try:
+            yield
+        finally:
+            _write_counter(fd, generation + 1)
+
+
+def read_generation(path):
+    """Return the guarded file's current generation, or None mid-rewrite.
+
+    Takes no lock unless the generation is odd, in which case a
+    non-blocking probe tells a rewrite in progress (None) from one that
+    crashed before finishing (the odd value is then stable).
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        return 0
+    try:
+        generation = _read_counter(fd)
+        if generation % 2 and fcntl is not None:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+        return generation
+    finally:
+        os.close(fd)
@@ -0,0 +1,28 @@
+import math
+
+
+def to_satang(value):
+    """Convert a baht amount such as ``'1,234.50'`` to integer satang.
+
+    Empty or unparseable values count as zero.
+    """
+    if not value:
+        return 0
+    if isinstance(value, int):
+        return value * 100
+    if isinstance(value, str):
+        value = value.replace(',', '')
+    try:
+        satang = float(value) * 100
+    except (TypeError, ValueError):
+        return 0
+    # 'inf', 'nan' and exponents past the float range ('1e400') parse, but
+    # have no integer value
+    return int(round(satang)) if math.isfinite(satang) else 0
+
+
+def format_satang(satang):
+    """Format integer satang as a baht string such as ``'1,234.50'``."""
+    sign = '-' if satang < 0 else ''
+    baht, satang = divmod(abs(satang), 100)
+    return f"{sign}{baht:,}.{satang:02d}"
@@ -0,0 +1,127 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, check_password_hash, generate_password_hash
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_METHOD = 'pbkdf2:sha256:600000'
+DEFAULT_WORKERS = 2
+
+# Werkzeug's scrypt parameters when the method gives none
+DEFAULT_SCRYPT = (2**15, 8, 1)
+
+
+def _cost(method, defaults=True):
+    """Split a Werkzeug method string into its algorithm and a comparable cost.
+
+    Args:
+        method (str): e.g. ``'pbkdf2:sha256:600000'`` or ``'scrypt:32768:8:1'``
+        defaults (bool): Fill in parameters the string leaves out as Werkzeug
+            does when hashing; when False they count as no cost at all
+
+    Returns:
+        tuple[str, int]: The algorithm (with its digest, for PBKDF2) and the
+        PBKDF2 iterations or the scrypt ``n * r * p``
+
+    Raises:
+        ValueError: If the parameters aren't numbers
+    """
+    name, *args = method.split(':')
+    if name == 'pbkdf2':
+        digest = args[0] if args else 'sha256'
+        if len(args) > 1:
+            return f'pbkdf2:{digest}', int(args[1])
+        return f'pbkdf2:{digest}', DEFAULT_PBKDF2_ITERATIONS if defaults else 0
+    if name == 'scrypt':
+        n, r, p = map(int, args) if args else (DEFAULT_SCRYPT if defaults else (0, 0, 0))
+        return 'scrypt', n * r * p
+    return method, 0
+
+
+class PasswordHasher:
+    """Hashes and verifies passwords on a bounded pool of worker threads.
+
+    Werkzeug's PBKDF2 and scrypt run inside hashlib, which releases the GIL,
+    so the pool size caps how many cores password work can take however
+    many requests are logging in at once; other requests keep being served
+    while the rest queue. ``method`` is a Werkzeug method string such as
+    ``'pbkdf2:sha256:600000'`` or ``'scrypt:32768:8:1'``, which sets the
+    cost of new hashes.
+
+    Time spent queueing and hashing is recorded per operation and reported
+    by :meth:`stats`.
+    """
+
+    def __init__(self, method=DEFAULT_METHOD, workers=DEFAULT_WORKERS):
+        self.method = method
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password')
+        self._cost = _cost(method)
+        self._lock = threading.Lock()
+        self._stats = {name: {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'wait_seconds': 0.0}
+                       for name in ('hash', 'verify')}
+
+    def configure(self, method, workers):
+        """Change the hash method and the number of worker threads."""
+        with self._lock:
+            old = self._executor
+            self.method = method
+            self._cost = _cost(method)
+            self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password')
+        old.shutdown(wait=False)
+
+    def hash(self, password):
+        """Return a new hash of ``password`` at the configured cost."""
+        return self._run('hash', generate_password_hash, password, self.method)
+
+    def verify(self, password_hash, password):
+        """Return whether ``password`` matches ``password_hash``."""
+        if not password_hash:
+            return False
+        return self._run('verify', check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """Return whether a hash is weaker than the configured method makes.
+
+        Hashes from the configured algorithm are rehashed only when their
+        cost (PBKDF2 iterations, or scrypt ``n * r * p``) is lower, so a
+        stronger hash is never downgraded. Hashes from another algorithm or
+        digest are rehashed so a change of method takes effect, as are ones
+        whose method can't be parsed.
+        """
+        algorithm, cost = self._cost
+        try:
+            stored_algorithm, stored_cost = _cost(password_hash.split('$', 1)[0], defaults=False)
+        except ValueError:
+            return True
+        return stored_algorithm != algorithm or stored_cost < cost
+
+    def _run(self, name, func, *args):
+        queued = time.perf_counter()
+
+        def timed():
+            started = time.perf_counter()
+            result = func(*args)
+            return result, started, time.perf_counter()
+
+        with self._lock:
+            executor = self._executor
+        result, started, finished = executor.submit(timed).result()
+        with self._lock:
+            stats = self._stats[name]
+            stats['count'] += 1
+            stats['seconds'] += finished - started
+            stats['max_seconds'] = max(stats['max_seconds'], finished - started)
+            stats['wait_seconds'] += started - queued
+        logger.debug(f"Password {name} took {finished - started:.3f}s after {started - queued:.3f}s queued")
+        return result
+
+    def stats(self):
+        """Return count, total/max hashing time and total queueing time per operation."""
+        with self._lock:
+            return {name: dict(stats) for name, stats in self._stats.items()}
+
+
+password_hasher = PasswordHasher()
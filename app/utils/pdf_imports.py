@@ -1 +1,381 @@
+import io
+import logging
+import math
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 
+import pdfplumber
+
+try:
+    import pypdf
+except ImportError:
+    try:
+        import PyPDF2 as pypdf  # pypdf's name before 3.0
+    except ImportError:
+        pypdf = None
+
+try:
+    import fitz  # PyMuPDF
+except ImportError:
+    fitz = None
+
+logger = logging.getLogger(__name__)
+
+# Statements with fewer pages are extracted in-process; the pool round
+# trip would cost more than it saves
+PARALLEL_MIN_PAGES = 4
+
+# Passed to pdfplumber's Page.extract_text and Page.extract_words
+EXTRACT_OPTIONS = {'x_tolerance': 1, 'y_tolerance': 1}
+
+# Backend setting that picks the engine by measured speed and output
+AUTO = 'auto'
+
+
+def page_text(page):
+    """The default page reader: the page's text, '' if it has none."""
+    return page.extract_text(**EXTRACT_OPTIONS) or ''
+
+
+def _open(source):
+    # Something each engine can open: bytes (as sent to pool workers) are
+    # wrapped, files rewound
+    if isinstance(source, bytes):
+        return io.BytesIO(source)
+    if hasattr(source, 'read'):
+        source.seek(0)
+    return source
+
+
+def _pdfplumber_count(source):
+    with pdfplumber.open(_open(source)) as pdf:
+        return len(pdf.pages)
+
+
+def _pdfplumber_read(source, start, stop, on_page, reader=page_text):
+    # Each page's cached layout objects are released as soon as it has been
+    # read, so memory stays bounded by one page whatever the statement's length
+    texts = []
+    with pdfplumber.open(_open(source)) as pdf:
+        for page in pdf.pages[start:stop]:
+            texts.append(reader(page))
+            page.flush_cache()
+            on_page(1)
+    return texts
+
+
+def _pypdf_count(source):
+    return len(pypdf.PdfReader(_open(source)).pages)
+
+
+def _pypdf_read(source, start, stop, on_page, reader=None):
+    pages = pypdf.PdfReader(_open(source)).pages
+    texts = []
+    for index in range(start, stop):
+        texts.append(pages[index].extract_text() or '')
+        on_page(1)
+    return texts
+
+
+def _pymupdf_open(source):
+    source = _open(source)
+    if hasattr(source, 'read'):
+        return fitz.open(stream=source.read(), filetype='pdf')
+    return fitz.open(source)
+
+
+def _pymupdf_count(source):
+    with _pymupdf_open(source) as doc:
+        return doc.page_count
+
+
+def _pymupdf_read(source, start, stop, on_page, reader=None):
+    texts = []
+    with _pymupdf_open(source) as doc:
+        for index in range(start, stop):
+            texts.append(doc[index].get_text())
+            on_page(1)
+    return texts
+
+
+class Backend:
+    """A PDF text extraction engine.
+
+    Attributes:
+        name (str): Name used in config and stats
+        available (bool): Whether its package is installed
+        count (callable): ``count(source)`` returns the number of pages
+        read (callable): ``read(source, start, stop, on_page, reader)``
+            returns the text of pages ``start`` to ``stop`` (exclusive),
+            calling ``on_page(1)`` after each
+        readers (bool): Whether ``read`` takes a page reader. Only
+            pdfplumber does; its pages carry the word positions readers
+            such as read_page_columns need
+    """
+
+    def __init__(self, name, available, count, read, readers=False):
+        self.name = name
+        self.available = available
+        self.count = count
+        self.read = read
+        self.readers = readers
+
+
+# Every engine known, in order of preference among those not yet measured
+BACKENDS = {
+    'pymupdf': Backend('pymupdf', fitz is not None, _pymupdf_count, _pymupdf_read),
+    'pdfplumber': Backend('pdfplumber', True, _pdfplumber_count, _pdfplumber_read, readers=True),
+    'pypdf': Backend('pypdf', pypdf is not None, _pypdf_count, _pypdf_read),
+}
+
+
+def _extract_range(backend, source, start, stop, on_page=None, reader=page_text):
+    """Read pages ``start`` to ``stop`` (exclusive) of a PDF with ``backend``.
+
+    Runs in a pool worker, so it opens the PDF itself (``source`` is a path,
+    the PDF's bytes or, in-process, a binary file).
+
+    Returns:
+        tuple: The pages' results and the seconds spent reading them
+    """
+    started = time.perf_counter()
+    texts = BACKENDS[backend].read(source, start, stop, on_page or (lambda count: None), reader)
+    return texts, time.perf_counter() - started
+
+
+def _count_lines(texts):
+    return sum(1 for text in texts for line in text.split('\n') if line.strip())
+
+
+class PageExtractor:
+    """Extracts the text of every page of a PDF over a process pool.
+
+    Pages are split into contiguous ranges, one task per range, and the
+    results are put back together in page order. PDF layout analysis is
+    pure Python and CPU bound, so separate processes are what lets a long
+    statement use more than one core.
+
+    The engine is one of BACKENDS. With ``backend`` AUTO, every installed
+    engine is first tried on the first page of a statement: those whose
+    text yields fewer usable lines than the best are marked as not working,
+    and the rest are ranked by seconds per page, which every later
+    extraction keeps measuring. Engines are tried once: one that raises
+    then is left out from then on. An engine that raises on a later
+    statement is recorded as such and the next one is used. ``overrides`` maps text found on a
+    statement's first page, such as a bank's name or web address, to the
+    engine for that bank's statements.
+    """
+
+    def __init__(self, workers=None, backend=AUTO, overrides=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.backend = backend
+        self.overrides = dict(overrides or {})
+        self._executor = None
+        self._lock = threading.Lock()
+        self._stats = {name: {'runs': 0, 'pages': 0, 'seconds': 0.0, 'errors': 0, 'accepted': 0, 'rejected': 0,
+                              'calibrated': False, 'failed': False}
+                       for name in BACKENDS}
+
+    def configure(self, workers, backend=AUTO, overrides=None):
+        """Change the number of worker processes (None: one per CPU) and the engine.
+
+        Args:
+            workers (int): Worker processes, None for one per CPU
+            backend (str): A BACKENDS name, or AUTO
+            overrides (dict): First-page text to the BACKENDS name used for
+                statements containing it
+        """
+        overrides = dict(overrides or {})
+        for name in [backend, *overrides.values()]:
+            if name != AUTO and name not in BACKENDS:
+                raise ValueError(f"Unknown PDF backend {name!r}; expected {AUTO!r} or one of {tuple(BACKENDS)}")
+            if name != AUTO and not BACKENDS[name].available:
+                logger.warning(f"PDF backend {name!r} is not installed; choosing automatically instead")
+        with self._lock:
+            old, self._executor = self._executor, None
+            self.workers = workers or os.cpu_count() or 1
+            self.backend = backend
+            self.overrides = overrides
+        if old is not None:
+            old.shutdown(wait=False)
+
+    def extract_pages(self, source, progress=None, reader=page_text, score=None):
+        """Return the text of each page of the PDF at ``source``, in order.
+
+        Pages without text come back as empty strings.
+
+        Args:
+            source (str | Path | file): Path of the PDF, or a seekable
+                binary file such as a spooled upload
+            progress (callable): Called as ``progress(pages_done, page_count)``
+                as pages are extracted
+            reader (callable): Called with each pdfplumber page to produce
+                its result instead of the text. Must be a module-level
+                function, so that pool workers can run it. Implies the
+                pdfplumber engine
+            score (callable): Called with a list of page texts, returns how
+                many usable lines they hold; engines are compared by it.
+                Defaults to counting non-blank lines
+        """
+        if reader is not page_text:
+            candidates = [name for name, backend in BACKENDS.items() if backend.readers]
+        else:
+            candidates = self._candidates(source, score or _count_lines)
+
+        for index, backend in enumerate(candidates):
+            try:
+                return self._extract(backend, source, progress, reader)
+            except Exception as e:
+                # PDF engines raise all sorts on files they can't handle
+                with self._lock:
+                    self._stats[backend]['errors'] += 1
+                if index == len(candidates) - 1:
+                    raise
+                logger.warning(f"PDF backend {backend} failed on {source}, trying {candidates[index + 1]}: {e}")
+
+    def _candidates(self, source, score):
+        # Engines to try, best first
+        with self._lock:
+            backend, overrides = self.backend, self.overrides
+        if backend != AUTO and BACKENDS[backend].available:
+            return [backend]
+        with self._lock:
+            uncalibrated = any(not stats['calibrated'] for name, stats in self._stats.items()
+                               if BACKENDS[name].available)
+        if uncalibrated:
+            self._calibrate(source, score)
+        ranked = self.ranking()
+        if overrides:
+            try:
+                first_page = self._timed(ranked[0], source, 0, 1)[0][0].casefold()
+            except Exception as e:
+                logger.warning(f"Could not read the first page of {source} to match PDF backend overrides: {e}")
+                return ranked
+            for marker, name in overrides.items():
+                if name in ranked and marker.casefold() in first_page:
+                    logger.debug(f"Statement {source} matches {marker!r}, extracting with {name}")
+                    return [name] + [other for other in ranked if other != name]
+        return ranked
+
+    def _calibrate(self, source, score):
+        # Read the first page with every engine, timing each and comparing
+        # how much of its text parses. Each engine is tried once, whatever
+        # the outcome, except on a statement without pages
+        scores = {}
+        for name, backend in BACKENDS.items():
+            if not backend.available or self._stats[name]['calibrated']:
+                continue
+            try:
+                if backend.count(source) == 0:
+                    return
+                texts, _ = self._timed(name, source, 0, 1)
+            except Exception as e:
+                logger.warning(f"PDF backend {name} failed on the first page of {source}: {e}")
+                with self._lock:
+                    self._stats[name].update(calibrated=True, failed=True)
+                    self._stats[name]['errors'] += 1
+                continue
+            with self._lock:
+                self._stats[name]['calibrated'] = True
+            scores[name] = score(texts)
+        best = max(scores.values(), default=0)
+        if best == 0:
+            # Nothing on the page parses, so it says nothing of which engine works
+            return
+        with self._lock:
+            for name, lines in scores.items():
+                self._stats[name]['accepted' if lines == best else 'rejected'] += 1
+        logger.info(f"PDF backends calibrated on {source}: usable lines {scores}")
+
+    def ranking(self):
+        """Installed engines, best first.
+
+        Engines that raised when first tried are left out, unless every one
+        did. Working engines come before ones that more often failed or fell
+        short of the others' output than not; then the cheapest per page
+        measured, then those not yet measured in BACKENDS order.
+        """
+        preference = list(BACKENDS)
+        with self._lock:
+            def key(name):
+                stats = self._stats[name]
+                failing = stats['errors'] + stats['rejected'] > stats['accepted']
+                per_page = stats['seconds'] / stats['pages'] if stats['pages'] else math.inf
+                return failing, per_page, preference.index(name)
+            available = [name for name, backend in BACKENDS.items() if backend.available]
+            usable = [name for name in available if not self._stats[name]['failed']] or available
+            return sorted(usable, key=key)
+
+    def _timed(self, backend, source, start, stop, on_page=None, reader=page_text):
+        # _extract_range in-process, recording its cost
+        texts, seconds = _extract_range(backend, source, start, stop, on_page, reader)
+        self._record(backend, stop - start, seconds)
+        return texts, seconds
+
+    def _record(self, backend, pages, seconds):
+        with self._lock:
+            stats = self._stats[backend]
+            stats['pages'] += pages
+            stats['seconds'] += seconds
+
+    def _extract(self, backend, source, progress, reader):
+        page_count = BACKENDS[backend].count(source)
+        done = 0
+
+        def on_pages(count):
+            nonlocal done
+            done += count
+            if progress is not None:
+                progress(done, page_count)
+
+        with self._lock:
+            self._stats[backend]['runs'] += 1
+        logger.debug(f"Extracting {page_count} pages of {source} with {backend}")
+        if page_count < PARALLEL_MIN_PAGES or self.workers < 2:
+            return self._timed(backend, source, 0, page_count, on_pages, reader)[0]
+
+        # A couple of ranges per worker evens out pages of uneven cost
+        size = math.ceil(page_count / (self.workers * 2))
+        ranges = [(start, min(start + size, page_count)) for start in range(0, page_count, size)]
+        if hasattr(source, 'read'):
+            # Workers can't share an open file; they get its contents
+            source.seek(0)
+            task_source = source.read()
+        else:
+            task_source = str(source)
+        try:
+            futures = {self._pool().submit(_extract_range, backend, task_source, start, stop, None, reader): stop - start
+                       for start, stop in ranges}
+            for future in as_completed(futures):
+                on_pages(futures[future])
+            results = [future.result() for future in futures]
+        except BrokenProcessPool as e:
+            logger.warning(f"PDF extraction pool failed, extracting {source} in-process: {e}")
+            with self._lock:
+                self._executor = None
+            done = 0
+            return self._timed(backend, source, 0, page_count, on_pages, reader)[0]
+        # Worker seconds, not wall time, so engines compare the same however
+        # the pages were spread
+        self._record(backend, page_count, sum(seconds for _, seconds in results))
+        return [text for texts, _ in results for text in texts]
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            return self._executor
+
+    def stats(self):
+        """Return per-engine runs, pages, seconds and outcomes, and the ranking."""
+        ranking = self.ranking()
+        with self._lock:
+            backends = {name: dict(stats, available=BACKENDS[name].available)
+                        for name, stats in self._stats.items()}
+        return {'backend': self.backend, 'ranking': ranking, 'backends': backends}
+
+
+page_extractor = PageExtractor()
@@ -1,188 +1,207 @@
+import functools
+import hashlib
+import logging
 import re
-from typing import Dict, Any
-import PyPDF2
-from app.models.transaction import Transaction
+import sys
+from app.models.transaction import categorize
+from app.utils.money import format_satang, to_satang
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever extraction or parsing output changes; cached statements
+# parsed by another version are ignored
+PARSER_VERSION = 1
+
+DATE_PATTERN = re.compile(r'\d{2}/\d{2}/\d{2}')
+TIME_PATTERN = re.compile(r'\d{1,2}:\d{2}')
+# Cheap first test: a transaction line starts with a date, possibly after an
+# id. Looser than the token checks below, so it only rejects lines they would
+LINE_START = re.compile(r'\s*(?:\S+\s+)?\d{2}/\d{2}/\d{2}')
+# Amounts such as '1,234.50'; anything else falls back to float()
+PLAIN_NUMBER = re.compile(r'[\d,]*\.?\d+')
+# Characters float() can accept at the start of a number, besides digits
+NUMBER_STARTS = frozenset('+-.,nNiI')
+# Amounts already written the way format_satang writes them
+CANONICAL_AMOUNT = re.compile(r'(?:0|[1-9][0-9]{0,2}(?:,[0-9]{3})*)\.[0-9]{2}')
+
+# Words in a line's description that mark money coming in or going out;
+# lines with neither count as deposits
+DEPOSIT_WORDS = ("รับเงิน", "โอนเงินเข้า")
+WITHDRAWAL_WORDS = ("จ่าย", "โอนเงินออก")
+_deposit_search = re.compile('|'.join(DEPOSIT_WORDS)).search
+_withdrawal_search = re.compile('|'.join(WITHDRAWAL_WORDS)).search
+
+# Keys of a parsed line, in order
+RESULT_FIELDS = ('id', 'date_time', 'transaction', 'details', 'extra', 'withdrawal',
+                 'deposit', 'balance', 'branch', 'line_text', 'category')
+
+# Statements repeat the same counterparties, so categories are memoized
+_categorize = functools.lru_cache(maxsize=4096)(categorize)
 
 def is_numeric(token):
+    if PLAIN_NUMBER.fullmatch(token):
+        return True
+    if token[:1] not in NUMBER_STARTS and not token[:1].isdigit():
+        return False
     try:
         float(token.replace(',', ''))
         return True
     except ValueError:
         return False
 
-def parse_thai_transaction(transaction_str: str) -> Dict[str, Any]:
-    # Regex pattern to extract date, type, detail, and amount
-    pattern = r'(?P<date>\d{2}/\d{2}/\d{2})\s+(?P<type>[^\d]+)\s+(?P<detail>[^\s]+)\s+(?P<amount>\d+\.\d{2})'
-    match = re.search(pattern, transaction_str)
-    
-    if not match:
-        return None
-        
-    result = match.groupdict()
-    result['amount'] = float(result['amount'])
-    
-    # Automatically categorize transaction during parsing
-    result['category'], result['confidence'] = auto_categorize_transaction(
-        result['detail'], 
-        result['amount']
-    )
-    
-    return result
 
+def _amount(token):
+    # Same normalization Transaction applies: '1234.5' -> '1,234.50'
+    if not token or CANONICAL_AMOUNT.fullmatch(token):
+        return token
+    return format_satang(to_satang(token))
+
+
+def _is_withdrawal(description_tokens):
+    # The words have no case and no spaces, so the tokens can be searched as is
+    description = " ".join(description_tokens)
+    return not _deposit_search(description) and bool(_withdrawal_search(description))
 
-def categorize_transaction(detail: str, amount: float) -> tuple:
-    # Direct matches
-    if 'eastmallbuy.com' in detail:
-        return 'Shopping', 90
-    if 'MRT-BEM' in detail:
-        return 'Transport', 90
-    if detail.startswith('0107') and amount < 100:
-        return 'Food', 85
-    if 'BILLERID' in detail:
-        return 'Utilities', 90
-    if 'TR fr' in detail:
-        return 'Income', 95
-        
-    # Contextual fallback rules
-    if 30 <= amount <= 70 and 'recurring' in detail.lower():
-        return 'Food', 70
-    if 200 <= amount <= 500 and 'monthly' in detail.lower():
-        return 'Subscription', 65
-        
-    # Default unknown category
-    return 'Unknown', 50
 
 def parse_transaction_line(line):
-    print(f"\nParsing line: {line}")
+    """Parse one line of statement text into a transaction dict.
+
+    Returns:
+        dict | None: The fields in RESULT_FIELDS, or None if the line isn't
+        a transaction
+    """
+    if not LINE_START.match(line):
+        return None
     tokens = line.split()
-    date_pattern = re.compile(r'\d{2}/\d{2}/\d{2}')
-    
+
     # Extract transaction ID if present (e.g., "34" before the date)
     transaction_id = None
-    if tokens and tokens[0].isdigit() and len(tokens) > 1 and date_pattern.match(tokens[1]):
+    if len(tokens) > 1 and tokens[0].isdigit() and DATE_PATTERN.match(tokens[1]):
         transaction_id = tokens[0]
         tokens = tokens[1:]
-        print(f"Found transaction ID: {transaction_id}")
-        
-    if not tokens or not date_pattern.match(tokens[0]):
-        print("Not a transaction line")
+
+    if not tokens or not DATE_PATTERN.match(tokens[0]):
         return None  # Not a transaction line
 
     # Build the date/time field.
     date_time = tokens[0]
     idx = 1
-    time_pattern = re.compile(r'\d{1,2}:\d{2}')
-    if idx < len(tokens) and time_pattern.match(tokens[idx]):
+    if idx < len(tokens) and TIME_PATTERN.match(tokens[idx]):
         date_time += " " + tokens[idx]
         idx += 1
-    print(f"Date/Time: {date_time}")
 
     # Identify numeric tokens from the end.
     num_end = len(tokens)
-    numeric_tokens = []
     while num_end > idx and is_numeric(tokens[num_end - 1]):
-        numeric_tokens.insert(0, tokens[num_end - 1])
         num_end -= 1
-    print(f"Numeric tokens: {numeric_tokens}")
+    return _build(line, transaction_id, date_time, tokens[idx:num_end], tokens[num_end:])
+
 
+def _build(line, transaction_id, date_time, description_tokens, numeric_tokens):
+    # The row for a line already split into its date, description and
+    # trailing numeric tokens, or None if the numbers don't fit a transaction
     extra = ""
     # Process numeric tokens.
-    if len(numeric_tokens) == 4:
-        # Check if the second token looks extraneous (no decimal point)
-        if '.' not in numeric_tokens[1]:
-            extra = numeric_tokens[1]
-            description_section = " ".join(tokens[idx:num_end]).lower()
-            print(f"Description section: {description_section}")
-            if "รับเงิน" in description_section or "โอนเงินเข้า" in description_section:
-                # Deposit transaction: use first token as deposit.
-                withdrawal = ""
-                deposit = numeric_tokens[0]
-                print("Identified as deposit transaction")
-            elif "จ่าย" in description_section or "โอนเงินออก" in description_section:
-                # Withdrawal transaction.
-                withdrawal = numeric_tokens[0]
-                deposit = ""
-                print("Identified as withdrawal transaction")
-            else:
-                # Default to deposit.
-                withdrawal = ""
-                deposit = numeric_tokens[0]
-                print("Defaulting to deposit transaction")
-            balance = numeric_tokens[2]
-            branch = numeric_tokens[3]
+    if len(numeric_tokens) == 4 and '.' not in numeric_tokens[1]:
+        # The second token is extraneous (no decimal point)
+        amount, extra, balance, branch = numeric_tokens
+        if _is_withdrawal(description_tokens):
+            withdrawal, deposit = amount, ""
         else:
-            # If not matching the extraneous pattern, use tokens as is.
-            withdrawal, deposit, balance, branch = numeric_tokens
-            print("Using numeric tokens as is")
+            withdrawal, deposit = "", amount
+    elif len(numeric_tokens) == 4:
+        withdrawal, deposit, balance, branch = numeric_tokens
     elif len(numeric_tokens) == 3:
-        description_section = " ".join(tokens[idx:num_end]).lower()
-        print(f"Description section: {description_section}")
-        if "รับเงิน" in description_section or "โอนเงินเข้า" in description_section:
-            withdrawal = ""
-            deposit, balance, branch = numeric_tokens
-            print("Identified as deposit transaction")
-        elif "จ่าย" in description_section or "โอนเงินออก" in description_section:
-            deposit = ""
-            withdrawal, balance, branch = numeric_tokens
-            print("Identified as withdrawal transaction")
+        amount, balance, branch = numeric_tokens
+        if _is_withdrawal(description_tokens):
+            withdrawal, deposit = amount, ""
         else:
-            withdrawal = ""
-            deposit, balance, branch = numeric_tokens
-            print("Defaulting to deposit transaction")
+            withdrawal, deposit = "", amount
     else:
-        print(f"Invalid number of numeric tokens: {len(numeric_tokens)}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Skipping line with {len(numeric_tokens)} numeric tokens: {line!r}")
         return None  # Does not match expected numeric pattern
 
     # Ensure that if a deposit amount is present then the withdrawal is blank.
     if deposit:
         withdrawal = ""
 
-    # The remaining tokens (from idx to num_end) form the description.
-    description_tokens = tokens[idx:num_end]
+    # The first description token is the transaction, the rest its details.
     if description_tokens:
         transaction_field = description_tokens[0]
-        details = " ".join(description_tokens[1:]) if len(description_tokens) > 1 else ""
+        details = " ".join(description_tokens[1:])
     else:
         transaction_field = ""
         details = ""
-    print(f"Transaction field: {transaction_field}")
-    print(f"Details: {details}")
 
+    return transaction_row(line, transaction_id, date_time, transaction_field, details, extra,
+                           withdrawal, deposit, balance, branch)
+
+
+def transaction_row(line, transaction_id, date_time, transaction_field, details, extra,
+                    withdrawal, deposit, balance, branch):
+    """The parsed row for fields already picked out of a statement line.
+
+    Amounts are normalized, details lowercased and the row categorized, as
+    for parse_transaction_line. Without a ``transaction_id`` one is derived
+    from the fields.
+    """
     # Use the extracted transaction ID or generate a temporary one
     if not transaction_id:
-        # Generate a temporary ID based on the transaction data
-        import hashlib
         id_str = f"{date_time}{transaction_field}{details}{withdrawal}{deposit}{balance}"
         transaction_id = 'temp_' + hashlib.md5(id_str.encode()).hexdigest()[:8]
-        print(f"Generated temporary ID: {transaction_id}")
-    
-    # Create Transaction object and auto-categorize
-    transaction = Transaction(
-        id=transaction_id,
-        date_time=date_time,
-        transaction_type=transaction_field,
-        detail=details,
-        extra=extra,
-        withdrawal=withdrawal,
-        deposit=deposit,
-        balance=balance,
-        branch=branch,
-        line_text=line
-    )
-    transaction.auto_categorize()
-    
+
+    details = details.lower()
     result = {
-        'id': transaction.id,
-        'date_time': transaction.date_time,
-        'transaction': transaction.transaction_type,
-        'details': transaction.detail,
-        'extra': transaction.extra,
-        'withdrawal': transaction.withdrawal,
-        'deposit': transaction.deposit,
-        'balance': transaction.balance,
-        'branch': transaction.branch,
-        'line_text': transaction.line_text,
-        'category': transaction.category
+        'id': transaction_id,
+        'date_time': date_time,
+        'transaction': sys.intern(transaction_field),
+        'details': details,
+        'extra': extra,
+        'withdrawal': _amount(withdrawal),
+        'deposit': _amount(deposit),
+        'balance': _amount(balance),
+        'branch': sys.intern(branch),
+        'line_text': line,
+        'category': _categorize(details, transaction_field),
     }
-    print(f"Parsed result: {result}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Parsed line {line!r}: {result}")
     return result
+
+
+def parse_lines(lines):
+    """Parse many lines of statement text at once.
+
+    A line that raises while being parsed is recorded as a failure rather
+    than stopping the batch.
+
+    Args:
+        lines (iterable[str]): Lines of statement text
+
+    Returns:
+        dict: ``parsed_transactions``, ``failed_transactions``
+        (``{'line', 'error'}``) and ``non_transactions`` (stripped lines that
+        aren't transactions)
+    """
+    parsed_transactions = []
+    failed_transactions = []
+    non_transactions = []
+    parse = parse_transaction_line
+    for line in lines:
+        try:
+            parsed = parse(line)
+        except Exception as e:
+            logger.info(f"Error parsing line {line!r}: {e}")
+            failed_transactions.append({'line': line, 'error': str(e)})
+            continue
+        if parsed:
+            parsed_transactions.append(parsed)
+        else:
+            non_transactions.append(line.strip())
+
+    return {
+        'parsed_transactions': parsed_transactions,
+        'failed_transactions': failed_transactions,
+        'non_transactions': non_transactions,
+    }
@@ -0,0 +1,129 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+# Bytes read at a time while hashing a PDF
+HASH_CHUNK = 1024 * 1024
+
+
+def content_key(source, version):
+    """Cache key for a PDF: SHA-256 of its bytes and the parser version.
+
+    Args:
+        source (str | Path | file): Path of the PDF, or a seekable binary
+            file, which is left at its start
+        version (int | str): Version of the code that produced the entry
+    """
+    digest = hashlib.sha256()
+    if hasattr(source, 'read'):
+        source.seek(0)
+        _update(digest, source)
+        source.seek(0)
+    else:
+        with open(source, 'rb') as f:
+            _update(digest, f)
+    return f'{digest.hexdigest()}-v{version}'
+
+
+def _update(digest, f):
+    for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+        digest.update(chunk)
+
+
+class StatementCache:
+    """On-disk cache of parsed statements, keyed by content.
+
+    Each entry is a JSON file ``<directory>/<key>.json`` written atomically,
+    so worker processes share the cache. Reading an entry touches its mtime;
+    when the directory grows past ``max_bytes`` the least recently used
+    entries are deleted. The same statement uploaded again, by anyone, is
+    served without opening the PDF.
+    """
+
+    def __init__(self, directory='statement_cache', max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def configure(self, directory, max_bytes):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+
+    def get(self, key):
+        """Return the cached value for ``key``, or None."""
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                value = json.load(f)
+            os.utime(path)
+        except FileNotFoundError:
+            value = None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable statement cache entry {path}: {e}")
+            value = None
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Store a JSON-serializable value, evicting old entries if needed."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        data = json.dumps(value).encode('utf-8')
+        if len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=f'.{path.name}.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for path in self.directory.glob('*.json'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+            with self._lock:
+                self.evictions += 1
+
+    def _path(self, key):
+        return self.directory / f'{key}.json'
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'max_bytes': self.max_bytes}
+
+
+statement_cache = StatementCache()
@@ -0,0 +1,250 @@
+import bisect
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from .pdf_imports import EXTRACT_OPTIONS, page_text
+from .pdf_parser import DATE_PATTERN, TIME_PATTERN, is_numeric, parse_lines, transaction_row
+
+logger = logging.getLogger(__name__)
+
+# Column header labels, as extract_words splits them, and the field each
+# column holds
+HEADER_FIELDS = {
+    'วันที่/เวลา': 'date_time', 'วันที่': 'date_time', 'Date/Time': 'date_time', 'Date': 'date_time',
+    'รายการ': 'transaction', 'Transaction': 'transaction', 'Description': 'transaction',
+    'รายละเอียด/หมายเลขเช็ค': 'details', 'รายละเอียด': 'details', 'Details': 'details',
+    'รายการถอน': 'withdrawal', 'ถอน': 'withdrawal', 'Withdrawal': 'withdrawal',
+    'รายการฝาก': 'deposit', 'ฝาก': 'deposit', 'Deposit': 'deposit',
+    'ยอดเงินคงเหลือ': 'balance', 'คงเหลือ': 'balance', 'Balance': 'balance',
+    'สาขา': 'branch', 'Branch': 'branch',
+}
+# A header row names at least this many columns, date and balance among them
+MIN_HEADER_FIELDS = 4
+AMOUNT_FIELDS = ('withdrawal', 'deposit', 'balance')
+# Columns that only ever hold numbers; a row with words in them is not a
+# continuation of the row above
+NUMERIC_FIELDS = AMOUNT_FIELDS + ('branch',)
+
+# Words whose tops are this close (points) are on the same row
+ROW_TOLERANCE = 2
+
+DEFAULT_MAX_LAYOUTS = 64
+
+
+class ColumnMap:
+    """The x-boundaries of a statement layout's columns.
+
+    Attributes:
+        fields (list[str]): Field held by each column, left to right
+        edges (list[float]): x at which each column after the first begins
+    """
+
+    def __init__(self, fields, edges):
+        self.fields = fields
+        self.edges = edges
+
+    def field(self, word):
+        """The field of the column a word's centre falls in."""
+        return self.fields[bisect.bisect(self.edges, (word['x0'] + word['x1']) / 2)]
+
+    @classmethod
+    def learn(cls, header, rows):
+        """Place the boundaries between the columns of a page.
+
+        Words of the transaction rows are first given to the column whose
+        heading they overlap most (or lie nearest), which finds how far each
+        column's contents really reach; headings alone don't say, as amounts
+        are right-aligned under them and descriptions run past theirs. Each
+        boundary then goes midway across the gap between two columns.
+
+        Args:
+            header (list[tuple]): ``(field, x0, x1)`` of each heading, left
+                to right
+            rows (list[list[dict]]): The page's rows of words below the header
+        """
+        extents = [[x0, x1] for _, x0, x1 in header]
+
+        def nearest(word):
+            def score(column):
+                _, x0, x1 = header[column]
+                overlap = min(x1, word['x1']) - max(x0, word['x0'])
+                return overlap if overlap > 0 else -min(abs(x0 - word['x1']), abs(word['x0'] - x1))
+            return max(range(len(header)), key=score)
+
+        for row in rows:
+            columns = [nearest(word) for word in row]
+            if header[columns[0]][0] != 'date_time' or not DATE_PATTERN.fullmatch(row[0]['text']):
+                continue
+            for word, column in zip(row, columns):
+                extent = extents[column]
+                extent[0] = min(extent[0], word['x0'])
+                extent[1] = max(extent[1], word['x1'])
+
+        edges = []
+        for (_, _, head_right), (_, head_left, _), (_, right), (left, _) in zip(
+                header, header[1:], extents, extents[1:]):
+            edges.append((right + left) / 2 if right < left else (head_right + head_left) / 2)
+        return cls([field for field, _, _ in header], edges)
+
+
+class ColumnMaps:
+    """Learned column maps, keyed by layout fingerprint.
+
+    A fingerprint is the page width and the position of every column
+    heading, so every page of a statement, and later statements from the
+    same bank, share one map. Least recently used layouts are dropped past
+    ``max_layouts``. Each process (including every PDF pool worker) keeps
+    its own maps.
+    """
+
+    def __init__(self, max_layouts=DEFAULT_MAX_LAYOUTS):
+        self.max_layouts = max_layouts
+        self.hits = 0
+        self.misses = 0
+        self._maps = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, page, header, rows):
+        """The column map for a page, learned from it if its layout is new."""
+        fingerprint = layout_fingerprint(page, header)
+        with self._lock:
+            columns = self._maps.get(fingerprint)
+            if columns is not None:
+                self._maps.move_to_end(fingerprint)
+                self.hits += 1
+                return columns
+            self.misses += 1
+        columns = ColumnMap.learn(header, rows)
+        logger.debug(f"Learned columns of layout {fingerprint}: {list(zip(columns.fields, columns.edges))}")
+        with self._lock:
+            self._maps[fingerprint] = columns
+            while len(self._maps) > self.max_layouts:
+                self._maps.popitem(last=False)
+        return columns
+
+    def stats(self):
+        with self._lock:
+            return {'layouts': len(self._maps), 'hits': self.hits, 'misses': self.misses}
+
+
+column_maps = ColumnMaps()
+
+
+def layout_fingerprint(page, header):
+    """Identify a layout by page width and where its column headings sit."""
+    key = repr((round(page.width), [(field, round(x0), round(x1)) for field, x0, x1 in header]))
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+def _rows(words):
+    rows = []
+    for word in sorted(words, key=lambda word: word['top']):
+        if rows and word['top'] - rows[-1][0]['top'] <= ROW_TOLERANCE:
+            rows[-1].append(word)
+        else:
+            rows.append([word])
+    for row in rows:
+        row.sort(key=lambda word: word['x0'])
+    return rows
+
+
+def _find_header(rows):
+    # Index of the column header row and its headings, or (None, None)
+    for index, row in enumerate(rows):
+        header = {}
+        for word in row:
+            field = HEADER_FIELDS.get(word['text'])
+            if field is not None and field not in header:
+                header[field] = (field, word['x0'], word['x1'])
+        if len(header) >= MIN_HEADER_FIELDS and 'date_time' in header and 'balance' in header:
+            return index, sorted(header.values(), key=lambda heading: heading[1])
+    return None, None
+
+
+def _row_text(row):
+    return ' '.join(word['text'] for word in row)
+
+
+def read_page_columns(page):
+    """Parse a pdfplumber page by mapping its words to columns.
+
+    Each word goes to the column its position falls in, so cells map
+    straight to fields: no counting of numbers to tell a withdrawal from a
+    deposit, and no text to rebuild. A transaction's time and any wrapped
+    description on the row below are joined to it. Pages without a column
+    header fall back to the line parser.
+
+    Used as a PageExtractor reader, so it runs in pool workers.
+
+    Returns:
+        dict: ``parsed_transactions``, ``failed_transactions`` and
+        ``non_transactions`` as parse_lines returns them, and ``lines``, the
+        number of rows read
+    """
+    rows = _rows(page.extract_words(**EXTRACT_OPTIONS))
+    start, header = _find_header(rows)
+    if header is None:
+        text = page_text(page)
+        result = parse_lines(text.split('\n'))
+        result['lines'] = text.count('\n') + 1
+        return result
+
+    columns = column_maps.get(page, header, rows[start + 1:])
+    parsed_transactions = []
+    failed_transactions = []
+    non_transactions = [_row_text(row) for row in rows[:start + 1]]
+    current = None
+
+    def finish():
+        if current is None:
+            return
+        cells = {field: ' '.join(words) for field, words in current['cells'].items()}
+        line = ' '.join(current['text'])
+        amounts = {field: cells.get(field, '') for field in NUMERIC_FIELDS}
+        bad = [f"{field} {value!r}" for field, value in amounts.items()
+               if value and (' ' in value or not is_numeric(value))]
+        if bad:
+            failed_transactions.append({'line': line, 'error': f"Unreadable {', '.join(bad)}"})
+        elif not amounts['balance'] or not (amounts['withdrawal'] or amounts['deposit']):
+            # Such as the balance brought forward
+            non_transactions.append(line)
+        else:
+            parsed_transactions.append(transaction_row(
+                line, None, cells['date_time'], cells.get('transaction', ''), cells.get('details', ''), '',
+                amounts['withdrawal'], amounts['deposit'], amounts['balance'], amounts['branch']))
+
+    for row in rows[start + 1:]:
+        cells = {}
+        for word in row:
+            cells.setdefault(columns.field(word), []).append(word['text'])
+        dates = cells.get('date_time')
+        if dates and DATE_PATTERN.fullmatch(dates[0]):
+            finish()
+            current = {'cells': cells, 'text': [_row_text(row)], 'bottom': row[0]['bottom']}
+        elif (current is not None and not any(field in cells for field in NUMERIC_FIELDS)
+              and row[0]['top'] - current['bottom'] <= row[0]['bottom'] - row[0]['top']):
+            # Wrapped onto the next row: the time under the date, the rest of
+            # a long description
+            for field, words in cells.items():
+                if field == 'date_time':
+                    date_time = current['cells']['date_time']
+                    if len(date_time) == 1 and TIME_PATTERN.fullmatch(words[0]):
+                        date_time.append(words.pop(0))
+                    field = 'transaction'
+                current['cells'].setdefault(field, []).extend(words)
+            current['text'].append(_row_text(row))
+            current['bottom'] = row[0]['bottom']
+        else:
+            finish()
+            current = None
+            non_transactions.append(_row_text(row))
+    finish()
+
+    return {
+        'parsed_transactions': parsed_transactions,
+        'failed_transactions': failed_transactions,
+        'non_transactions': non_transactions,
+        'lines': len(rows),
+    }
@@ -0,0 +1,140 @@
+import os
+import threading
+from collections import OrderedDict
+
+# Parsed Transaction objects take several times the space of the CSV text
+# they came from; cached entries are charged at this multiple of file size.
+PARSED_SIZE_FACTOR = 4
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+def file_signature(file_path):
+    """Return a (mtime_ns, size, inode) tuple identifying a file's contents.
+
+    Args:
+        file_path (Path | str): File to stat
+
+    Returns:
+        tuple | None: The signature, or None if the file does not exist
+    """
+    try:
+        st = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+class TransactionCache:
+    """In-process LRU cache of parsed transactions, keyed by user id.
+
+    Each entry remembers the signature of the file it was parsed from and is
+    discarded as soon as the file on disk no longer matches it. Entries are
+    evicted least-recently-used first once their estimated size exceeds
+    ``max_bytes``.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def configure(self, max_bytes):
+        """Change the memory cap, evicting entries if it shrank."""
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def get(self, user_id, signature):
+        """Return a copy of the cached transactions for a user.
+
+        Args:
+            user_id (str): The ID of the user
+            signature (tuple): Current signature of the user's file
+
+        Returns:
+            list[Transaction] | None: Copies of the cached transactions, or
+            None if nothing valid is cached
+        """
+        key = str(user_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != signature:
+                if entry is not None:
+                    self._drop(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            transactions = entry[1]
+        # Callers are free to mutate what they get back, so never hand out
+        # the cached objects themselves.
+        return [t.__copy__() for t in transactions]
+
+    def peek(self, user_id, signature):
+        """Return the cached transactions themselves, without copying.
+
+        For read-only scans that copy only what they keep. Does not count
+        as a hit or miss.
+        """
+        with self._lock:
+            entry = self._entries.get(str(user_id))
+            if entry is None or entry[0] != signature:
+                return None
+            return entry[1]
+
+    def put(self, user_id, signature, transactions):
+        """Cache the transactions parsed from a file with the given signature."""
+        if signature is None:
+            return
+        key = str(user_id)
+        size = signature[1] * PARSED_SIZE_FACTOR
+        if size > self.max_bytes:
+            return
+        entry = (signature, [t.__copy__() for t in transactions], size)
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = entry
+            self._size += size
+            self._evict()
+
+    def invalidate(self, user_id):
+        """Forget whatever is cached for a user."""
+        with self._lock:
+            self._drop(str(user_id))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        """Return hit/miss counters and current usage."""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'size': self._size,
+                'max_bytes': self.max_bytes,
+            }
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry[2]
+
+    def _evict(self):
+        while self._size > self.max_bytes and self._entries:
+            _, entry = self._entries.popitem(last=False)
+            self._size -= entry[2]
+            self.evictions += 1
+
+
+transaction_cache = TransactionCache()
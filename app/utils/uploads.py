@@ -0,0 +1,39 @@
+import shutil
+import tempfile
+
+from flask import Request, current_app
+
+# Uploads up to this size stay in memory; larger ones spill to a temp file
+DEFAULT_SPOOL_MAX_BYTES = 4 * 1024 * 1024
+
+
+def spooled_file():
+    """An empty binary buffer kept in memory up to UPLOAD_SPOOL_MAX_BYTES."""
+    max_size = current_app.config.get('UPLOAD_SPOOL_MAX_BYTES', DEFAULT_SPOOL_MAX_BYTES)
+    return tempfile.SpooledTemporaryFile(max_size=max_size, mode='w+b')
+
+
+def spool_upload(file):
+    """Copy an uploaded file into a buffer that outlives the request.
+
+    Werkzeug closes upload streams when the request ends, so work that
+    carries on afterwards (such as a background import) needs its own copy.
+    The caller closes it.
+    """
+    spool = spooled_file()
+    file.stream.seek(0)
+    shutil.copyfileobj(file.stream, spool)
+    spool.seek(0)
+    return spool
+
+
+class SpooledUploadRequest(Request):
+    """Request whose uploaded files are spooled per UPLOAD_SPOOL_MAX_BYTES.
+
+    Werkzeug's default keeps only the first 500 KB of an upload in memory;
+    statements a little larger than that would otherwise be written to disk
+    and read back for every preview.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return spooled_file()
@@ -0,0 +1,67 @@
+"""Microbenchmark: per-row date fallback chain vs per-column detected parser.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_date_parsing [rows]
+"""
+import sys
+import time
+from datetime import datetime, timedelta
+
+from app.utils.dates import (
+    DATE_TIME_FORMATS, TIMESTAMP_FORMATS, DateColumnParser, parse_date_time, parse_timestamp,
+)
+
+
+def make_rows(n, statement_dates):
+    start = datetime(2020, 1, 1, 8, 30)
+    rows = []
+    for i in range(n):
+        when = start + timedelta(minutes=37 * i)
+        date_time = when.strftime('%d/%m/%y %H:%M') if statement_dates else str(when)
+        stamp = str(when + timedelta(days=1, microseconds=i))
+        rows.append((date_time, stamp, stamp))
+    return rows
+
+
+def slow(rows):
+    for date_time, created_at, updated_at in rows:
+        parse_date_time(date_time)
+        parse_timestamp(created_at)
+        parse_timestamp(updated_at)
+
+
+def fast(rows):
+    date_time = DateColumnParser(DATE_TIME_FORMATS, parse_date_time)
+    created_at = DateColumnParser(TIMESTAMP_FORMATS, parse_timestamp)
+    updated_at = DateColumnParser(TIMESTAMP_FORMATS, parse_timestamp)
+    head = rows[:20]
+    date_time.detect(r[0] for r in head)
+    created_at.detect(r[1] for r in head)
+    updated_at.detect(r[2] for r in head)
+    for d, c, u in rows:
+        date_time.parse(d)
+        created_at.parse(c)
+        updated_at.parse(u)
+    return date_time.fallbacks + created_at.fallbacks + updated_at.fallbacks
+
+
+def timed(func, rows):
+    t0 = time.perf_counter()
+    result = func(rows)
+    return time.perf_counter() - t0, result
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    for label, statement_dates in (('dd/mm/yy HH:MM', True), ('ISO', False)):
+        rows = make_rows(n, statement_dates)
+        before, _ = timed(slow, rows)
+        after, fallbacks = timed(fast, rows)
+        print(f"{label:>15}: before {n / before:>12,.0f} rows/s   "
+              f"after {n / after:>12,.0f} rows/s   "
+              f"x{before / after:.1f}   fallbacks {fallbacks}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+"""Microbenchmark: line-by-line statement parsing vs whole-page scanning.
+
+Imports parse each page with parse_lines. scan_page below finds the
+transaction lines with one regex over the whole page instead; it gives
+the same output but measured no repeatable gain (most of the time goes
+into building each row, which both paths share), so it stays here as an
+experiment rather than on the import path.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_statement_scan [pages]
+"""
+import random
+import re
+import sys
+import time
+
+from app.utils.pdf_parser import _build, is_numeric, parse_lines, parse_transaction_line
+
+# Finds the lines of a page that start with a date, run over the page with a
+# newline in front. Starting on a literal newline lets the regex engine skip
+# from line to line instead of trying every character. ``_`` is whitespace
+# other than a newline. The first branch captures the common layout (date,
+# optional time, description, then three or four plain amounts) so the line
+# needn't be tokenized; anything else that may be a transaction goes to
+# parse_transaction_line
+TRANSACTION_SCAN = re.compile(r'''
+    \n(?:
+        _*(?:(?P<id>\d+)_+)?
+        (?P<date>\d{2}/\d{2}/\d{2}\S*)
+        (?:_+(?P<time>\d{1,2}:\d{2}\S*)|(?!_+\d{1,2}:\d{2}))
+        _+(?P<type>\S+)
+        (?P<details>(?:_+\S+)*?)
+        (?P<numbers>(?:_+-?[\d,]*\.?\d+){3,4})_*$
+      | _*(?:\S+_+)?\d{2}/\d{2}/\d{2}.*
+    )
+'''.replace('_', r'[^\S\n]'), re.MULTILINE | re.VERBOSE)
+
+HEADER = [
+    'รายการเดินบัญชี',
+    'รายการบัญชีระหว่างวันที่ 01/02/25 ถึง 31/03/25',
+    'วันที่ส่งคำขอ 07/03/25',
+    'ชื่อบัญชี นาย ตัวอย่าง ทดสอบ ประเภทบัญชี ออมทรัพย์',
+    'สาขา PHUNPHIN BR.',
+    'เลขที่บัญชี 0000000000 รหัสสาขา 808',
+    'วันที่ รายการ รายละเอียด ถอน ฝาก คงเหลือ สาขา',
+]
+
+TRANSACTIONS = [
+    'เงินโอนเข้า (IORSDT) 011-{account}',
+    'โอนเงินออก (IORSWT) 011-{account}',
+    'จ่ายค่าสินค้า/บริการออนไลน์ ONA eastmallbuy com',
+    'จ่ายบิล BILLERID {account}',
+    'ชำระค่าสินค้า MRT-BEM {account}',
+]
+
+
+NOTES = [
+    'ยอดยกมา / Balance brought forward',
+    'รายการนี้ไม่รวมค่าธรรมเนียม Fees are not included in this listing',
+    'สอบถามข้อมูลเพิ่มเติม โทร 02 000 0000 Contact centre, 24 hours',
+    'ธนาคารขอสงวนสิทธิ์ในการแก้ไขข้อมูล The bank reserves the right to amend',
+]
+
+
+def make_pages(n, rows_per_page, notes_per_page, seed=0):
+    rng = random.Random(seed)
+    balance = 100_000.0
+    pages = []
+    for page in range(n):
+        lines = list(HEADER)
+        lines += [rng.choice(NOTES) for _ in range(notes_per_page)]
+        for row in range(rows_per_page):
+            amount = round(rng.uniform(10, 5_000), 2)
+            balance += amount if row % 3 == 0 or balance < amount else -amount
+            date = f'{rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}/25'
+            if rng.random() < 0.5:
+                date += f' {rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}'
+            description = rng.choice(TRANSACTIONS).format(account=rng.randint(10**9, 10**10 - 1))
+            lines.append(f'{date} {description} {amount:,.2f} {balance:,.2f} 808')
+        lines.append(f'หน้า {page + 1}')
+        pages.append('\n'.join(lines))
+    return pages
+
+
+def scan_page(text):
+    """Parse a whole page of statement text in one pass.
+
+    The experiment: gives the same rows as ``parse_lines(text.split('\\n'))``, but a single
+    TRANSACTION_SCAN over the page finds the transaction lines, and the
+    runs of lines between them are never looked at one by one.
+
+    Returns:
+        dict: What parse_lines returns, plus ``spans``: the ``(start, end)``
+        offsets in ``text`` of each parsed transaction's line
+    """
+    parsed_transactions = []
+    spans = []
+    failed_transactions = []
+    non_transactions = []
+    # Start of the first line not yet accounted for
+    pos = 0
+    for match in TRANSACTION_SCAN.finditer('\n' + text):
+        # The match starts on the newline put in front, so its span is the
+        # line's span in ``text`` shifted by one
+        start, end = match.start(), match.end() - 1
+        if start > pos:
+            non_transactions += [line.strip() for line in text[pos:start - 1].split('\n')]
+        pos = end + 1
+        line = text[start:end]
+        transaction_id, date_time, time, transaction_field, details, numbers = match.groups()
+        try:
+            description = details.split() if date_time is not None else None
+            # A numeric last word means more numbers than the pattern took
+            if description is None or is_numeric(description[-1] if description else transaction_field):
+                parsed = parse_transaction_line(line)
+            else:
+                description.insert(0, transaction_field)
+                if time is not None:
+                    date_time += " " + time
+                parsed = _build(line, transaction_id, date_time, description, numbers.split())
+        except Exception as e:
+            failed_transactions.append({'line': line, 'error': str(e)})
+            continue
+        if parsed:
+            parsed_transactions.append(parsed)
+            spans.append((start, end))
+        else:
+            non_transactions.append(line.strip())
+    if pos <= len(text):
+        non_transactions += [line.strip() for line in text[pos:].split('\n')]
+
+    return {
+        'parsed_transactions': parsed_transactions,
+        'failed_transactions': failed_transactions,
+        'non_transactions': non_transactions,
+        'spans': spans,
+    }
+
+
+def by_line(pages):
+    return [parse_lines(page.split('\n')) for page in pages]
+
+
+def by_page(pages):
+    return [scan_page(page) for page in pages]
+
+
+def timed(func, pages):
+    t0 = time.perf_counter()
+    result = func(pages)
+    return time.perf_counter() - t0, result
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    for label, rows, notes in (('dense', 40, 0), ('text-heavy', 5, 60)):
+        pages = make_pages(n, rows, notes)
+        lines = sum(page.count('\n') + 1 for page in pages)
+        before, expected = timed(by_line, pages)
+        after, results = timed(by_page, pages)
+        same = all(result['parsed_transactions'] == page['parsed_transactions']
+                   and result['non_transactions'] == page['non_transactions']
+                   for result, page in zip(results, expected))
+        print(f"{label:>10}: before {lines / before:>10,.0f} lines/s   "
+              f"after {lines / after:>10,.0f} lines/s   x{before / after:.1f}   same rows {same}")
+
+
+if __name__ == '__main__':
+    main()
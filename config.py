@@ -6,4 +6,59 @@ class Config:
     
     # Upload settings
     UPLOAD_FOLDER = 'uploads'
+    # Uploaded statements are parsed straight from memory; only uploads
+    # larger than this are spooled to a temporary file
+    UPLOAD_SPOOL_MAX_BYTES = 4 * 1024 * 1024
+
+    # Database used by the 'sqlite' transaction backend
+    SQLALCHEMY_DATABASE_URI = 'sqlite:///finance.db'
+
+    # Where user transactions are stored: 'csv' keeps one file per user in
+    # user_transactions/, 'partitioned' one file per user and month in
+    # user_transactions/<id>/, 'sqlite' keeps them in the indexed database above
+    TRANSACTION_BACKEND = 'csv'
+
+    # 'partitioned' backend: gzip months older than this many months
+    # (None keeps every month uncompressed)
+    TRANSACTION_COMPRESS_AFTER_MONTHS = 6
+
+    # Keep a memory-mapped binary copy of each user's CSV (<id>.bin) so
+    # reads skip CSV parsing; the CSV remains the source of truth
+    TRANSACTION_SNAPSHOTS = True
+
+    # Upper bound on memory used by the per-user transaction cache
+    TRANSACTION_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+    # Werkzeug method (and cost) for new password hashes; older hashes are
+    # upgraded when their owner next logs in
+    PASSWORD_HASH_METHOD = 'pbkdf2:sha256:600000'
+    # Threads hashing passwords at once, bounding the CPU logins can take
+    PASSWORD_HASH_WORKERS = 2
+
+    # Processes extracting PDF pages for statement imports (None: one per CPU)
+    PDF_EXTRACT_WORKERS = None
+    # PDF engine: 'pdfplumber', 'pypdf', 'pymupdf' (when installed) or 'auto',
+    # the fastest engine whose text parses as well as the others'
+    PDF_BACKEND = 'auto'
+    # Engine per bank, keyed by text on the first page of its statements,
+    # e.g. {'krungthai.com': 'pdfplumber'}
+    PDF_BACKEND_OVERRIDES = {}
+
+    # Background statement imports: job state and previews are kept in
+    # IMPORT_JOB_FOLDER for IMPORT_JOB_TTL seconds
+    IMPORT_JOB_FOLDER = 'import_jobs'
+    IMPORT_JOB_WORKERS = 2
+    IMPORT_JOB_TTL = 24 * 60 * 60
+
+    # How statement pages are read: 'text' parses each line of the page's
+    # text, 'words' places words in columns learned from the table header
+    STATEMENT_EXTRACT_MODE = 'text'
+
+    # Parsed statements cached by content hash, shared by all workers
+    STATEMENT_CACHE_FOLDER = 'statement_cache'
+    STATEMENT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+    # Fingerprints of each user's stored rows, used to skip rows of
+    # overlapping statements that were imported before
+    ROW_FINGERPRINT_FOLDER = 'row_fingerprints'
     DEBUG = True